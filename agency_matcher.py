@@ -0,0 +1,109 @@
+import re
+from typing import Dict, Iterable, List, Optional
+
+# Por defecto el código es el nombre del archivo, sin distinguir mayúsculas
+DEFAULT_PDF_MATCH_RULES = 'casefold'
+
+
+def is_pdf_filename(filename: str) -> bool:
+    return filename[-4:].lower() == '.pdf' and len(filename) > 4 and not filename.startswith('.')
+
+
+def parse_match_rules(spec: str) -> Dict:
+    """
+    Lee las reglas para obtener el código de agencia del nombre de un PDF,
+    separadas por ';', p. ej.
+        'regex: 1099_(\\w+)_\\d{4}; prefix: 1099_, F-; suffix: _final; casefold'
+    - regex: el código es el grupo 'agency', el primer grupo o la coincidencia
+    - prefix / suffix: prefijos y sufijos (separados por ',') que se quitan
+    - casefold: compara con los códigos de clientes sin distinguir mayúsculas
+    """
+    rules = {'regex': [], 'prefix': [], 'suffix': [], 'casefold': False}
+    for part in (spec or '').split(';'):
+        if not part.strip():
+            continue
+        kind, _, value = part.partition(':')
+        kind = kind.strip().lower()
+        if kind == 'casefold' and not value.strip():
+            rules['casefold'] = True
+        elif kind == 'regex' and value.strip():
+            try:
+                rules['regex'].append(re.compile(value.strip()))
+            except re.error as e:
+                raise ValueError(f"Expresión regular no válida en {part.strip()!r}: {str(e)}")
+        elif kind in ('prefix', 'suffix') and value.strip():
+            rules[kind].extend(item.strip() for item in value.split(',') if item.strip())
+        else:
+            raise ValueError(f"Regla de nombres de PDF no válida: {part.strip()!r}")
+    return rules
+
+
+def _affix_pattern(affixes: List[str], template: str, flags: int):
+    if not affixes:
+        return None
+    # Los más largos primero, para que '1099_NEC_' gane a '1099_'
+    alternatives = '|'.join(re.escape(affix) for affix in sorted(affixes, key=len, reverse=True))
+    return re.compile(template.format(alternatives), flags)
+
+
+class AgencyMatcher:
+    """
+    Resuelve el código de agencia de un PDF a partir de su nombre. Las reglas
+    se compilan una sola vez y los códigos de clientes se guardan en memoria
+    (clave normalizada -> código), así cada archivo se resuelve con unas pocas
+    búsquedas en un dict y sin consultas a la base de datos.
+    Candidatos, en orden: capturas de las reglas regex, el nombre sin
+    prefijos/sufijos y el nombre tal cual. Gana el primero que corresponde a
+    un cliente; si ninguno, el primero (el PDF queda pendiente con ese código).
+    """
+
+    def __init__(self, spec: str = DEFAULT_PDF_MATCH_RULES):
+        rules = parse_match_rules(spec)
+        self.casefold = rules['casefold']
+        flags = re.IGNORECASE if self.casefold else 0
+        self.patterns = rules['regex']
+        self.prefix_pattern = _affix_pattern(rules['prefix'], '^(?:{})', flags)
+        self.suffix_pattern = _affix_pattern(rules['suffix'], '(?:{})$', flags)
+        self._codes: Dict[str, str] = {}
+
+    def key(self, code: str) -> str:
+        return code.casefold() if self.casefold else code
+
+    def load_codes(self, codes: Iterable[str]) -> int:
+        """Reemplaza el índice de códigos de clientes; devuelve cuántos cargó"""
+        index = {}
+        for code in codes:
+            if code:
+                index.setdefault(self.key(code), code)
+        # Se reemplaza el dict completo: los lectores nunca ven uno a medias
+        self._codes = index
+        return len(index)
+
+    def candidates(self, stem: str) -> List[str]:
+        found = []
+        for pattern in self.patterns:
+            match = pattern.search(stem)
+            if match:
+                if 'agency' in pattern.groupindex:
+                    found.append(match.group('agency'))
+                else:
+                    found.append(match.group(1) if pattern.groups else match.group(0))
+        stripped = stem
+        if self.prefix_pattern:
+            stripped = self.prefix_pattern.sub('', stripped, count=1)
+        if self.suffix_pattern:
+            stripped = self.suffix_pattern.sub('', stripped, count=1)
+        found.extend((stripped, stem))
+        return [candidate.strip() for candidate in found if candidate and candidate.strip()]
+
+    def match(self, filename: str) -> Optional[str]:
+        """Código de agencia de un PDF ('1099_ABC123_2024.pdf' -> 'ABC123'), o None si no es PDF"""
+        if not is_pdf_filename(filename):
+            return None
+        candidates = self.candidates(filename[:-4])
+        codes = self._codes
+        for candidate in candidates:
+            code = codes.get(self.key(candidate))
+            if code is not None:
+                return code
+        return candidates[0] if candidates else None
@@ -1,12 +1,21 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, Response
 import os
-from database import DatabaseManager
-from mailer import OutlookSender
-import pandas as pd
+import io
+import csv
+from database import DatabaseManager, release_thread_connections
+from mailer import create_mailer
+from template_engine import render_template as render_email_template, validate_template
+from job_worker import SendJobWorker
+from pdf_index import PDFIndex
+from agency_matcher import AgencyMatcher, DEFAULT_PDF_MATCH_RULES, is_pdf_filename
+from pdf_watcher import PDFEventBatcher
+from pdf_ingest import ingest_files
+from pdf_store import PDFStore, stored_rows
+from pdf_splitter import PDFSplitter, parse_page_mapping
+from rate_limiter import DEFAULT_RATE_LIMITS, parse_rate_limits
 from datetime import datetime
 import shutil
-import time
-import uuid
+import tempfile
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
@@ -17,89 +26,306 @@ app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__fil
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
+# Configuración del transporte de correo ('outlook' o 'smtp')
+app.config['MAIL_TRANSPORT'] = os.environ.get('MAIL_TRANSPORT', 'outlook' if os.name == 'nt' else 'smtp')
+app.config['SMTP_HOST'] = os.environ.get('SMTP_HOST', 'localhost')
+app.config['SMTP_PORT'] = int(os.environ.get('SMTP_PORT', '587'))
+app.config['SMTP_USER'] = os.environ.get('SMTP_USER')
+app.config['SMTP_PASSWORD'] = os.environ.get('SMTP_PASSWORD')
+app.config['SMTP_USE_TLS'] = os.environ.get('SMTP_USE_TLS', 'true')
+app.config['SMTP_USE_SSL'] = os.environ.get('SMTP_USE_SSL', 'false')
+app.config['SMTP_FROM'] = os.environ.get('SMTP_FROM')
+app.config['SMTP_POOL_SIZE'] = int(os.environ.get('SMTP_POOL_SIZE', '4'))
+app.config['SEND_CONCURRENCY'] = int(os.environ.get('SEND_CONCURRENCY', '4'))
+# Límites por dominio del destinatario, p. ej. "gmail.com: 20/min, default: 100/min".
+# Vacío (por defecto) = sin límites; los borradores nunca se limitan
+app.config['SEND_RATE_LIMITS'] = os.environ.get('SEND_RATE_LIMITS', DEFAULT_RATE_LIMITS)
+# Tamaño máximo de los PDFs de un envío agrupado por destinatario (MB)
+app.config['COALESCE_MAX_BYTES'] = int(float(os.environ.get('COALESCE_MAX_MB', '15')) * 1024 * 1024)
+# Procesos que preparan los mensajes por delante del envío (0 = preparar al enviar)
+app.config['RENDER_WORKERS'] = int(os.environ.get('RENDER_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Caché de adjuntos codificados: memoria máxima (MB) y carpeta opcional para lo que no cabe
+app.config['ATTACHMENT_CACHE_MB'] = os.environ.get('ATTACHMENT_CACHE_MB', '64')
+app.config['ATTACHMENT_CACHE_FOLDER'] = os.environ.get('ATTACHMENT_CACHE_FOLDER')
+# Reglas para obtener el código de agencia del nombre de un PDF (ver agency_matcher.py),
+# p. ej. "regex: 1099_(\w+)_\d{4}; prefix: 1099_; casefold"
+app.config['PDF_MATCH_RULES'] = os.environ.get('PDF_MATCH_RULES', DEFAULT_PDF_MATCH_RULES)
+# Procesos que dividen un PDF combinado por agencia (0 = en el proceso del servidor)
+app.config['SPLIT_WORKERS'] = int(os.environ.get('SPLIT_WORKERS', str(os.cpu_count() or 1)))
+app.config['DRAFTS_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'drafts')
+
 # Inicializar la base de datos al arrancar
 db = DatabaseManager()
 db.connect()  # Conectar antes de setup
 db.setup_database()
 db.close()  # Cerrar después de setup
 
-# Variables globales para el estado del envío
-sending_status = {
-    'is_sending': False,
-    'total': 0,
-    'current': 0,
-    'current_agency': ''
-}
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    # El servidor atiende cada petición en un hilo nuevo: su conexión vuelve
+    # al pool en lugar de quedar abierta hasta que se recolecte el hilo
+    release_thread_connections()
+
+# Crear el backend de envío (Outlook o SMTP con pool de conexiones)
+mailer = create_mailer(app.config)
+
+# Reglas de nombres de PDF compiladas y códigos de clientes en memoria
+agency_matcher = AgencyMatcher(app.config['PDF_MATCH_RULES'])
+agency_matcher.load_codes(DatabaseManager().get_agency_codes())
+
+# Índice en memoria de los PDFs de uploads; lo mantiene al día PDFHandler
+pdf_index = PDFIndex(app.config['UPLOAD_FOLDER'], agency_matcher)
+pdf_index.rebuild()
 
-# Crear instancia del manejador de Outlook
-mailer = OutlookSender()
+# Almacén por contenido de los PDFs subidos (uploads/.blobs)
+pdf_store = PDFStore(app.config['UPLOAD_FOLDER'], matcher=agency_matcher)
+
+
+def refresh_agency_codes():
+    """
+    Recarga los códigos de clientes del matcher (p. ej. tras importar) y
+    vuelve a indexar la carpeta, por si algún PDF ahora corresponde a otro código
+    """
+    agency_matcher.load_codes(DatabaseManager().get_agency_codes())
+    return pdf_index.rebuild()
 
 class PDFHandler(FileSystemEventHandler):
-    def __init__(self, app):
+    """
+    Recibe los eventos del watcher y los pasa a un PDFEventBatcher: los PDFs
+    se vinculan cuando terminan de copiarse y por lotes, en una transacción
+    por lote, en lugar de varias consultas por archivo
+    """
+
+    def __init__(self, app, pdf_index: PDFIndex, pdf_store: PDFStore):
         self.app = app
-        self.db = DatabaseManager()
+        self.pdf_index = pdf_index
+        self.pdf_store = pdf_store
+        self.batcher = PDFEventBatcher(self.apply_batch)
+
+    def is_pdf(self, path: str) -> bool:
+        return (os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.pdf_index.folder)
+                and is_pdf_filename(os.path.basename(path)))
 
     def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.pdf'):
-            with self.app.app_context():
-                try:
-                    # Obtener el nombre del archivo sin la ruta
-                    filename = os.path.basename(event.src_path)
-                    # Extraer el código de agencia del nombre del archivo
-                    agency_code = filename.replace('.pdf', '')
-                    
-                    # Verificar si existe el cliente
-                    client = self.db.get_client_by_agency_code(agency_code)
-                    
-                    if client:
-                        self.db.update_client_pdf_status(agency_code, True)
-                        self.db.add_log('SYSTEM', 'auto_pdf_import', 'success', 
-                                      f'PDF {filename} vinculado automáticamente')
-                    else:
-                        self.db.add_pending_pdf(agency_code)
-                        self.db.add_log('SYSTEM', 'auto_pdf_import', 'pending', 
-                                      f'PDF {filename} agregado a pendientes')
-                except Exception as e:
-                    self.db.add_log('SYSTEM', 'auto_pdf_import', 'error', 
-                                  f'Error procesando {filename}: {str(e)}')
+        if not event.is_directory and self.is_pdf(event.src_path):
+            self.batcher.created(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory and self.is_pdf(event.src_path):
+            self.batcher.modified(event.src_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory and self.is_pdf(event.src_path):
+            self.batcher.deleted(event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        src_path = event.src_path if self.is_pdf(event.src_path) else None
+        dest_path = event.dest_path if self.is_pdf(event.dest_path) else None
+        if src_path or dest_path:
+            self.batcher.moved(src_path, dest_path)
+
+    def apply_batch(self, created, deleted):
+        """Actualiza el índice y la base de datos con un lote ya asentado"""
+        # Código con el que estaba indexado cada PDF borrado (o el que resuelve su nombre)
+        deleted_codes = [self.pdf_index.remove(path) or self.pdf_index.matcher.match(os.path.basename(path))
+                         for path in deleted]
+        touched, adopted = set(), []
+        # Registro del almacén de todo el lote en una sola consulta
+        known = self.pdf_store.known_files(os.path.basename(path) for path in created) if created else {}
+        for path in created:
+            entry = self.pdf_index.update(path)
+            if entry:
+                # El hash ya está en el índice si el PDF llegó por una subida
+                record = self.pdf_store.adopt(entry['path'], entry['hash'], known)
+                if record:
+                    adopted.append(record)
+                    if entry['hash'] is None:
+                        self.pdf_index.update(path, digest=record['hash'])
+                touched.add(entry['agency_code'])
+        removed = []
+        for code in deleted_codes:
+            if code is None:
+                continue
+            # Un borrado seguido de una nueva copia, u otro PDF de la misma
+            # agencia, deja la agencia con PDF (quizás con otro archivo elegido)
+            if self.pdf_index.exists(code):
+                touched.add(code)
+            else:
+                removed.append(code)
+        # Se vincula la versión del archivo elegido para cada agencia
+        hashes = {}
+        for code in touched:
+            try:
+                digest = self.pdf_index.file_hash(code)
+            except OSError:
+                digest = None
+            if digest:
+                hashes[code] = digest
+        conflicts = self.pdf_index.conflicts(touched)
+        stored = stored_rows(adopted)
+        with self.app.app_context():
+            db_instance = DatabaseManager()
+            # Los PDFs cuyo contenido ya está registrado (p. ej. los que vinculó
+            # la subida, o una copia idéntica) no se vuelven a vincular
+            if hashes:
+                known = db_instance.get_pdf_hashes(hashes)
+                hashes = {code: digest for code, digest in hashes.items() if known.get(code) != digest}
+            if hashes or removed or conflicts or stored:
+                db_instance.apply_pdf_changes(list(hashes), removed, source='auto_pdf_import', hashes=hashes,
+                                              conflicts=conflicts, stored_files=stored)
 
 def setup_pdf_watcher(app):
-    event_handler = PDFHandler(app)
+    event_handler = PDFHandler(app, pdf_index, pdf_store)
+    event_handler.batcher.start()
     observer = Observer()
     observer.schedule(event_handler, path=app.config['UPLOAD_FOLDER'], recursive=False)
     observer.start()
     app.logger.info('PDF watcher iniciado')
-    return observer
+    return observer, event_handler
 
 @app.route('/')
 def index():
     try:
-        # Obtener lista de PDFs en el directorio de uploads
-        pdfs = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.endswith('.pdf')]
-        
-        # Obtener registros de la base de datos
-        db_instance = DatabaseManager()
-        sent_emails = db_instance.get_sent_emails()
-        pending_emails = db_instance.get_pending_clients()
-        pending_pdfs = db_instance.get_pending_pdfs()
-        logs = db_instance.get_logs()
-        
-        return render_template('index.html', 
-                             pdfs=pdfs,
-                             sent_emails=sent_emails,
-                             pending_emails=pending_emails,
-                             pending_pdfs=pending_pdfs,
-                             logs=logs,
-                             sending_status=sending_status)
+        # PDFs del directorio de uploads, según el índice en memoria
+        pdfs = pdf_index.filenames()
+
+        # Las tablas de correos, pendientes y logs se cargan desde el navegador
+        # página por página (ver /api/...), así la carga no crece con la base
+        return render_template('index.html', pdfs=pdfs)
     except Exception as e:
         return f"Error: {str(e)}"
-    finally:
-        if 'db_instance' in locals():
-            db_instance.close()
+
+def page_args():
+    """
+    Lee los parámetros comunes de los listados paginados
+    (cursor, limit, status, agency_code, date_from, date_to)
+    """
+    args = {
+        'cursor': request.args.get('cursor', type=int),
+        'limit': request.args.get('limit', 50, type=int),
+        'status': request.args.get('status') or None,
+        'agency_code': (request.args.get('agency_code') or '').strip() or None,
+        'date_from': request.args.get('date_from') or None,
+        'date_to': request.args.get('date_to') or None
+    }
+    for key in ('date_from', 'date_to'):
+        if args[key]:
+            # Valida el formato; lanza ValueError si no es YYYY-MM-DD
+            datetime.strptime(args[key], '%Y-%m-%d')
+    return args
+
+@app.route('/api/logs')
+def api_logs():
+    try:
+        page = DatabaseManager().get_logs_page(**page_args())
+        return jsonify({'success': True, **page})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Parámetro no válido: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/sent-emails')
+def api_sent_emails():
+    try:
+        page = DatabaseManager().get_sent_emails_page(**page_args())
+        return jsonify({'success': True, **page})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Parámetro no válido: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/pending-clients')
+def api_pending_clients():
+    try:
+        args = page_args()
+        # Para los pendientes, status filtra por PDF: 'with_pdf' o 'without_pdf'
+        status = args.pop('status')
+        args.pop('date_from')
+        args.pop('date_to')
+        if status not in (None, 'with_pdf', 'without_pdf'):
+            raise ValueError(f"status debe ser 'with_pdf' o 'without_pdf', no {status!r}")
+        has_pdf = None if status is None else status == 'with_pdf'
+        page = DatabaseManager().get_pending_clients_page(has_pdf=has_pdf, **args)
+        return jsonify({'success': True, **page})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Parámetro no válido: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@app.route('/api/pending-pdfs')
+def api_pending_pdfs():
+    try:
+        args = page_args()
+        # Para los PDFs sin cliente, status es 'pending' o 'processed' (ya vinculados)
+        status = args.pop('status')
+        if status not in (None, 'pending', 'processed'):
+            raise ValueError(f"status debe ser 'pending' o 'processed', no {status!r}")
+        processed = None if status is None else status == 'processed'
+        page = DatabaseManager().get_pending_pdfs_page(processed=processed, **args)
+        return jsonify({'success': True, **page})
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'Parámetro no válido: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
 
 @app.route('/get-status')
 def get_status():
-    return jsonify(sending_status)
+    # El progreso se lee del trabajo de envío persistido en la base de datos
+    job_id = request.args.get('job_id', type=int)
+    job = DatabaseManager().get_send_job(job_id)
+    if not job:
+        return jsonify({'is_sending': False, 'total': 0, 'current': 0, 'current_agency': ''})
+    return jsonify({
+        'is_sending': job['status'] in ('queued', 'running'),
+        'total': job['total'],
+        'current': job['current'],
+        'current_agency': job['current_agency'] or '',
+        'job_id': job['id'],
+        'status': job['status'],
+        'success_count': job['success_count'],
+        'error_count': job['error_count'],
+        'message': job['message']
+    })
+
+@app.route('/jobs/<int:job_id>')
+def get_job(job_id):
+    db_instance = DatabaseManager()
+    job = db_instance.get_send_job(job_id)
+    if not job:
+        return jsonify({'success': False, 'message': 'Trabajo no encontrado'})
+    return jsonify({
+        'success': True,
+        'job': job,
+        'errors': db_instance.get_send_job_items(job_id, status='error')
+    })
+
+def link_saved_pdfs(saved, source):
+    """
+    Registra en el índice los PDFs guardados por el almacén y, en una sola
+    transacción, vincula los que cambiaron de contenido y registra su versión
+    en pdf_store_files
+    """
+    # El índice se actualiza sin esperar al watcher
+    for result in saved:
+        pdf_index.update(result['path'], digest=result['hash'])
+
+    changed = [result for result in saved if result['changed']]
+    # Si varios archivos resuelven a la misma agencia, se vincula el elegido por el índice
+    hashes = {}
+    for code in {result['agency_code'] for result in changed}:
+        digest = pdf_index.file_hash(code)
+        if digest:
+            hashes[code] = digest
+    conflicts = pdf_index.conflicts({result['agency_code'] for result in saved})
+    stored = stored_rows(saved)
+    summary = {'matched': 0, 'pending': 0, 'conflicts': 0}
+    if hashes or conflicts or stored:
+        summary = DatabaseManager().apply_pdf_changes(list(hashes), [], source=source, hashes=hashes,
+                                                      conflicts=conflicts, stored_files=stored)
+    summary['unchanged'] = len(saved) - len(changed)
+    return summary
 
 @app.route('/upload-pdf', methods=['POST'])
 def upload_pdf():
@@ -112,8 +338,10 @@ def upload_pdf():
             return jsonify({'success': False, 'message': 'No se seleccionó archivo'})
         
         if file and file.filename.endswith('.pdf'):
-            filename = file.filename
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            filename = os.path.basename(file.filename)
+            summary = link_saved_pdfs([pdf_store.save(file.stream, filename)], source='upload_pdf')
+            if summary['unchanged']:
+                return jsonify({'success': True, 'message': f'PDF {filename} sin cambios (mismo contenido)'})
             return jsonify({'success': True, 'message': f'PDF {filename} subido correctamente'})
             
         return jsonify({'success': False, 'message': 'Tipo de archivo no válido'})
@@ -122,7 +350,6 @@ def upload_pdf():
 
 @app.route('/import-excel', methods=['POST'])
 def import_excel():
-    temp_path = None
     db_instance = None
     try:
         if 'file' not in request.files:
@@ -132,20 +359,17 @@ def import_excel():
         if file.filename == '':
             return jsonify({'success': False, 'message': 'No se seleccionó archivo'})
             
-        if not file.filename.endswith('.xlsx'):
-            return jsonify({'success': False, 'message': 'El archivo debe ser un Excel (.xlsx)'})
-        
-        # Crear un nombre único para el archivo temporal
-        temp_path = f'temp_excel_{uuid.uuid4()}.xlsx'
-        
-        # Guardar el archivo temporalmente
-        file.save(temp_path)
+        if not file.filename.lower().endswith(('.xlsx', '.csv')):
+            return jsonify({'success': False, 'message': 'El archivo debe ser un Excel (.xlsx) o CSV (.csv)'})
         
-        # Crear una nueva instancia de DatabaseManager para esta operación
+        # Se lee directamente del stream de la subida, sin archivo temporal
         db_instance = DatabaseManager()
-        success, message = db_instance.import_from_excel(temp_path)
+        success, message, summary = db_instance.import_clients(file.stream, file.filename)
+        if success:
+            # Los PDFs con nombres no exactos se resuelven contra los nuevos códigos
+            refresh_agency_codes()
         
-        return jsonify({'success': success, 'message': message})
+        return jsonify({'success': success, 'message': message, 'summary': summary})
             
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
@@ -154,13 +378,21 @@ def import_excel():
         # Cerrar la conexión de la base de datos
         if db_instance:
             db_instance.close()
-            
-        # Asegurarse de eliminar el archivo temporal
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+
+@app.route('/imports/<int:import_id>/report')
+def import_report(import_id):
+    # Reporte de validación por fila; ?format=csv lo descarga como archivo
+    issues = DatabaseManager().get_import_issues(import_id)
+    if request.args.get('format') != 'csv':
+        return jsonify({'success': True, 'import_id': import_id, 'issues': issues})
+
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=['row_number', 'agency_code', 'email', 'severity', 'reason'])
+    writer.writeheader()
+    writer.writerows(issues)
+    return Response(output.getvalue(), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=importacion_{import_id}_validacion.csv'
+    })
 
 @app.route('/send-email/<client_id>')
 def send_single_email(client_id):
@@ -174,28 +406,21 @@ def send_single_email(client_id):
         template = db.get_template(template_id) if template_id else None
         
         agency_code = client['Agency Code']
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{agency_code}.pdf")
-        
-        if not os.path.exists(pdf_path):
-            error_msg = f"PDF no encontrado: {pdf_path}"
+        pdf_path = pdf_index.path(agency_code)
+
+        if pdf_path is None:
+            error_msg = f"PDF no encontrado: {agency_code}.pdf"
             return jsonify({'success': False, 'message': error_msg})
         
+        # La versión del PDF se toma antes de enviar: si el archivo cambia
+        # después, un envío exitoso no debe quedar registrado como error
+        try:
+            pdf_hash = pdf_index.file_hash(agency_code)
+        except OSError:
+            pdf_hash = None
+
         try:
             mailer.send_email(client, pdf_path, save_as_draft, template)
-            
-            # Registrar el envío exitoso
-            db.add_sent_email(
-                agency_code=client['Agency Code'],
-                email=client['Report email'],
-                status='success',
-                message='Correo enviado correctamente' if not save_as_draft else 'Guardado como borrador'
-            )
-            
-            return jsonify({
-                'success': True, 
-                'message': f"Correo {'guardado como borrador' if save_as_draft else 'enviado'} correctamente"
-            })
-            
         except Exception as e:
             error_msg = str(e)
             db.add_sent_email(
@@ -205,188 +430,127 @@ def send_single_email(client_id):
                 message=error_msg
             )
             return jsonify({'success': False, 'message': error_msg})
-            
+
+        # Registrar el envío exitoso
+        db.add_sent_email(
+            agency_code=client['Agency Code'],
+            email=client['Report email'],
+            status='success',
+            message='Correo enviado correctamente' if not save_as_draft else 'Guardado como borrador',
+            pdf_hash=pdf_hash
+        )
+
+        return jsonify({
+            'success': True,
+            'message': f"Correo {'guardado como borrador' if save_as_draft else 'enviado'} correctamente"
+        })
+
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
+    finally:
+        mailer.close()
+
+def enqueue_send_job(kind, params, pending_clients=None):
+    """Encola una campaña con los clientes indicados (por defecto, los pendientes)"""
+    if pending_clients is None:
+        pending_clients = db.get_pending_clients()
+    if not pending_clients:
+        return None, 0
+    job_id = db.create_send_job(kind, params, pending_clients)
+    db.add_log('SYSTEM', 'send_job', 'queued',
+               f'Trabajo {job_id} encolado con {len(pending_clients)} destinatarios')
+    return job_id, len(pending_clients)
 
 @app.route('/send-all-emails')
 def send_all_emails():
     try:
-        # Obtener la plantilla seleccionada
-        template_id = request.args.get('template_id')
-        template = db.get_template(template_id) if template_id else None
-        
-        # Verificar si es borrador
-        save_as_draft = request.args.get('draft', 'false').lower() == 'true'
-        
-        # Obtener todos los clientes pendientes
-        pending_clients = db.get_pending_clients()
-        if not pending_clients:
+        job_id, total = enqueue_send_job('send_all_emails', {
+            'template_id': request.args.get('template_id') or None,
+            'draft': request.args.get('draft', 'false').lower() == 'true',
+            'concurrency': int(request.args.get('concurrency', app.config['SEND_CONCURRENCY'])),
+            # Un solo correo con todos los PDFs de cada destinatario
+            'coalesce': request.args.get('coalesce', 'false').lower() == 'true'
+        })
+        if not job_id:
             return jsonify({'success': False, 'message': 'No hay correos pendientes para enviar'})
-            
-        success_count = 0
-        error_count = 0
-        error_messages = []
-        
-        # Actualizar estado global
-        global sending_status
-        sending_status['is_sending'] = True
-        sending_status['total'] = len(pending_clients)
-        sending_status['current'] = 0
-        
-        for client in pending_clients:
-            try:
-                # Convertir los nombres de campos al formato esperado por mailer.py
-                mailer_client = {
-                    'Agency Code': client['agency_code'],
-                    'Report email': client['email']
-                }
-                
-                agency_code = client['agency_code']
-                sending_status['current_agency'] = agency_code
-                sending_status['current'] += 1
-                
-                pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{agency_code}.pdf")
-                
-                if not os.path.exists(pdf_path):
-                    error_count += 1
-                    error_msg = f"PDF no encontrado para {agency_code}"
-                    error_messages.append(error_msg)
-                    db.add_sent_email(
-                        agency_code=agency_code,
-                        email=client['email'],
-                        status='error',
-                        message=error_msg
-                    )
-                    continue
-                
-                # Enviar correo con el formato correcto de cliente
-                mailer.send_email(mailer_client, pdf_path, save_as_draft, template)
-                
-                # Registrar envío exitoso
-                status = 'draft' if save_as_draft else 'success'
-                message = 'Guardado como borrador' if save_as_draft else 'Correo enviado correctamente'
-                db.add_sent_email(
-                    agency_code=agency_code,
-                    email=client['email'],
-                    status=status,
-                    message=message
-                )
-                success_count += 1
-                
-            except Exception as e:
-                error_count += 1
-                error_msg = f"Error al procesar {client['agency_code']}: {str(e)}"
-                error_messages.append(error_msg)
-                db.add_sent_email(
-                    agency_code=client['agency_code'],
-                    email=client['email'],
-                    status='error',
-                    message=error_msg
-                )
-        
-        # Actualizar estado final
-        sending_status['is_sending'] = False
-        sending_status['current_agency'] = ''
-        
-        # Preparar mensaje de respuesta
-        if success_count > 0:
-            message = f"{'Borradores guardados' if save_as_draft else 'Correos enviados'}: {success_count}"
-            if error_count > 0:
-                message += f", Errores: {error_count}"
-        else:
-            message = "No se pudo procesar ningún correo"
-        
-        if error_messages:
-            message += f"\nErrores encontrados:\n" + "\n".join(error_messages)
         
         return jsonify({
             'success': True,
-            'message': message,
-            'success_count': success_count,
-            'error_count': error_count,
-            'errors': error_messages
+            'job_id': job_id,
+            'message': f'Envío de {total} correos encolado (trabajo {job_id})'
         })
             
     except Exception as e:
-        if 'sending_status' in globals():
-            sending_status['is_sending'] = False
-            sending_status['current_agency'] = ''
         return jsonify({'success': False, 'message': f"Error en el proceso: {str(e)}"})
 
 @app.route('/send-all')
 def send_all_pending():
     try:
-        delay = float(request.args.get('delay', default='5'))
-        save_as_draft = request.args.get('draft', default='false').lower() == 'true'
-        template_id = request.args.get('template_id')
-        template = db.get_template(template_id) if template_id else None
-        
-        # Obtener todos los clientes que no tienen correo enviado
-        clients = db.get_all_clients()
-        total = len(clients)
-        
-        if total == 0:
+        # Los límites por dominio reemplazan la espera fija entre envíos
+        rate_limits = request.args.get('rate_limits') or app.config['SEND_RATE_LIMITS']
+        parse_rate_limits(rate_limits)  # Validar antes de encolar
+        job_id, total = enqueue_send_job('send_all', {
+            'template_id': request.args.get('template_id') or None,
+            'draft': request.args.get('draft', default='false').lower() == 'true',
+            'rate_limits': rate_limits,
+            'concurrency': int(request.args.get('concurrency', app.config['SEND_CONCURRENCY'])),
+            'coalesce': request.args.get('coalesce', 'false').lower() == 'true'
+        })
+        if not job_id:
             return jsonify({'success': False, 'message': 'No hay correos pendientes'})
         
-        # Inicializar estado del envío
-        sending_status['total'] = total
-        sending_status['current'] = 0
-        sending_status['current_agency'] = ''
-        sending_status['errors'] = []
-        
-        # Enviar correos
-        for i, client in enumerate(clients):
-            agency_code = client['Agency Code']
-            sending_status['current'] = i + 1
-            sending_status['current_agency'] = agency_code
-            
-            pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{agency_code}.pdf")
-            if os.path.exists(pdf_path):
-                if i > 0:  # No esperar antes del primer correo
-                    time.sleep(delay)
-                    
-                try:
-                    mailer.send_email(client, pdf_path, save_as_draft, template)
-                    if not save_as_draft:
-                        db.add_sent_email(agency_code, client['Report email'], 'success', 'Correo enviado correctamente')
-                except Exception as e:
-                    error_msg = f"Error al enviar correo a {client['Report email']}: {str(e)}"
-                    db.add_sent_email(agency_code, client['Report email'], 'error', error_msg)
-                    sending_status['errors'].append({
-                        'agency_code': agency_code,
-                        'email': client['Report email'],
-                        'error': str(e)
-                    })
-            else:
-                error_msg = f"PDF no encontrado para {agency_code}"
-                db.add_sent_email(agency_code, client['Report email'], 'error', error_msg)
-                sending_status['errors'].append({
-                    'agency_code': agency_code,
-                    'email': client['Report email'],
-                    'error': error_msg
-                })
-        
         return jsonify({
             'success': True,
-            'message': f"Proceso de envío completado. {total - len(sending_status['errors'])} correos enviados, {len(sending_status['errors'])} errores."
+            'job_id': job_id,
+            'message': f'Envío de {total} correos encolado (trabajo {job_id})'
         })
         
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
 
+@app.route('/dead-letters')
+def get_dead_letters():
+    include_resolved = request.args.get('all', 'false').lower() == 'true'
+    return jsonify({
+        'success': True,
+        'dead_letters': DatabaseManager().get_dead_letters(include_resolved)
+    })
+
+@app.route('/dead-letters/retry', methods=['POST'])
+def retry_dead_letters():
+    try:
+        # Solo se reenvía a los destinatarios que agotaron sus reintentos
+        db_instance = DatabaseManager()
+        clients = db_instance.get_dead_letter_clients()
+        job_id, total = enqueue_send_job('retry_dead_letters', {
+            'template_id': request.args.get('template_id') or None,
+            'draft': False,
+            'concurrency': int(request.args.get('concurrency', app.config['SEND_CONCURRENCY']))
+        }, clients)
+        if not job_id:
+            return jsonify({'success': False, 'message': 'No hay destinatarios pendientes de reintento'})
+        db_instance.resolve_dead_letters([client['agency_code'] for client in clients])
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'message': f'Reintento de {total} destinatarios encolado (trabajo {job_id})'
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
 @app.route('/delete-pdf/<filename>')
 def delete_pdf(filename):
     try:
         if filename.endswith('.pdf'):
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            if os.path.exists(file_path):
-                # Obtener el código de agencia del nombre del archivo
-                agency_code = filename.replace('.pdf', '')
-                
+            if pdf_index.has_file(filename):
+                # Código de agencia con el que está indexado el archivo
+                agency_code = pdf_index.agency_code(filename)
+
                 # Eliminar el archivo
-                os.remove(file_path)
-                
+                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                pdf_store.remove(file_path)
+                pdf_index.remove(file_path)
+
                 # Eliminar el registro de la base de datos
                 db.delete_client(agency_code)
                 
@@ -398,28 +562,28 @@ def delete_pdf(filename):
 @app.route('/delete-all-pdfs', methods=['POST'])
 def delete_all_pdfs():
     try:
-        # Obtener lista de PDFs
-        pdfs = [f for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.endswith('.pdf')]
-        
-        # Eliminar PDFs físicos si existen
+        # Eliminar PDFs físicos según el índice
+        pdfs = pdf_index.filenames()
         for pdf in pdfs:
             pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf)
-            os.remove(pdf_path)
+            try:
+                pdf_store.remove(pdf_path)
+            except FileNotFoundError:
+                pass
+            pdf_index.remove(pdf_path)
+        # Blobs del almacén que ya no usa ninguna agencia
+        pdf_store.prune()
         
         # Limpiar registros en la base de datos
         db_instance = DatabaseManager()
         db_instance.ensure_connection()  # Asegurar conexión
         
-        # Verificar si existe la columna has_pdf
-        db_instance.cursor.execute("PRAGMA table_info(clients)")
-        columns = [col[1] for col in db_instance.cursor.fetchall()]
-        
-        # Resetear has_pdf en clients si existe la columna
-        if 'has_pdf' in columns:
-            db_instance.cursor.execute("UPDATE clients SET has_pdf = FALSE")
+        # Resetear has_pdf en clients
+        db_instance.cursor.execute("UPDATE clients SET has_pdf = FALSE")
         
         # Limpiar tabla de PDFs pendientes
         db_instance.cursor.execute("DELETE FROM pending_pdfs")
+        db_instance.cursor.execute("DELETE FROM pdf_files")
         db_instance.conn.commit()
         
         return jsonify({
@@ -464,8 +628,7 @@ def preview_email(client_id):
             return jsonify({'success': False, 'message': 'Cliente no encontrado'})
 
         # Verificar si existe el PDF
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{client['Agency Code']}.pdf")
-        has_pdf = os.path.exists(pdf_path)
+        has_pdf = pdf_index.exists(client['Agency Code'])
 
         # Generar el cuerpo del correo
         email_body = f"""
@@ -494,13 +657,20 @@ def preview_email(client_id):
         <a href="http://www.paseotravel.us">www.paseotravel.us</a></small></p>
         """
 
+        subject = 'Formulario 1099-NEC – Comisiones Recibidas'
+        template_id = request.args.get('template_id')
+        template = db.get_template(template_id) if template_id else None
+        if template:
+            # Misma combinación de campos que en el envío
+            subject, email_body = render_email_template(template, client)
+
         preview_data = {
             'success': True,
-            'subject': 'Formulario 1099-NEC – Comisiones Recibidas',
+            'subject': subject,
             'to': client['Report email'],
             'body': email_body,
             'has_pdf': has_pdf,
-            'pdf_name': f"{client['Agency Code']}.pdf" if has_pdf else None
+            'pdf_name': pdf_index.get(client['Agency Code'])['filename'] if has_pdf else None
         }
 
         return jsonify(preview_data)
@@ -533,6 +703,10 @@ def add_template():
         if not all([name, subject, body]):
             return jsonify({'success': False, 'message': 'Todos los campos son requeridos'})
 
+        error = validate_template(subject, body)
+        if error:
+            return jsonify({'success': False, 'message': error})
+
         db = DatabaseManager()
         if db.add_template(name, subject, body):
             return jsonify({'success': True, 'message': 'Plantilla agregada correctamente'})
@@ -551,6 +725,10 @@ def update_template(template_id):
         if not all([name, subject, body]):
             return jsonify({'success': False, 'message': 'Todos los campos son requeridos'})
 
+        error = validate_template(subject, body)
+        if error:
+            return jsonify({'success': False, 'message': error})
+
         db = DatabaseManager()
         if db.update_template(template_id, name, subject, body):
             return jsonify({'success': True, 'message': 'Plantilla actualizada correctamente'})
@@ -574,39 +752,16 @@ def upload_pdfs():
         if 'pdfs' not in request.files:
             return jsonify({'success': False, 'message': 'No se encontraron archivos PDF'})
 
-        files = request.files.getlist('pdfs')
-        uploaded_count = 0
-        matched_count = 0
-        pending_count = 0
-        errors = []
+        # PDFs sueltos o dentro de .zip, copiados en streaming y con su hash;
+        # los que ya estaban con el mismo contenido no se reescriben
+        saved, errors = ingest_files(request.files.getlist('pdfs'), pdf_store)
 
-        db_instance = DatabaseManager()
-
-        for file in files:
-            if file.filename == '':
-                continue
-
-            if file and file.filename.endswith('.pdf'):
-                try:
-                    # Extraer el código de agencia del nombre del archivo
-                    agency_code = file.filename.replace('.pdf', '')
-                    
-                    # Guardar el PDF
-                    file.save(os.path.join(app.config['UPLOAD_FOLDER'], file.filename))
-                    uploaded_count += 1
-
-                    # Verificar si existe el cliente
-                    client = db_instance.get_client_by_agency_code(agency_code)
-                    
-                    if client:
-                        db_instance.update_client_pdf_status(agency_code, True)
-                        matched_count += 1
-                    else:
-                        db_instance.add_pending_pdf(agency_code)
-                        pending_count += 1
-
-                except Exception as e:
-                    errors.append(f"Error al procesar {file.filename}: {str(e)}")
+        # Vinculación de todo el lote en una sola transacción
+        summary = link_saved_pdfs(saved, source='upload_pdfs')
+        uploaded_count = len(saved) - summary['unchanged']
+        matched_count = summary['matched']
+        pending_count = summary['pending']
+        unchanged_count = summary['unchanged']
 
         # Preparar mensaje detallado
         message = f"PDFs subidos: {uploaded_count}"
@@ -614,6 +769,10 @@ def upload_pdfs():
             message += f"\nVinculados automáticamente: {matched_count}"
         if pending_count > 0:
             message += f"\nPendientes de vinculación: {pending_count}"
+        if unchanged_count > 0:
+            message += f"\nSin cambios (omitidos): {unchanged_count}"
+        if summary['conflicts'] > 0:
+            message += f"\nAgencias con varios PDFs (se usa el más reciente): {summary['conflicts']}"
         if errors:
             message += f"\nErrores: {len(errors)}"
 
@@ -624,64 +783,101 @@ def upload_pdfs():
                 'uploaded': uploaded_count,
                 'matched': matched_count,
                 'pending': pending_count,
+                'unchanged': unchanged_count,
+                'conflicts': summary['conflicts'],
                 'errors': errors
             }
         })
 
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)})
-    finally:
-        if 'db_instance' in locals():
-            db_instance.close()
 
-@app.route('/pending-pdfs')
-def get_pending_pdfs():
+@app.route('/split-pdf', methods=['POST'])
+def split_pdf():
+    temp_path = None
     try:
-        db_instance = DatabaseManager()
-        pending = db_instance.get_pending_pdfs()
-        
+        file = request.files.get('pdf')
+        if not file or file.filename == '':
+            return jsonify({'success': False, 'message': 'No se encontró el PDF combinado'})
+        if not PDFSplitter.available():
+            return jsonify({'success': False, 'message': 'Dividir PDFs combinados requiere pypdf (pip install pypdf)'})
+
+        # Mapeo página -> agencia (archivo o texto) o expresión regular sobre el texto
+        pattern = request.form.get('pattern', '').strip() or None
+        mapping_file = request.files.get('mapping')
+        if mapping_file and mapping_file.filename:
+            mapping_text = mapping_file.read().decode('utf-8-sig')
+        else:
+            mapping_text = request.form.get('mapping', '')
+        mapping = parse_page_mapping(mapping_text) if mapping_text.strip() else None
+        if (mapping is None) == (pattern is None):
+            return jsonify({'success': False, 'message': 'Indique un mapeo de páginas o una expresión regular (solo uno)'})
+
+        # Los procesos del splitter leen el PDF combinado desde disco
+        fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(file.stream, f, 1 << 20)
+
+        splitter = PDFSplitter(pdf_store, workers=app.config['SPLIT_WORKERS'])
+        saved, errors, unassigned = splitter.split(temp_path, mapping=mapping, pattern=pattern)
+
+        # Vinculación de todas las agencias en una sola transacción
+        summary = link_saved_pdfs(saved, source='split_pdf')
+        created_count = len(saved) - summary['unchanged']
+
+        message = f"PDFs generados: {created_count}"
+        if summary['matched'] > 0:
+            message += f"\nVinculados automáticamente: {summary['matched']}"
+        if summary['pending'] > 0:
+            message += f"\nPendientes de vinculación: {summary['pending']}"
+        if summary['unchanged'] > 0:
+            message += f"\nSin cambios (omitidos): {summary['unchanged']}"
+        if unassigned > 0:
+            message += f"\nPáginas sin agencia: {unassigned}"
+        if summary['conflicts'] > 0:
+            message += f"\nAgencias con varios PDFs (se usa el más reciente): {summary['conflicts']}"
+        if errors:
+            message += f"\nErrores: {len(errors)}"
+
         return jsonify({
             'success': True,
-            'pending': pending
+            'message': message,
+            'details': {
+                'uploaded': created_count,
+                'matched': summary['matched'],
+                'pending': summary['pending'],
+                'unchanged': summary['unchanged'],
+                'unassigned': unassigned,
+                'errors': errors
+            }
         })
+
     except Exception as e:
-        return jsonify({
-            'success': False,
-            'message': str(e)
-        })
+        return jsonify({'success': False, 'message': str(e)})
     finally:
-        if 'db_instance' in locals():
-            db_instance.close()
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+@app.route('/api/pdf-conflicts')
+def api_pdf_conflicts():
+    # Agencias con varios PDFs en uploads: cuál se usa y cuáles se ignoran
+    conflicts = pdf_index.conflicts()
+    return jsonify({
+        'success': True,
+        'conflicts': [{'agency_code': code, 'used': filenames[0], 'ignored': filenames[1:]}
+                      for code, filenames in sorted(conflicts.items())]
+    })
 
 def scan_existing_pdfs():
     """Escanea PDFs existentes en el directorio de uploads"""
     try:
-        db = DatabaseManager()
-        upload_folder = app.config['UPLOAD_FOLDER']
-        
-        for filename in os.listdir(upload_folder):
-            if filename.endswith('.pdf'):
-                agency_code = filename.replace('.pdf', '')
-                
-                # Verificar si ya está en la base de datos
-                client = db.get_client_by_agency_code(agency_code)
-                
-                if client:
-                    db.update_client_pdf_status(agency_code, True)
-                    db.add_log('SYSTEM', 'pdf_scan', 'success', 
-                              f'PDF {filename} vinculado durante escaneo')
-                else:
-                    # Verificar si ya está en pendientes
-                    pending_pdfs = db.get_pending_pdfs()
-                    if not any(pdf['agency_code'] == agency_code for pdf in pending_pdfs):
-                        db.add_pending_pdf(agency_code)
-                        db.add_log('SYSTEM', 'pdf_scan', 'pending', 
-                                 f'PDF {filename} agregado a pendientes durante escaneo')
+        # El escaneo vuelve a leer la carpeta completa (por si el watcher perdió eventos)
+        refresh_agency_codes()
+        # Conciliación por conjuntos: una transacción y un solo log
+        return DatabaseManager().reconcile_pdfs(pdf_index.agency_codes(), source='pdf_scan',
+                                                conflicts=pdf_index.conflicts())
     except Exception as e:
         app.logger.error(f'Error durante escaneo de PDFs: {str(e)}')
-    finally:
-        if 'db' in locals():
-            db.close()
 
 @app.route('/scan-pdfs', methods=['POST'])
 def scan_pdfs():
@@ -700,40 +896,20 @@ def scan_pdfs():
 @app.route('/match-existing', methods=['POST'])
 def match_existing():
     try:
-        db_instance = DatabaseManager()
-        db_instance.ensure_connection()  # Asegurar conexión
-        
-        # Log los PDFs encontrados
-        pdfs = [f.replace('.pdf', '') for f in os.listdir(app.config['UPLOAD_FOLDER']) if f.endswith('.pdf')]
-        print(f"PDFs encontrados: {pdfs}")  # Debug
-        
-        matched = 0
-        not_found = []
-        
-        # Primero, limpiar la tabla de PDFs pendientes
-        db_instance.cursor.execute("DELETE FROM pending_pdfs")
-        db_instance.conn.commit()
-        
-        for agency_code in pdfs:
-            client = db_instance.get_client_by_agency_code(agency_code)
-            
-            if client:
-                success = db_instance.update_client_pdf_status(agency_code, True)
-                if success:
-                    matched += 1
-                    db_instance.add_log('SYSTEM', 'match_existing', 'success', 
-                                      f'PDF vinculado para {agency_code}')
-            else:
-                not_found.append(agency_code)
-                # Agregar a pendientes solo si no existe
-                db_instance.add_pending_pdf(agency_code)
-                db_instance.add_log('SYSTEM', 'match_existing', 'warning', 
-                                  f'No se encontró cliente para PDF {agency_code}')
-        
+        # Vuelve a llenar pending_pdfs desde cero con los PDFs sin cliente
+        refresh_agency_codes()
+        summary = DatabaseManager().reconcile_pdfs(pdf_index.agency_codes(), reset_pending=True,
+                                                   source='match_existing', conflicts=pdf_index.conflicts())
+        matched = summary['matched']
+        not_found = summary['not_found']
+
         message = f'Se vincularon {matched} PDFs con clientes existentes'
         if not_found:
-            message += f'\nNo se encontraron clientes para: {", ".join(not_found)}'
-        
+            shown = ", ".join(not_found[:20])
+            if len(not_found) > 20:
+                shown += f" y {len(not_found) - 20} más"
+            message += f'\nNo se encontraron clientes para: {shown}'
+
         return jsonify({
             'success': True,
             'message': message,
@@ -742,16 +918,13 @@ def match_existing():
                 'not_found': not_found
             }
         })
-        
+
     except Exception as e:
         print(f"Error en match_existing: {str(e)}")  # Debug
         return jsonify({
             'success': False,
             'message': str(e)
         })
-    finally:
-        if 'db_instance' in locals():
-            db_instance.close()
 
 @app.route('/check-client/<agency_code>')
 def check_client(agency_code):
@@ -780,50 +953,6 @@ def check_client(agency_code):
         if 'db_instance' in locals():
             db_instance.close()
 
-@app.route('/add-has-pdf-column', methods=['POST'])
-def add_has_pdf_column():
-    try:
-        db_instance = DatabaseManager()
-        db_instance.ensure_connection()
-        
-        # Crear tabla temporal con la nueva estructura
-        db_instance.cursor.execute("""
-            CREATE TABLE clients_temp (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                "Agency Code" TEXT NOT NULL,
-                "Report email" TEXT NOT NULL,
-                email_sent INTEGER DEFAULT 0,
-                sent_date DATETIME,
-                has_pdf BOOLEAN DEFAULT FALSE
-            )
-        """)
-        
-        # Copiar datos existentes
-        db_instance.cursor.execute("""
-            INSERT INTO clients_temp (id, "Agency Code", "Report email", email_sent, sent_date)
-            SELECT id, "Agency Code", "Report email", email_sent, sent_date FROM clients
-        """)
-        
-        # Eliminar tabla original
-        db_instance.cursor.execute("DROP TABLE clients")
-        
-        # Renombrar tabla temporal
-        db_instance.cursor.execute("ALTER TABLE clients_temp RENAME TO clients")
-        
-        db_instance.conn.commit()
-        return jsonify({
-            'success': True,
-            'message': 'Columna has_pdf agregada correctamente'
-        })
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'message': str(e)
-        })
-    finally:
-        if 'db_instance' in locals():
-            db_instance.close()
-
 @app.route('/link-pdf/<agency_code>', methods=['POST'])
 def link_pdf(agency_code):
     try:
@@ -836,10 +965,8 @@ def link_pdf(agency_code):
                 'message': 'Nombre de PDF no proporcionado'
             })
             
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], pdf_name)
-        
         # Verificar si el PDF existe
-        if not os.path.exists(pdf_path):
+        if not pdf_index.has_file(pdf_name):
             return jsonify({
                 'success': False,
                 'message': f'El archivo {pdf_name} no existe en la carpeta de uploads'
@@ -875,14 +1002,31 @@ def link_pdf(agency_code):
 
 # Modificar el bloque principal
 if __name__ == '__main__':
-    # Escanear PDFs existentes al inicio
-    scan_existing_pdfs()
-    
-    # Iniciar el observador de archivos
-    observer = setup_pdf_watcher(app)
-    
+    # Con debug, el reloader de Werkzeug ejecuta este bloque en el proceso que
+    # vigila el código y en el hijo que atiende las peticiones: el watcher y el
+    # worker de campañas (con su pool de render) solo arrancan en el hijo
+    serving = os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    if serving:
+        # Escanear PDFs existentes al inicio
+        scan_existing_pdfs()
+
+        # Iniciar el observador de archivos
+        observer, pdf_handler = setup_pdf_watcher(app)
+
+        # Iniciar el worker de campañas (reanuda trabajos interrumpidos)
+        send_worker = SendJobWorker(mailer, app.config['UPLOAD_FOLDER'],
+                                    concurrency=app.config['SEND_CONCURRENCY'],
+                                    rate_limits=app.config['SEND_RATE_LIMITS'],
+                                    max_attachment_bytes=app.config['COALESCE_MAX_BYTES'],
+                                    render_workers=app.config['RENDER_WORKERS'],
+                                    pdf_index=pdf_index)
+        send_worker.start()
+
     try:
         app.run(debug=True)
     finally:
-        observer.stop()
-        observer.join()
+        if serving:
+            send_worker.stop()
+            observer.stop()
+            observer.join()
+            pdf_handler.batcher.stop()
@@ -0,0 +1,133 @@
+import os
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from email.message import MIMEPart
+from typing import Dict, Optional, Tuple
+
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class AttachmentCache:
+    """
+    Caché de adjuntos ya codificados en base64, direccionada por contenido.
+    Un mismo PDF (reintentos, borradores, reenvíos o varias agencias con el
+    mismo archivo) se lee y codifica una sola vez. Para no releer el archivo,
+    cada ruta recuerda su mtime y tamaño: si no cambiaron, se usa el hash ya
+    calculado. Las partes codificadas se guardan en memoria hasta max_bytes,
+    expulsando la menos usada (LRU); con spill_folder, lo expulsado se guarda
+    en disco y se recupera sin volver a codificar.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_BYTES, spill_folder: str = None):
+        self.max_bytes = max(0, max_bytes)
+        self.spill_folder = spill_folder
+        self._lock = threading.Lock()
+        # ruta -> (mtime_ns, tamaño, hash)
+        self._paths: Dict[str, Tuple[int, int, str]] = {}
+        # hash -> payload base64 (LRU: el más reciente al final)
+        self._parts = OrderedDict()
+        self._used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _spill_path(self, digest: str) -> Optional[str]:
+        if not self.spill_folder:
+            return None
+        return os.path.join(self.spill_folder, f"{digest}.b64")
+
+    def _store(self, digest: str, payload: str):
+        """Guarda una parte en memoria y expulsa las menos usadas si hace falta"""
+        if len(payload) > self.max_bytes:
+            self._spill(digest, payload)
+            return
+        self._parts[digest] = payload
+        self._used += len(payload)
+        while self._used > self.max_bytes:
+            old_digest, old_payload = self._parts.popitem(last=False)
+            self._used -= len(old_payload)
+            self._spill(old_digest, old_payload)
+
+    def _spill(self, digest: str, payload: str):
+        path = self._spill_path(digest)
+        if path is None or os.path.exists(path):
+            return
+        try:
+            os.makedirs(self.spill_folder, exist_ok=True)
+            # Varios procesos de render pueden compartir la carpeta
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w', encoding='ascii') as f:
+                f.write(payload)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error al guardar adjunto en disco: {str(e)}")
+
+    def _lookup(self, digest: str) -> Optional[str]:
+        payload = self._parts.get(digest)
+        if payload is not None:
+            self._parts.move_to_end(digest)
+            return payload
+        path = self._spill_path(digest)
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='ascii') as f:
+                payload = f.read()
+            self._store(digest, payload)
+            return payload
+        return None
+
+    def encoded(self, path: str) -> Tuple[str, str]:
+        """
+        Devuelve (hash, payload base64) del archivo, leyéndolo solo si cambió
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            known = self._paths.get(key)
+            if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+                payload = self._lookup(known[2])
+                if payload is not None:
+                    self.hits += 1
+                    return known[2], payload
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            self._paths[key] = (stat.st_mtime_ns, stat.st_size, digest)
+            payload = self._lookup(digest)
+            if payload is not None:
+                # Mismo contenido con otra ruta o tras tocar el archivo
+                self.hits += 1
+                return digest, payload
+            self.misses += 1
+            # Líneas de 76 caracteres, igual que el codificador de email
+            payload = base64.encodebytes(data).decode('ascii')
+            self._store(digest, payload)
+            return digest, payload
+
+    def attachment(self, path: str, filename: str = None,
+                   maintype: str = 'application', subtype: str = 'pdf') -> MIMEPart:
+        """Parte MIME lista para adjuntar, sin volver a codificar el archivo"""
+        _, payload = self.encoded(path)
+        part = MIMEPart()
+        part['Content-Type'] = f'{maintype}/{subtype}'
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment', filename=filename or os.path.basename(path))
+        part.set_payload(payload)
+        return part
+
+    def clear(self):
+        """Vacía la caché en memoria y los archivos derramados a disco"""
+        with self._lock:
+            self._paths.clear()
+            self._parts.clear()
+            self._used = 0
+            if self.spill_folder and os.path.isdir(self.spill_folder):
+                for name in os.listdir(self.spill_folder):
+                    if name.endswith('.b64'):
+                        try:
+                            os.remove(os.path.join(self.spill_folder, name))
+                        except OSError:
+                            pass
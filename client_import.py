@@ -0,0 +1,184 @@
+import io
+import csv
+import json
+import hashlib
+import warnings
+import pandas as pd
+from typing import Iterator, List, Tuple
+from openpyxl import load_workbook
+
+# Ignorar advertencias de openpyxl
+warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+
+# Columnas obligatorias del archivo de clientes
+REQUIRED_COLUMNS = ['Agency Code', 'Report email']
+
+# Filas por lote de validación y escritura (executemany)
+IMPORT_CHUNK_SIZE = 5000
+
+# Sintaxis aceptada para cada dirección (ya en minúsculas)
+EMAIL_PATTERN = (r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+                 r"@(?:[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,}")
+
+
+def clean_agency_code(value) -> str:
+    """
+    Normaliza un código de agencia leído de Excel (5008.0 -> '5008')
+    """
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        if value != value:  # NaN
+            return ''
+        if value.is_integer():
+            value = int(value)
+    value = str(value).strip()
+    # Los CSV exportados desde Excel o pandas traen '5008.0'
+    if value.endswith('.0') and value[:-2].isdigit():
+        value = value[:-2]
+    return value
+
+
+def row_hash(email: str, extra: str) -> str:
+    """Hash del contenido importado de un cliente, para detectar cambios"""
+    return hashlib.sha1(f"{email}\x1f{extra or ''}".encode('utf-8')).hexdigest()
+
+
+def file_hash(stream, block_size: int = 1 << 20) -> str:
+    """
+    Hash SHA-256 del archivo; deja el stream al inicio para leerlo después
+    """
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(block_size), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def iter_sheet_rows(stream, filename: str) -> Iterator[Tuple]:
+    """
+    Recorre las filas de un .xlsx o .csv sin cargar el archivo completo.
+    La primera fila es el encabezado.
+    Args:
+        stream: Archivo binario (p. ej. el stream de la subida)
+        filename (str): Nombre original; la extensión decide el formato
+    """
+    name = (filename or '').lower()
+    if name.endswith('.csv'):
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        try:
+            sample = text.read(4096)
+            text.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+            except csv.Error:
+                dialect = csv.excel
+            for row in csv.reader(text, dialect):
+                yield tuple(value if value != '' else None for value in row)
+        finally:
+            # No cerrar el stream de la subida junto con el wrapper
+            text.detach()
+    elif name.endswith('.xlsx'):
+        # read_only lee la hoja como flujo de filas en memoria acotada
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield row
+        finally:
+            workbook.close()
+    else:
+        raise ValueError('El archivo debe ser un Excel (.xlsx) o CSV (.csv)')
+
+
+def _join_by_row(parts, separator: str):
+    """Une las direcciones de cada fila; solo las filas con varias pasan por groupby"""
+    multiple = parts['row'].duplicated(keep=False)
+    joined = parts[multiple].groupby('row')['address'].agg(separator.join)
+    return pd.concat([parts.loc[~multiple].set_index('row')['address'], joined])
+
+
+def validate_chunk(records: List[Tuple]):
+    """
+    Normaliza y valida los correos de un lote de filas, de forma vectorizada.
+    Separa las direcciones por ';' o ',', las recorta y pasa a minúsculas,
+    quita repetidas dentro de la fila y verifica la sintaxis de cada una.
+    Args:
+        records (list): Tuplas (row_number, agency_code, email, extra)
+    Returns:
+        tuple: (rows, addresses, issues)
+            rows: (agency_code, email normalizado, extra, row_hash) de las filas válidas
+            addresses: (row_number, agency_code, dirección) de las filas válidas
+            issues: (row_number, agency_code, email, severity, reason) de las rechazadas
+    """
+    df = pd.DataFrame(records, columns=['row_number', 'agency_code', 'email', 'extra'])
+
+    # Una fila por dirección; "row" es la posición de la fila original en df
+    parts = (df['email'].fillna('').astype(str).str.lower()
+             .str.split(r'[;,]').explode().str.strip()
+             .rename('address').rename_axis('row').reset_index())
+    parts = parts[parts['address'] != ''].drop_duplicates()
+    parts['valid'] = parts['address'].str.fullmatch(EMAIL_PATTERN)
+
+    invalid = _join_by_row(parts[~parts['valid']], ', ')
+    normalized = _join_by_row(parts[parts['valid']], '; ')
+
+    df['normalized'] = normalized.reindex(df.index)
+    df['reason'] = None
+    df.loc[df['normalized'].isna(), 'reason'] = 'Sin correo'
+    df.loc[invalid.index, 'reason'] = 'Correo no válido: ' + invalid
+    df.loc[df['agency_code'] == '', 'reason'] = 'Sin Agency Code'
+
+    accepted = df[df['reason'].isna()]
+    rejected = df[df['reason'].notna()]
+    accepted_parts = parts[parts['valid'] & parts['row'].isin(accepted.index)]
+
+    rows = [(code, email, extra, row_hash(email, extra)) for code, email, extra in
+            zip(accepted['agency_code'], accepted['normalized'], accepted['extra'])]
+    addresses = list(zip(df['row_number'].to_numpy()[accepted_parts['row']].tolist(),
+                         df['agency_code'].to_numpy()[accepted_parts['row']].tolist(),
+                         accepted_parts['address'].tolist()))
+    issues = [(int(row_number), code, email, 'rejected', reason) for row_number, code, email, reason in
+              zip(rejected['row_number'], rejected['agency_code'], rejected['email'], rejected['reason'])]
+    return rows, addresses, issues
+
+
+def iter_client_chunks(stream, filename: str, chunk_size: int = IMPORT_CHUNK_SIZE):
+    """
+    Lee el archivo de clientes por lotes y valida cada lote con validate_chunk
+    Returns:
+        Lotes (rows, addresses, issues); en rows, extra es el JSON de las
+        columnas que no forman parte del esquema, o None
+    """
+    rows = iter_sheet_rows(stream, filename)
+    header = next(rows, None)
+    if header is None:
+        raise ValueError('El archivo está vacío')
+
+    header = [str(col).strip() if col is not None else '' for col in header]
+    if not all(col in header for col in REQUIRED_COLUMNS):
+        raise ValueError("El archivo debe contener las columnas 'Agency Code' y 'Report email'")
+
+    code_index = header.index('Agency Code')
+    email_index = header.index('Report email')
+    extra_columns = [(i, col) for i, col in enumerate(header)
+                     if col and col not in REQUIRED_COLUMNS]
+
+    chunk = []
+    # La fila 1 es el encabezado, igual que en Excel
+    for row_number, row in enumerate(rows, start=2):
+        if all(value is None for value in row):
+            continue
+        row = tuple(row) + (None,) * (len(header) - len(row))
+        extra = {col: row[i] for i, col in extra_columns if row[i] is not None}
+        chunk.append((
+            row_number,
+            clean_agency_code(row[code_index]),
+            str(row[email_index]).strip() if row[email_index] is not None else '',
+            json.dumps(extra, default=str, sort_keys=True) if extra else None
+        ))
+        if len(chunk) >= chunk_size:
+            yield validate_chunk(chunk)
+            chunk = []
+    if chunk:
+        yield validate_chunk(chunk)
@@ -1,35 +1,134 @@
-import pandas as pd
 import sqlite3
+import json
+import threading
+from migrations import apply_migrations, sync_delivery_state
+from client_import import iter_client_chunks, file_hash, IMPORT_CHUNK_SIZE
 from typing import List, Dict
-import warnings
 
-# Ignorar advertencias de openpyxl
-warnings.filterwarnings('ignore', category=UserWarning, module='openpyxl')
+# Tamaño máximo de página de los listados paginados
+MAX_PAGE_SIZE = 500
+
+# Conexiones persistentes: una por hilo y por archivo de base de datos
+_thread_state = threading.local()
+
+# Conexiones devueltas por hilos de corta vida (las peticiones web), listas
+# para reutilizar sin abrir otra ni repetir los PRAGMA: db_name -> conexiones
+_pool: Dict[str, List[sqlite3.Connection]] = {}
+_pool_lock = threading.Lock()
+POOL_SIZE = 8
+
+# Ajustes aplicados a cada conexión nueva
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',      # lectores y escritores no se bloquean entre sí
+    'PRAGMA synchronous = NORMAL',    # seguro con WAL y con muchos menos fsync
+    'PRAGMA busy_timeout = 30000',    # esperar en lugar de fallar con "database is locked"
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',     # ~16 MB de caché de páginas
+)
+
+
+def get_thread_connection(db_name: str) -> sqlite3.Connection:
+    """
+    Devuelve la conexión del hilo actual para db_name: la que ya tenía, una
+    del pool o, si no hay, una nueva
+    """
+    connections = getattr(_thread_state, 'connections', None)
+    if connections is None:
+        connections = _thread_state.connections = {}
+    conn = connections.get(db_name)
+    if conn is None:
+        with _pool_lock:
+            pooled = _pool.get(db_name)
+            conn = pooled.pop() if pooled else None
+        if conn is None:
+            # Puede pasar a otro hilo por el pool, pero nunca la usan dos a la vez
+            conn = sqlite3.connect(db_name, timeout=30, check_same_thread=False)
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+        connections[db_name] = conn
+    return conn
+
+
+def release_thread_connections():
+    """
+    Devuelve al pool las conexiones del hilo actual (p. ej. al terminar una
+    petición web) y cierra las que no caben
+    """
+    connections = getattr(_thread_state, 'connections', None) or {}
+    for db_name, conn in connections.items():
+        try:
+            conn.commit()
+            with _pool_lock:
+                pooled = _pool.setdefault(db_name, [])
+                if len(pooled) < POOL_SIZE:
+                    pooled.append(conn)
+                    continue
+            conn.close()
+        except Exception as e:
+            print(f"Error al liberar la conexión a la base de datos: {str(e)}")
+            try:
+                conn.close()
+            except Exception:
+                pass
+    connections.clear()
+
+
+def close_thread_connections():
+    """Cierra las conexiones del hilo actual (p. ej. al terminar un worker)"""
+    connections = getattr(_thread_state, 'connections', None) or {}
+    for conn in connections.values():
+        try:
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            print(f"Error al cerrar la base de datos: {str(e)}")
+    connections.clear()
+
 
 class DatabaseManager:
     def __init__(self, db_name: str = 'clients.db'):
         self.db_name = db_name
-        self.conn = None
-        self.cursor = None
+        # conn y cursor son propios de cada hilo: una misma instancia puede
+        # usarse desde varios hilos de Flask o del motor de envío
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        return getattr(self._local, 'conn', None)
+
+    @conn.setter
+    def conn(self, value):
+        self._local.conn = value
+
+    @property
+    def cursor(self):
+        return getattr(self._local, 'cursor', None)
+
+    @cursor.setter
+    def cursor(self, value):
+        self._local.cursor = value
 
     def connect(self):
         """Establece conexión con la base de datos"""
         try:
             if self.conn is None:
-                self.conn = sqlite3.connect(self.db_name)
+                self.conn = get_thread_connection(self.db_name)
+            if self.cursor is None:
                 self.cursor = self.conn.cursor()
         except Exception as e:
             print(f"Error al conectar a la base de datos: {str(e)}")
             raise
 
     def close(self):
-        """Cierra la conexión con la base de datos"""
+        """
+        Confirma los cambios y libera el cursor. La conexión del hilo se
+        mantiene abierta para las siguientes operaciones.
+        """
         try:
             if self.cursor:
                 self.cursor.close()
             if self.conn:
                 self.conn.commit()
-                self.conn.close()
         except Exception as e:
             print(f"Error al cerrar la base de datos: {str(e)}")
         finally:
@@ -41,123 +140,254 @@ class DatabaseManager:
         try:
             if self.conn is None or self.cursor is None:
                 self.connect()
-            # Verificar que la conexión está activa
-            self.cursor.execute("SELECT 1")
-        except (sqlite3.Error, AttributeError):
-            # Si hay algún error, intentar reconectar
-            self.close()
+        except sqlite3.Error:
+            # Si la conexión del hilo quedó inutilizable, abrir una nueva
+            close_thread_connections()
+            self.cursor = None
+            self.conn = None
             self.connect()
 
     def setup_database(self):
-        """Configura la base de datos con las tablas necesarias"""
+        """
+        Configura la base de datos aplicando las migraciones pendientes
+        (ver migrations.py)
+        """
         try:
             self.ensure_connection()
-            
-            # Tabla de clientes
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS clients (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    "Agency Code" TEXT NOT NULL,
-                    "Report email" TEXT NOT NULL,
-                    email_sent INTEGER DEFAULT 0,
-                    sent_date DATETIME,
-                    has_pdf BOOLEAN DEFAULT FALSE
-                )
+            applied = apply_migrations(self.conn)
+            if applied:
+                self.cursor.execute('''
+                    INSERT INTO activity_logs (agency_code, action, status, message)
+                    VALUES ('SYSTEM', 'migrate', 'success', ?)
+                ''', (f'Migraciones aplicadas: {", ".join(map(str, applied))}',))
+                self.conn.commit()
+        except Exception as e:
+            print(f"Error en setup_database: {str(e)}")
+            raise
+
+    def import_from_excel(self, excel_path: str):
+        """
+        Importa datos desde un archivo Excel o CSV a SQLite
+        Args:
+            excel_path (str): Ruta al archivo
+        """
+        with open(excel_path, 'rb') as stream:
+            success, message, _ = self.import_clients(stream, excel_path)
+        return success, message
+
+    def get_last_import(self):
+        """Obtiene la última importación de clientes registrada"""
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                SELECT id, filename, file_hash, total, added, changed, removed, unchanged, imported_at
+                FROM client_imports
+                ORDER BY id DESC
+                LIMIT 1
             ''')
+            row = self.cursor.fetchone()
+            if not row:
+                return None
+            return dict(zip(['id', 'filename', 'file_hash', 'total', 'added', 'changed',
+                             'removed', 'unchanged', 'imported_at'], row))
+        finally:
+            self.close()
 
-            # Tabla de logs
+    def get_import_issues(self, import_id: int):
+        """
+        Obtiene el reporte de validación de una importación
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                SELECT row_number, agency_code, email, severity, reason
+                FROM client_import_issues
+                WHERE import_id = ?
+                ORDER BY row_number, id
+            ''', (import_id,))
+            return [{
+                'row_number': row[0],
+                'agency_code': row[1],
+                'email': row[2],
+                'severity': row[3],
+                'reason': row[4]
+            } for row in self.cursor.fetchall()]
+        finally:
+            self.close()
+
+    def import_clients(self, stream, filename: str, chunk_size: int = IMPORT_CHUNK_SIZE):
+        """
+        Importa clientes desde un .xlsx o .csv leído como flujo, por lotes.
+        Las filas se comparan por hash con las ya guardadas: solo se escriben
+        los clientes nuevos o modificados (se conservan el estado de envío y
+        el vínculo con su PDF) y se eliminan los que ya no están en el archivo.
+        Si el archivo es idéntico a la última importación no se procesa.
+        Los correos se normalizan y validan (client_import.validate_chunk); las
+        filas rechazadas no se aplican y, junto con las advertencias, quedan en
+        client_import_issues.
+        Args:
+            stream: Archivo binario con seek, p. ej. request.files['file'].stream
+            filename (str): Nombre original del archivo (.xlsx o .csv)
+        Returns:
+            tuple: (éxito, mensaje, resumen con added/changed/removed/unchanged)
+        """
+        summary = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0,
+                   'rejected': 0, 'warnings': 0, 'skipped': False, 'import_id': None}
+        try:
+            digest = file_hash(stream)
+            last = self.get_last_import()
+
+            self.ensure_connection()
+            self.cursor.execute('SELECT COUNT(*) FROM clients')
+            client_count = self.cursor.fetchone()[0]
+            if last and last['file_hash'] == digest and last['total'] == client_count:
+                summary.update({'unchanged': client_count, 'skipped': True})
+                message = "El archivo es idéntico a la última importación; no hay cambios"
+                self.add_log('SYSTEM', 'import_excel', 'success', f'{message} ({filename})')
+                return True, message, summary
+
+            # Una sola transacción: si el archivo falla a mitad, no cambia nada
+            self.ensure_connection()
+            self.conn.commit()
+            self.cursor.execute('BEGIN IMMEDIATE')
+            self.cursor.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS import_rows (
+                    code TEXT PRIMARY KEY,
+                    email TEXT,
+                    extra TEXT,
+                    row_hash TEXT
+                )
+            ''')
+            self.cursor.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS import_addresses (
+                    row_number INTEGER,
+                    code TEXT,
+                    address TEXT
+                )
+            ''')
             self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS activity_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                CREATE TEMP TABLE IF NOT EXISTS import_issues (
+                    row_number INTEGER,
                     agency_code TEXT,
-                    action TEXT,
-                    status TEXT,
-                    message TEXT
+                    email TEXT,
+                    severity TEXT,
+                    reason TEXT
                 )
             ''')
+            for table in ('import_rows', 'import_addresses', 'import_issues'):
+                self.cursor.execute(f'DELETE FROM temp.{table}')
+
+            for rows, addresses, issues in iter_client_chunks(stream, filename, chunk_size):
+                # Si un código se repite en el archivo, gana la última fila
+                self.cursor.executemany('''
+                    INSERT OR REPLACE INTO temp.import_rows (code, email, extra, row_hash)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+                self.cursor.executemany('''
+                    INSERT INTO temp.import_addresses (row_number, code, address) VALUES (?, ?, ?)
+                ''', addresses)
+                self.cursor.executemany('''
+                    INSERT INTO temp.import_issues (row_number, agency_code, email, severity, reason)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', issues)
 
-            # Tabla de correos enviados
+            # Direcciones usadas por más de una agencia: se aceptan, pero se reportan
             self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sent_emails (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    agency_code TEXT NOT NULL,
-                    email TEXT NOT NULL,
-                    sent_date DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    status TEXT,
-                    message TEXT
-                )
+                INSERT INTO temp.import_issues (row_number, agency_code, email, severity, reason)
+                SELECT a.row_number, a.code, a.address, 'warning',
+                       'Correo compartido con ' || d.agencies || ' agencias'
+                FROM temp.import_addresses a
+                JOIN (
+                    SELECT address, COUNT(DISTINCT code) AS agencies
+                    FROM temp.import_addresses
+                    GROUP BY address
+                    HAVING COUNT(DISTINCT code) > 1
+                ) d ON d.address = a.address
+            ''')
+            self.cursor.execute('''
+                SELECT COALESCE(SUM(severity = 'rejected'), 0), COALESCE(SUM(severity = 'warning'), 0)
+                FROM temp.import_issues
             ''')
+            rejected, warnings = self.cursor.fetchone()
 
-            # Tabla de plantillas de correo
             self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS email_templates (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT NOT NULL,
-                    subject TEXT NOT NULL,
-                    body TEXT NOT NULL,
-                    is_default INTEGER DEFAULT 0
-                )
+                SELECT
+                    COUNT(*),
+                    COALESCE(SUM(c.id IS NULL), 0),
+                    COALESCE(SUM(c.id IS NOT NULL AND c.row_hash IS NOT s.row_hash), 0)
+                FROM temp.import_rows s
+                LEFT JOIN clients c ON c."Agency Code" = s.code
             ''')
+            total, added, changed = self.cursor.fetchone()
+            if total == 0:
+                if not rejected:
+                    raise ValueError('El archivo no contiene clientes')
+                self.cursor.execute('''
+                    SELECT row_number, reason FROM temp.import_issues
+                    WHERE severity = 'rejected' ORDER BY row_number LIMIT 3
+                ''')
+                examples = '; '.join(f'fila {row}: {reason}' for row, reason in self.cursor.fetchall())
+                raise ValueError(f'Ninguna fila es válida ({rejected} rechazadas). {examples}')
 
-            # Tabla de PDFs pendientes
+            # Solo se escriben las filas nuevas o con contenido distinto
             self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS pending_pdfs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    agency_code TEXT NOT NULL,
-                    upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed BOOLEAN DEFAULT FALSE,
-                    processed_date TIMESTAMP
-                )
+                INSERT INTO clients ("Agency Code", "Report email", extra, row_hash)
+                SELECT code, email, extra, row_hash FROM temp.import_rows WHERE true
+                ON CONFLICT("Agency Code") DO UPDATE SET
+                    "Report email" = excluded."Report email",
+                    extra = excluded.extra,
+                    row_hash = excluded.row_hash
+                WHERE clients.row_hash IS NOT excluded.row_hash
             ''')
 
-            self.conn.commit()
-        except Exception as e:
-            print(f"Error en setup_database: {str(e)}")
-            raise
+            # El archivo es la lista completa: quitar los clientes que ya no aparecen.
+            # Las filas rechazadas no se aplican: esos clientes conservan sus datos
+            self.cursor.execute('''
+                DELETE FROM clients
+                WHERE "Agency Code" NOT IN (SELECT code FROM temp.import_rows)
+                  AND "Agency Code" NOT IN (
+                      SELECT agency_code FROM temp.import_issues WHERE severity = 'rejected'
+                  )
+            ''')
+            removed = self.cursor.rowcount
+            if added:
+                sync_delivery_state(self.cursor)
 
-    def import_from_excel(self, excel_path: str):
-        """
-        Importa datos desde Excel a SQLite
-        Args:
-            excel_path (str): Ruta al archivo Excel
-        """
-        try:
-            # Leer Excel primero para validar
-            df = pd.read_excel(excel_path)
-            
-            # Asegurarse de que existan las columnas necesarias
-            required_columns = ['Agency Code', 'Report email']
-            if not all(col in df.columns for col in required_columns):
-                raise ValueError("El archivo Excel debe contener las columnas 'Agency Code' y 'Report email'")
-            
-            # Agregar columnas para tracking
-            df['email_sent'] = 0
-            df['sent_date'] = None
-            
-            # Asegurar conexión y configuración de la base de datos
-            self.ensure_connection()
-            self.setup_database()
-            
-            # Importar datos
-            df.to_sql('clients', self.conn, if_exists='replace', index=True, index_label='id')
+            summary.update({'added': added, 'changed': changed, 'removed': removed,
+                            'unchanged': total - added - changed,
+                            'rejected': rejected, 'warnings': warnings})
+            self.cursor.execute('''
+                INSERT INTO client_imports (filename, file_hash, total, added, changed, removed, unchanged,
+                                            rejected, warnings)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (filename, digest, total, added, changed, removed, summary['unchanged'], rejected, warnings))
+            summary['import_id'] = self.cursor.lastrowid
+            self.cursor.execute('''
+                INSERT INTO client_import_issues (import_id, row_number, agency_code, email, severity, reason)
+                SELECT ?, row_number, agency_code, email, severity, reason
+                FROM temp.import_issues
+                ORDER BY row_number
+            ''', (summary['import_id'],))
+            for table in ('import_rows', 'import_addresses', 'import_issues'):
+                self.cursor.execute(f'DELETE FROM temp.{table}')
             self.conn.commit()
-            
-            # Agregar log
-            self.add_log('SYSTEM', 'import_excel', 'success', f'Datos importados exitosamente desde {excel_path}')
-            
-            return True, "Datos importados exitosamente"
-            
-        except pd.errors.EmptyDataError:
-            return False, "El archivo Excel está vacío"
+
+            message = (f"Datos importados exitosamente: {added} nuevos, {changed} modificados, "
+                       f"{removed} eliminados, {summary['unchanged']} sin cambios")
+            if rejected or warnings:
+                message += f". Validación: {rejected} filas rechazadas, {warnings} advertencias"
+            self.add_log('SYSTEM', 'import_excel', 'success', f'{message} ({filename})')
+            return True, message, summary
+
         except Exception as e:
+            if self.conn:
+                self.conn.rollback()
             error_msg = f"Error al importar datos: {str(e)}"
             try:
-                if self.conn and self.cursor:
-                    self.add_log('SYSTEM', 'import_excel', 'error', error_msg)
-            except:
+                self.add_log('SYSTEM', 'import_excel', 'error', error_msg)
+            except Exception:
                 pass
-            return False, error_msg
+            return False, error_msg, summary
 
     def get_pending_clients(self):
         """
@@ -167,12 +397,8 @@ class DatabaseManager:
             self.ensure_connection()
             self.cursor.execute('''
                 SELECT id, "Agency Code" as agency_code, "Report email" as email
-                FROM clients c
-                WHERE NOT EXISTS (
-                    SELECT 1 FROM sent_emails s
-                    WHERE s.agency_code = c."Agency Code"
-                    AND s.status = 'success'
-                )
+                FROM clients
+                WHERE email_sent = 0
             ''')
             return [{
                 'id': row[0],
@@ -192,7 +418,7 @@ class DatabaseManager:
         try:
             self.ensure_connection()
             self.cursor.execute('''
-                SELECT "Agency Code", "Report email"
+                SELECT "Agency Code", "Report email", extra
                 FROM clients
                 WHERE id = ?
             ''', (client_id,))
@@ -200,7 +426,8 @@ class DatabaseManager:
             if row:
                 return {
                     'Agency Code': row[0],
-                    'Report email': row[1]
+                    'Report email': row[1],
+                    'extra': row[2]
                 }
             return None
         except Exception as e:
@@ -209,6 +436,32 @@ class DatabaseManager:
         finally:
             self.close()
 
+    def get_client_extras(self, agency_codes) -> Dict[str, str]:
+        """
+        Obtiene en una sola consulta las columnas extra (JSON) de varios
+        clientes, para combinar plantillas sin consultar por destinatario
+        Returns:
+            dict: agency_code -> extra
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS merge_codes (code TEXT PRIMARY KEY)')
+            self.cursor.execute('DELETE FROM temp.merge_codes')
+            self.cursor.executemany('INSERT OR IGNORE INTO temp.merge_codes (code) VALUES (?)',
+                                    ((code,) for code in agency_codes))
+            self.cursor.execute('''
+                SELECT c."Agency Code", c.extra
+                FROM clients c
+                JOIN temp.merge_codes m ON m.code = c."Agency Code"
+                WHERE c.extra IS NOT NULL
+            ''')
+            return dict(self.cursor.fetchall())
+        except Exception as e:
+            print(f"Error al obtener campos de los clientes: {str(e)}")
+            return {}
+        finally:
+            self.close()
+
     def clear_all_records(self):
         """
         Limpia todos los registros de la base de datos
@@ -293,14 +546,18 @@ class DatabaseManager:
         """
         try:
             self.ensure_connection()
-            self.cursor.execute('SELECT id, name, subject, body, is_default FROM email_templates ORDER BY is_default DESC, name')
+            self.cursor.execute('''
+                SELECT id, name, subject, body, is_default, version
+                FROM email_templates ORDER BY is_default DESC, name
+            ''')
             templates = self.cursor.fetchall()
             return [{
                 'id': t[0],
                 'name': t[1],
                 'subject': t[2],
                 'body': t[3],
-                'is_default': t[4]
+                'is_default': t[4],
+                'version': t[5]
             } for t in templates]
         except Exception as e:
             print(f"Error al obtener plantillas: {str(e)}")
@@ -314,14 +571,16 @@ class DatabaseManager:
         """
         try:
             self.ensure_connection()
-            self.cursor.execute('SELECT id, name, subject, body FROM email_templates WHERE id = ?', (template_id,))
+            self.cursor.execute('SELECT id, name, subject, body, version FROM email_templates WHERE id = ?',
+                                (template_id,))
             t = self.cursor.fetchone()
             if t:
                 return {
                     'id': t[0],
                     'name': t[1],
                     'subject': t[2],
-                    'body': t[3]
+                    'body': t[3],
+                    'version': t[4]
                 }
             return None
         except Exception as e:
@@ -356,7 +615,7 @@ class DatabaseManager:
             self.ensure_connection()
             self.cursor.execute('''
                 UPDATE email_templates
-                SET name = ?, subject = ?, body = ?
+                SET name = ?, subject = ?, body = ?, version = version + 1
                 WHERE id = ?
             ''', (name, subject, body, template_id))
             self.conn.commit()
@@ -439,23 +698,40 @@ class DatabaseManager:
         finally:
             self.close()
 
-    def add_sent_email(self, agency_code: str, email: str, status: str, message: str):
+    def add_sent_email(self, agency_code: str, email: str, status: str, message: str, pdf_hash: str = None):
         """
-        Registra un correo enviado en la base de datos
+        Registra un correo enviado en la base de datos, con la versión (hash)
+        del PDF adjunto si se conoce
         """
         try:
             self.ensure_connection()
             self.cursor.execute('''
-                INSERT INTO sent_emails (agency_code, email, sent_date, status, message)
-                VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?)
-            ''', (agency_code, email, status, message))
+                INSERT INTO sent_emails (agency_code, email, sent_date, status, message, pdf_hash)
+                VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?)
+            ''', (agency_code, email, status, message, pdf_hash))
+            
+            # Un envío exitoso saca al cliente de pendientes y resuelve sus dead letters
+            if status == 'success':
+                self.cursor.execute('''
+                    UPDATE clients SET email_sent = 1, sent_date = CURRENT_TIMESTAMP
+                    WHERE "Agency Code" = ?
+                ''', (agency_code,))
+                self.cursor.execute('''
+                    UPDATE dead_letters SET resolved = 1
+                    WHERE agency_code = ? AND resolved = 0
+                ''', (agency_code,))
             
-            # También registrar en el log
-            self.add_log(agency_code, 'send_email', status, message)
+            # También registrar en el log, en la misma transacción
+            self.cursor.execute('''
+                INSERT INTO activity_logs (agency_code, action, status, message)
+                VALUES (?, 'send_email', ?, ?)
+            ''', (agency_code, status, message))
             
             self.conn.commit()
             return True
         except Exception as e:
+            if self.conn:
+                self.conn.rollback()
             print(f"Error al registrar correo enviado: {str(e)}")
             return False
         finally:
@@ -485,23 +761,124 @@ class DatabaseManager:
         finally:
             self.close()
 
-    def get_pending_pdfs(self):
-        """Obtiene todos los PDFs pendientes de procesamiento"""
+    def _fetch_page(self, select: str, columns: List[str], conditions: List[str], params: List,
+                    cursor=None, limit: int = 50, descending: bool = True, id_column: str = 'id') -> Dict:
+        """
+        Lee una página con paginación por cursor (keyset) sobre la columna id.
+        En lugar de OFFSET se filtra por "id < cursor" (o "id > cursor"), así que
+        el costo de cada página no depende de cuántas filas se saltaron.
+        Returns:
+            dict: {'items': [...], 'next_cursor': id de la última fila o None}
+        """
+        conditions = list(conditions)
+        params = list(params)
+        if cursor is not None:
+            conditions.append(f'{id_column} {"<" if descending else ">"} ?')
+            params.append(int(cursor))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'DESC' if descending else 'ASC'
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
         try:
             self.ensure_connection()
-            self.cursor.execute("""
-                SELECT id, agency_code, upload_date 
-                FROM pending_pdfs 
-                WHERE processed = FALSE
-            """)
-            return [{
-                'id': row[0],
-                'agency_code': row[1],
-                'upload_date': row[2]
-            } for row in self.cursor.fetchall()]
-        except Exception as e:
-            print(f"Error al obtener PDFs pendientes: {str(e)}")
-            return []
+            # Se pide una fila de más para saber si hay otra página
+            self.cursor.execute(f'{select} {where} ORDER BY {id_column} {order} LIMIT ?',
+                                params + [limit + 1])
+            rows = self.cursor.fetchall()
+            items = [dict(zip(columns, row)) for row in rows[:limit]]
+            next_cursor = items[-1]['id'] if len(rows) > limit else None
+            return {'items': items, 'next_cursor': next_cursor}
+        finally:
+            self.close()
+
+    @staticmethod
+    def _date_conditions(column: str, date_from: str = None, date_to: str = None):
+        """Condiciones de rango de fechas (YYYY-MM-DD, ambos extremos inclusive)"""
+        conditions, params = [], []
+        if date_from:
+            conditions.append(f'{column} >= ?')
+            params.append(date_from)
+        if date_to:
+            conditions.append(f"{column} < date(?, '+1 day')")
+            params.append(date_to)
+        return conditions, params
+
+    def get_logs_page(self, cursor=None, limit: int = 50, status: str = None,
+                      agency_code: str = None, date_from: str = None, date_to: str = None) -> Dict:
+        """
+        Obtiene una página del log de actividades, de la más reciente a la más antigua
+        """
+        conditions, params = self._date_conditions('timestamp', date_from, date_to)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if agency_code:
+            conditions.append('agency_code = ?')
+            params.append(agency_code)
+        return self._fetch_page('''
+            SELECT id, timestamp, agency_code, action, status, message
+            FROM activity_logs
+        ''', ['id', 'timestamp', 'agency_code', 'action', 'status', 'message'],
+            conditions, params, cursor, limit)
+
+    def get_sent_emails_page(self, cursor=None, limit: int = 50, status: str = None,
+                             agency_code: str = None, date_from: str = None, date_to: str = None) -> Dict:
+        """
+        Obtiene una página de correos enviados, del más reciente al más antiguo
+        """
+        conditions, params = self._date_conditions('sent_date', date_from, date_to)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if agency_code:
+            conditions.append('agency_code = ?')
+            params.append(agency_code)
+        return self._fetch_page('''
+            SELECT id, agency_code, email, sent_date, status, message
+            FROM sent_emails
+        ''', ['id', 'agency_code', 'email', 'sent_date', 'status', 'message'],
+            conditions, params, cursor, limit)
+
+    def get_pending_clients_page(self, cursor=None, limit: int = 50, has_pdf: bool = None,
+                                 agency_code: str = None) -> Dict:
+        """
+        Obtiene una página de clientes que aún no han recibido el correo
+        """
+        conditions, params = ['email_sent = 0'], []
+        if has_pdf is not None:
+            conditions.append('COALESCE(has_pdf, 0) = ?')
+            params.append(1 if has_pdf else 0)
+        if agency_code:
+            conditions.append('"Agency Code" = ?')
+            params.append(agency_code)
+        page = self._fetch_page('''
+            SELECT id, "Agency Code", "Report email", has_pdf
+            FROM clients
+        ''', ['id', 'agency_code', 'email', 'has_pdf'],
+            conditions, params, cursor, limit, descending=False)
+        for item in page['items']:
+            item['has_pdf'] = bool(item['has_pdf'])
+        return page
+
+    def get_pending_pdfs_page(self, cursor=None, limit: int = 50, processed: bool = None,
+                              agency_code: str = None, date_from: str = None, date_to: str = None) -> Dict:
+        """
+        Obtiene una página de PDFs sin cliente, en orden de llegada
+        """
+        conditions, params = self._date_conditions('upload_date', date_from, date_to)
+        if processed is not None:
+            conditions.append('processed = ?')
+            params.append(1 if processed else 0)
+        if agency_code:
+            conditions.append('agency_code = ?')
+            params.append(agency_code)
+        page = self._fetch_page('''
+            SELECT id, agency_code, upload_date, processed, processed_date
+            FROM pending_pdfs
+        ''', ['id', 'agency_code', 'upload_date', 'processed', 'processed_date'],
+            conditions, params, cursor, limit, descending=False)
+        for item in page['items']:
+            item['processed'] = bool(item['processed'])
+        return page
 
     def add_pending_pdf(self, agency_code):
         """Agrega un nuevo PDF pendiente"""
@@ -521,6 +898,246 @@ class DatabaseManager:
             self.add_log('DATABASE', 'add_pending_pdf', 'error', str(e))
             return False
 
+    def _log_pdf_conflicts(self, conflicts: Dict[str, List[str]], source: str):
+        """
+        Registra (dentro de la transacción en curso) las agencias con más de un
+        PDF; el primer archivo de cada lista es el que se usa
+        """
+        self.cursor.executemany('''
+            INSERT INTO activity_logs (agency_code, action, status, message)
+            VALUES (?, ?, 'warning', ?)
+        ''', [(agency_code, source, f"Varios PDFs para {agency_code}: se usa {filenames[0]}; "
+                                    f"se ignoran {', '.join(filenames[1:])}")
+              for agency_code, filenames in (conflicts or {}).items()])
+
+    def reconcile_pdfs(self, agency_codes, reset_pending: bool = False, source: str = 'pdf_scan',
+                       conflicts: Dict[str, List[str]] = None) -> Dict:
+        """
+        Concilia en una sola transacción los PDFs de uploads con los clientes:
+        carga los códigos en una tabla temporal y, con joins, marca has_pdf,
+        agrega a pending_pdfs los PDFs sin cliente y escribe un único log
+        Args:
+            agency_codes: Códigos de agencia de los PDFs presentes en la carpeta
+            reset_pending (bool): Vaciar pending_pdfs antes de volver a llenarla
+            source (str): Acción con la que se registra el log
+            conflicts (dict): Agencias con varios PDFs (PDFIndex.conflicts), se registran como advertencia
+        Returns:
+            dict: total, matched, pending, not_found (códigos sin cliente) y conflicts
+        """
+        summary = {'total': 0, 'matched': 0, 'pending': 0, 'not_found': [], 'conflicts': len(conflicts or {})}
+        try:
+            self.ensure_connection()
+            self.cursor.execute('CREATE TEMP TABLE IF NOT EXISTS folder_pdfs (code TEXT PRIMARY KEY)')
+            self.cursor.execute('BEGIN IMMEDIATE')
+            self.cursor.execute('DELETE FROM temp.folder_pdfs')
+            self.cursor.executemany('INSERT OR IGNORE INTO temp.folder_pdfs (code) VALUES (?)',
+                                    ((code,) for code in agency_codes))
+
+            # has_pdf refleja la carpeta; solo se escriben las filas que cambian
+            self.cursor.execute('''
+                UPDATE clients
+                SET has_pdf = "Agency Code" IN (SELECT code FROM temp.folder_pdfs)
+                WHERE has_pdf IS NOT ("Agency Code" IN (SELECT code FROM temp.folder_pdfs))
+            ''')
+            self.cursor.execute('''
+                SELECT COUNT(*), COUNT(c."Agency Code")
+                FROM temp.folder_pdfs f
+                LEFT JOIN clients c ON c."Agency Code" = f.code
+            ''')
+            summary['total'], summary['matched'] = self.cursor.fetchone()
+            self.cursor.execute('''
+                SELECT f.code FROM temp.folder_pdfs f
+                WHERE NOT EXISTS (SELECT 1 FROM clients c WHERE c."Agency Code" = f.code)
+                ORDER BY f.code
+            ''')
+            summary['not_found'] = [row[0] for row in self.cursor.fetchall()]
+            summary['pending'] = len(summary['not_found'])
+
+            if reset_pending:
+                self.cursor.execute('DELETE FROM pending_pdfs')
+            self.cursor.execute('''
+                INSERT INTO pending_pdfs (agency_code, upload_date)
+                SELECT f.code, CURRENT_TIMESTAMP
+                FROM temp.folder_pdfs f
+                WHERE NOT EXISTS (SELECT 1 FROM clients c WHERE c."Agency Code" = f.code)
+                  AND NOT EXISTS (SELECT 1 FROM pending_pdfs p
+                                  WHERE p.agency_code = f.code AND p.processed = FALSE)
+                ORDER BY f.code
+            ''')
+
+            self.cursor.execute('''
+                INSERT INTO activity_logs (agency_code, action, status, message)
+                VALUES ('SYSTEM', ?, 'success', ?)
+            ''', (source, f"PDFs conciliados: {summary['total']} en la carpeta, "
+                          f"{summary['matched']} vinculados, {summary['pending']} sin cliente"))
+            self._log_pdf_conflicts(conflicts, source)
+            self.cursor.execute('DELETE FROM temp.folder_pdfs')
+            self.conn.commit()
+            return summary
+        except Exception as e:
+            if self.conn:
+                self.conn.rollback()
+            print(f"Error al conciliar PDFs: {str(e)}")
+            raise
+        finally:
+            self.close()
+
+    def apply_pdf_changes(self, added, removed, source: str = 'auto_pdf_import',
+                          hashes: Dict[str, str] = None, conflicts: Dict[str, List[str]] = None,
+                          stored_files=None) -> Dict:
+        """
+        Aplica en una sola transacción un lote de cambios de la carpeta de
+        uploads: vincula los PDFs nuevos con su cliente (o los deja pendientes),
+        desvincula los borrados y escribe un único log
+        Args:
+            added: Códigos de agencia de los PDFs creados o modificados
+            removed: Códigos de agencia de los PDFs borrados
+            hashes (dict): Hash del contenido de los PDFs agregados, para pdf_files
+            conflicts (dict): Agencias del lote con varios PDFs, se registran como advertencia
+            stored_files: Filas (archivo, hash, tamaño, mtime) para pdf_store_files
+                          (ver pdf_store.stored_rows)
+        Returns:
+            dict: added, matched, pending y removed
+        """
+        summary = {'added': 0, 'matched': 0, 'pending': 0, 'removed': 0, 'conflicts': len(conflicts or {})}
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                CREATE TEMP TABLE IF NOT EXISTS batch_pdfs (code TEXT PRIMARY KEY, present INTEGER)
+            ''')
+            self.cursor.execute('BEGIN IMMEDIATE')
+            self.cursor.execute('DELETE FROM temp.batch_pdfs')
+            # Si un código aparece en ambos, gana el PDF presente
+            self.cursor.executemany('INSERT OR REPLACE INTO temp.batch_pdfs (code, present) VALUES (?, 0)',
+                                    ((code,) for code in removed))
+            self.cursor.executemany('INSERT OR REPLACE INTO temp.batch_pdfs (code, present) VALUES (?, 1)',
+                                    ((code,) for code in added))
+
+            self.cursor.execute('''
+                UPDATE clients
+                SET has_pdf = (SELECT b.present FROM temp.batch_pdfs b WHERE b.code = clients."Agency Code")
+                WHERE "Agency Code" IN (SELECT code FROM temp.batch_pdfs)
+            ''')
+            self.cursor.execute('''
+                SELECT COALESCE(SUM(b.present), 0),
+                       COALESCE(SUM(b.present AND c."Agency Code" IS NOT NULL), 0),
+                       COALESCE(SUM(NOT b.present), 0)
+                FROM temp.batch_pdfs b
+                LEFT JOIN clients c ON c."Agency Code" = b.code
+            ''')
+            summary['added'], summary['matched'], summary['removed'] = self.cursor.fetchone()
+            summary['pending'] = summary['added'] - summary['matched']
+
+            # Los PDFs sin cliente quedan pendientes (una sola vez); los borrados dejan de estarlo
+            self.cursor.execute('''
+                INSERT INTO pending_pdfs (agency_code, upload_date)
+                SELECT b.code, CURRENT_TIMESTAMP
+                FROM temp.batch_pdfs b
+                WHERE b.present = 1
+                  AND NOT EXISTS (SELECT 1 FROM clients c WHERE c."Agency Code" = b.code)
+                  AND NOT EXISTS (SELECT 1 FROM pending_pdfs p
+                                  WHERE p.agency_code = b.code AND p.processed = FALSE)
+            ''')
+            self.cursor.execute('''
+                DELETE FROM pending_pdfs
+                WHERE processed = FALSE
+                  AND agency_code IN (SELECT code FROM temp.batch_pdfs WHERE present = 0)
+            ''')
+
+            # Versión vigente de cada PDF
+            self.cursor.executemany('''
+                INSERT INTO pdf_files (agency_code, hash, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(agency_code) DO UPDATE SET hash = excluded.hash, updated_at = excluded.updated_at
+            ''', (hashes or {}).items())
+            self.cursor.execute('''
+                DELETE FROM pdf_files
+                WHERE agency_code IN (SELECT code FROM temp.batch_pdfs WHERE present = 0)
+            ''')
+
+            # Versión registrada de cada archivo del almacén
+            self.cursor.executemany('''
+                INSERT INTO pdf_store_files (filename, hash, size, mtime, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(filename) DO UPDATE SET
+                    hash = excluded.hash, size = excluded.size,
+                    mtime = excluded.mtime, updated_at = excluded.updated_at
+            ''', stored_files or [])
+
+            # Un lote que solo registra archivos del almacén no deja log
+            if added or removed:
+                self.cursor.execute('''
+                    INSERT INTO activity_logs (agency_code, action, status, message)
+                    VALUES ('SYSTEM', ?, 'success', ?)
+                ''', (source, f"Lote de PDFs: {summary['added']} nuevos o modificados "
+                              f"({summary['matched']} vinculados, {summary['pending']} pendientes), "
+                              f"{summary['removed']} eliminados"))
+            self._log_pdf_conflicts(conflicts, source)
+            self.cursor.execute('DELETE FROM temp.batch_pdfs')
+            self.conn.commit()
+            return summary
+        except Exception as e:
+            if self.conn:
+                self.conn.rollback()
+            print(f"Error al aplicar cambios de PDFs: {str(e)}")
+            raise
+        finally:
+            self.close()
+
+    def get_pdf_hashes(self, agency_codes) -> Dict[str, str]:
+        """
+        Obtiene la versión registrada (hash) del PDF de varias agencias
+        Returns:
+            dict: agency_code -> hash
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                SELECT agency_code, hash FROM pdf_files
+                WHERE agency_code IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(agency_codes)),))
+            return dict(self.cursor.fetchall())
+        except Exception as e:
+            print(f"Error al obtener versiones de PDF: {str(e)}")
+            return {}
+        finally:
+            self.close()
+
+    def get_stored_pdfs(self, filenames) -> Dict[str, Dict]:
+        """
+        Obtiene el registro de pdf_store_files de varios archivos de uploads
+        Returns:
+            dict: archivo -> hash, size y mtime con que se registró
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                SELECT filename, hash, size, mtime FROM pdf_store_files
+                WHERE filename IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(filenames)),))
+            return {row[0]: dict(zip(['hash', 'size', 'mtime'], row[1:])) for row in self.cursor.fetchall()}
+        finally:
+            self.close()
+
+    def sync_stored_pdfs(self, filenames):
+        """
+        Quita los registros de archivos que ya no están en uploads
+        Args:
+            filenames: Archivos presentes en la carpeta
+        Returns:
+            set: Hashes de los blobs que siguen en uso
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                DELETE FROM pdf_store_files
+                WHERE filename NOT IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(filenames)),))
+            self.cursor.execute('SELECT DISTINCT hash FROM pdf_store_files')
+            return {row[0] for row in self.cursor.fetchall()}
+        finally:
+            self.close()
+
     def mark_pdf_as_processed(self, agency_code):
         """Marca un PDF como procesado"""
         try:
@@ -540,6 +1157,18 @@ class DatabaseManager:
             self.add_log('DATABASE', 'mark_pdf_as_processed', 'error', str(e))
             return False
 
+    def get_agency_codes(self) -> List[str]:
+        """Códigos de agencia de todos los clientes (índice del AgencyMatcher)"""
+        try:
+            self.ensure_connection()
+            self.cursor.execute('SELECT "Agency Code" FROM clients')
+            return [row[0] for row in self.cursor.fetchall()]
+        except Exception as e:
+            print(f"Error al obtener códigos de agencia: {str(e)}")
+            return []
+        finally:
+            self.close()
+
     def get_client_by_agency_code(self, agency_code):
         """Obtiene un cliente por su código de agencia"""
         try:
@@ -598,3 +1227,383 @@ class DatabaseManager:
             print(f"Error en update_client_pdf_status: {str(e)}")  # Debug
             self.add_log('DATABASE', 'update_pdf_status', 'error', str(e))
             return False
+
+    def create_send_job(self, kind: str, params: Dict, clients: List[Dict]):
+        """
+        Encola un trabajo de envío con sus destinatarios
+        Args:
+            kind (str): Tipo de campaña ('send_all_emails' o 'send_all')
+            params (dict): Parámetros de la campaña (plantilla, borrador, etc.)
+            clients (list): Clientes pendientes con 'agency_code' y 'email'
+        Returns:
+            int: ID del trabajo creado
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                INSERT INTO send_jobs (kind, params, status, total)
+                VALUES (?, ?, 'queued', ?)
+            ''', (kind, json.dumps(params), len(clients)))
+            job_id = self.cursor.lastrowid
+            self.cursor.executemany('''
+                INSERT INTO send_job_items (job_id, agency_code, email)
+                VALUES (?, ?, ?)
+            ''', [(job_id, c['agency_code'], c['email']) for c in clients])
+            self.conn.commit()
+            return job_id
+        finally:
+            self.close()
+
+    def claim_send_job(self, worker_id: str, stale_seconds: int = 60):
+        """
+        Reclama de forma atómica el siguiente trabajo en cola, o uno en curso
+        cuyo worker dejó de reportar actividad (caída o reinicio)
+        Returns:
+            dict: Trabajo reclamado o None si no hay trabajo
+        """
+        try:
+            self.ensure_connection()
+            # BEGIN IMMEDIATE evita que dos workers reclamen el mismo trabajo
+            self.conn.commit()
+            self.cursor.execute('BEGIN IMMEDIATE')
+            self.cursor.execute('''
+                SELECT id FROM send_jobs
+                WHERE status = 'queued'
+                   OR (status = 'running' AND heartbeat < datetime('now', ?))
+                ORDER BY id
+                LIMIT 1
+            ''', (f'-{int(stale_seconds)} seconds',))
+            row = self.cursor.fetchone()
+            if not row:
+                self.conn.commit()
+                return None
+            self.cursor.execute('''
+                UPDATE send_jobs
+                SET status = 'running',
+                    worker_id = ?,
+                    started_at = COALESCE(started_at, CURRENT_TIMESTAMP),
+                    heartbeat = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (worker_id, row[0]))
+            self.conn.commit()
+            return self._get_send_job(row[0])
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.close()
+
+    def _get_send_job(self, job_id):
+        self.cursor.execute('''
+            SELECT id, kind, params, status, total, current, success_count,
+                   error_count, current_agency, worker_id, message,
+                   created_at, started_at, heartbeat, finished_at
+            FROM send_jobs WHERE id = ?
+        ''', (job_id,))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        return {
+            'id': row[0],
+            'kind': row[1],
+            'params': json.loads(row[2]) if row[2] else {},
+            'status': row[3],
+            'total': row[4],
+            'current': row[5],
+            'success_count': row[6],
+            'error_count': row[7],
+            'current_agency': row[8],
+            'worker_id': row[9],
+            'message': row[10],
+            'created_at': row[11],
+            'started_at': row[12],
+            'heartbeat': row[13],
+            'finished_at': row[14]
+        }
+
+    def get_send_job(self, job_id=None):
+        """
+        Obtiene un trabajo de envío por ID, o el más reciente si no se indica
+        """
+        try:
+            self.ensure_connection()
+            if job_id is None:
+                self.cursor.execute('SELECT MAX(id) FROM send_jobs')
+                job_id = self.cursor.fetchone()[0]
+                if job_id is None:
+                    return None
+            return self._get_send_job(job_id)
+        except Exception as e:
+            print(f"Error al obtener trabajo de envío: {str(e)}")
+            return None
+        finally:
+            self.close()
+
+    def get_send_job_items(self, job_id, status: str = None):
+        """
+        Obtiene los destinatarios de un trabajo, opcionalmente filtrados por estado
+        """
+        try:
+            self.ensure_connection()
+            query = '''
+                SELECT id, agency_code, email, status, message, updated_at
+                FROM send_job_items
+                WHERE job_id = ?
+            '''
+            params = [job_id]
+            if status:
+                query += ' AND status = ?'
+                params.append(status)
+            self.cursor.execute(query + ' ORDER BY id', params)
+            return [{
+                'item_id': row[0],
+                'agency_code': row[1],
+                'email': row[2],
+                'status': row[3],
+                'message': row[4],
+                'updated_at': row[5]
+            } for row in self.cursor.fetchall()]
+        except Exception as e:
+            print(f"Error al obtener destinatarios del trabajo: {str(e)}")
+            return []
+        finally:
+            self.close()
+
+    def touch_send_job(self, job_id):
+        """Actualiza el heartbeat de un trabajo en curso"""
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                UPDATE send_jobs SET heartbeat = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running'
+            ''', (job_id,))
+            self.conn.commit()
+        finally:
+            self.close()
+
+    def finish_send_job(self, job_id, status: str, message: str = None):
+        """
+        Marca un trabajo como terminado ('completed' o 'failed')
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                UPDATE send_jobs
+                SET status = ?, message = ?, current_agency = NULL,
+                    finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, message, job_id))
+            self.conn.commit()
+        finally:
+            self.close()
+
+    def get_dead_letters(self, include_resolved: bool = False):
+        """
+        Obtiene los destinatarios en dead letter (por defecto solo los no resueltos)
+        """
+        try:
+            self.ensure_connection()
+            query = '''
+                SELECT id, agency_code, email, attempts, last_error, job_id, created_at, resolved
+                FROM dead_letters
+            '''
+            if not include_resolved:
+                query += ' WHERE resolved = 0'
+            self.cursor.execute(query + ' ORDER BY id DESC')
+            return [{
+                'id': row[0],
+                'agency_code': row[1],
+                'email': row[2],
+                'attempts': row[3],
+                'last_error': row[4],
+                'job_id': row[5],
+                'created_at': row[6],
+                'resolved': row[7]
+            } for row in self.cursor.fetchall()]
+        except Exception as e:
+            print(f"Error al obtener dead letters: {str(e)}")
+            return []
+        finally:
+            self.close()
+
+    def get_dead_letter_clients(self):
+        """
+        Obtiene los clientes con dead letters sin resolver, uno por código de
+        agencia, con su correo actual
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.execute('''
+                SELECT c.id, c."Agency Code", c."Report email"
+                FROM clients c
+                WHERE c."Agency Code" IN (
+                    SELECT agency_code FROM dead_letters WHERE resolved = 0
+                )
+            ''')
+            return [{
+                'id': row[0],
+                'agency_code': row[1],
+                'email': row[2]
+            } for row in self.cursor.fetchall()]
+        except Exception as e:
+            print(f"Error al obtener clientes con dead letters: {str(e)}")
+            return []
+        finally:
+            self.close()
+
+    def resolve_dead_letters(self, agency_codes: List[str]):
+        """
+        Marca como resueltos los dead letters de los códigos indicados
+        (p. ej. al reencolarlos)
+        """
+        try:
+            self.ensure_connection()
+            self.cursor.executemany('''
+                UPDATE dead_letters SET resolved = 1
+                WHERE agency_code = ? AND resolved = 0
+            ''', [(code,) for code in agency_codes])
+            self.conn.commit()
+            return True
+        except Exception as e:
+            print(f"Error al resolver dead letters: {str(e)}")
+            return False
+        finally:
+            self.close()
+
+
+class BatchWriter:
+    """
+    Escritura agrupada de resultados de envío.
+    Cada envío (fila de sent_emails, su log y, si corresponde, el progreso del
+    trabajo y el dead letter) se agrega al búfer como una unidad; el búfer se
+    vuelca con executemany en una sola transacción al llegar a max_batch
+    registros o a los max_delay segundos. Un registro nunca queda repartido
+    entre dos transacciones.
+    """
+
+    def __init__(self, db_name: str = 'clients.db', max_batch: int = 200, max_delay: float = 1.0):
+        self.db_name = db_name
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self._records = []
+        self._logs = []
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='batch-writer', daemon=True)
+        self._thread.start()
+
+    def record_send(self, agency_code: str, email: str, status: str, message: str,
+                    job_id=None, item_id=None, attempts: int = None, pdf_hash: str = None):
+        """
+        Agrega el resultado de un envío
+        Args:
+            job_id, item_id: Trabajo y destinatario de send_job_items a actualizar
+            attempts (int): Solo para un error reintentable que agotó sus
+                            intentos: el destinatario pasa a dead_letters
+                            con ese número de intentos
+            pdf_hash (str): Versión del PDF adjunto
+        """
+        with self._condition:
+            self._records.append((agency_code, email, status, message, job_id, item_id, attempts, pdf_hash))
+            if len(self._records) + len(self._logs) >= self.max_batch:
+                self._condition.notify()
+
+    def add_log(self, agency_code: str, action: str, status: str, message: str = None):
+        """Agrega un registro de log al búfer"""
+        with self._condition:
+            self._logs.append((agency_code, action, status, message))
+            if len(self._records) + len(self._logs) >= self.max_batch:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed and len(self._records) + len(self._logs) < self.max_batch:
+                    self._condition.wait(self.max_delay)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                # El error ya se informó; los registros se reintentan en el siguiente ciclo
+                pass
+            if closed:
+                return
+
+    def flush(self):
+        """Vuelca el búfer en una sola transacción"""
+        with self._flush_lock:
+            with self._lock:
+                records, self._records = self._records, []
+                logs, self._logs = self._logs, []
+            if not records and not logs:
+                return
+
+            conn = get_thread_connection(self.db_name)
+            try:
+                conn.commit()
+                cursor = conn.cursor()
+                cursor.executemany('''
+                    INSERT INTO sent_emails (agency_code, email, sent_date, status, message, pdf_hash)
+                    VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?)
+                ''', [r[:4] + (r[7],) for r in records])
+                cursor.executemany('''
+                    INSERT INTO activity_logs (agency_code, action, status, message)
+                    VALUES (?, ?, ?, ?)
+                ''', [(r[0], 'send_email', r[2], r[3]) for r in records] + logs)
+                delivered = [(r[0],) for r in records if r[2] == 'success']
+                cursor.executemany('''
+                    UPDATE clients SET email_sent = 1, sent_date = CURRENT_TIMESTAMP
+                    WHERE "Agency Code" = ?
+                ''', delivered)
+                cursor.executemany('''
+                    UPDATE dead_letters SET resolved = 1
+                    WHERE agency_code = ? AND resolved = 0
+                ''', delivered)
+                cursor.executemany('''
+                    INSERT INTO dead_letters (agency_code, email, attempts, last_error, job_id)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(r[0], r[1], r[6], r[3], r[4]) for r in records
+                      if r[2] == 'error' and r[6] is not None])
+
+                # Progreso de trabajos: un UPDATE por destinatario y uno por trabajo
+                job_records = [r for r in records if r[4] is not None and r[5] is not None]
+                cursor.executemany('''
+                    UPDATE send_job_items
+                    SET status = ?, message = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(r[2], r[3], r[5]) for r in job_records])
+                progress = {}
+                for r in job_records:
+                    current, success, error, _ = progress.get(r[4], (0, 0, 0, None))
+                    failed = r[2] == 'error'
+                    progress[r[4]] = (current + 1, success + (not failed), error + failed, r[0])
+                cursor.executemany('''
+                    UPDATE send_jobs
+                    SET current = current + ?,
+                        success_count = success_count + ?,
+                        error_count = error_count + ?,
+                        current_agency = ?,
+                        heartbeat = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [values + (job_id,) for job_id, values in progress.items()])
+                conn.commit()
+                cursor.close()
+            except Exception as e:
+                conn.rollback()
+                print(f"Error al volcar registros de envío ({len(records)} envíos, {len(logs)} logs): {str(e)}")
+                # Devolver los registros al búfer para el siguiente intento
+                with self._lock:
+                    self._records[:0] = records
+                    self._logs[:0] = logs
+                raise
+
+    def close(self):
+        """Vuelca lo pendiente y detiene el hilo de escritura"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
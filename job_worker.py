@@ -0,0 +1,142 @@
+import os
+import socket
+import threading
+from typing import Dict
+from concurrent.futures.process import BrokenProcessPool
+from database import DatabaseManager
+from send_engine import SendEngine, DEFAULT_MAX_ATTACHMENT_BYTES, create_render_executor
+from rate_limiter import DomainRateLimiter
+
+
+class SendJobWorker(threading.Thread):
+    """
+    Worker en segundo plano que reclama trabajos de la tabla send_jobs y los
+    ejecuta con SendEngine. El progreso se guarda por destinatario, por lo que
+    un trabajo interrumpido se reanuda desde los destinatarios que faltan.
+    """
+
+    def __init__(self, mailer, upload_folder: str, db_name: str = 'clients.db',
+                 concurrency: int = 4, rate_limits: str = None, poll_interval: float = 2,
+                 heartbeat_interval: float = 10, stale_seconds: int = 60,
+                 max_attachment_bytes: int = DEFAULT_MAX_ATTACHMENT_BYTES, render_workers: int = 0,
+                 pdf_index=None):
+        super().__init__(name='send-job-worker', daemon=True)
+        self.mailer = mailer
+        self.upload_folder = upload_folder
+        self.db_name = db_name
+        self.concurrency = concurrency
+        self.rate_limits = rate_limits
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_seconds = stale_seconds
+        self.max_attachment_bytes = max_attachment_bytes
+        self.render_workers = render_workers
+        self.pdf_index = pdf_index
+        # Pool de render que dura lo que el worker: las cachés de adjuntos de
+        # sus procesos se conservan entre trabajos (reintentos, reenvíos)
+        self._render_executor = None
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    job = DatabaseManager(self.db_name).claim_send_job(self.worker_id, self.stale_seconds)
+                except Exception as e:
+                    print(f"Error al reclamar trabajo de envío: {str(e)}")
+                    job = None
+
+                if job is None:
+                    self._stop_event.wait(self.poll_interval)
+                    continue
+
+                self.process_job(job)
+        finally:
+            if self._render_executor is not None:
+                self._render_executor.shutdown(wait=True, cancel_futures=True)
+                self._render_executor = None
+
+    def render_executor(self):
+        """Pool de render compartido; se crea al primer trabajo y se recrea si un proceso murió"""
+        if self.render_workers <= 0 or not getattr(self.mailer, 'supports_prepared', False):
+            return None
+        if self._render_executor is not None:
+            try:
+                self._render_executor.submit(int).result()
+            except BrokenProcessPool:
+                self._render_executor.shutdown(wait=False, cancel_futures=True)
+                self._render_executor = None
+        if self._render_executor is None:
+            self._render_executor = create_render_executor(
+                self.render_workers, getattr(self.mailer, 'attachment_cache', None))
+        return self._render_executor
+
+    def rate_limiter(self, params: Dict, save_as_draft: bool) -> DomainRateLimiter:
+        """Límites por dominio del trabajo; los borradores no salen al servidor y no se limitan"""
+        if save_as_draft:
+            return DomainRateLimiter({})
+        return DomainRateLimiter.from_spec(params.get('rate_limits') or self.rate_limits)
+
+    def process_job(self, job: Dict):
+        """Ejecuta un trabajo reclamado hasta completarlo"""
+        db = DatabaseManager(self.db_name)
+        job_id = job['id']
+        params = job['params']
+        save_as_draft = params.get('draft', False)
+
+        # Solo los destinatarios sin resultado (permite reanudar)
+        clients = db.get_send_job_items(job_id, status='queued')
+        db.add_log('SYSTEM', 'send_job', 'running',
+                   f"Trabajo {job_id} iniciado: {len(clients)} de {job['total']} destinatarios pendientes")
+
+        heartbeat_stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, heartbeat_stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            template_id = params.get('template_id')
+            template = db.get_template(template_id) if template_id else None
+
+            engine = SendEngine(self.mailer, self.upload_folder,
+                                concurrency=int(params.get('concurrency') or self.concurrency),
+                                save_as_draft=save_as_draft,
+                                template=template,
+                                rate_limiter=self.rate_limiter(params, save_as_draft),
+                                db_name=self.db_name,
+                                job_id=job_id,
+                                coalesce=params.get('coalesce', False),
+                                max_attachment_bytes=int(params.get('max_attachment_bytes')
+                                                         or self.max_attachment_bytes),
+                                render_workers=self.render_workers,
+                                pdf_index=self.pdf_index,
+                                render_executor=self.render_executor())
+            engine.run(clients)
+
+            job = db.get_send_job(job_id)
+            if job['success_count'] > 0:
+                message = f"{'Borradores guardados' if save_as_draft else 'Correos enviados'}: {job['success_count']}"
+                if job['error_count'] > 0:
+                    message += f", Errores: {job['error_count']}"
+            else:
+                message = "No se pudo procesar ningún correo"
+            db.finish_send_job(job_id, 'completed', message)
+            db.add_log('SYSTEM', 'send_job', 'success', f"Trabajo {job_id} completado. {message}")
+
+        except Exception as e:
+            db.finish_send_job(job_id, 'failed', str(e))
+            db.add_log('SYSTEM', 'send_job', 'error', f"Trabajo {job_id} falló: {str(e)}")
+        finally:
+            heartbeat_stop.set()
+            heartbeat.join()
+
+    def _heartbeat(self, job_id, stop: threading.Event):
+        """Mantiene vivo el trabajo mientras se envía"""
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                DatabaseManager(self.db_name).touch_send_job(job_id)
+            except Exception as e:
+                print(f"Error al actualizar heartbeat del trabajo {job_id}: {str(e)}")
@@ -1,54 +1,244 @@
 import os
+import re
 import time
-import pythoncom
-from typing import Dict
-import win32com.client
+import queue
+import smtplib
+import threading
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+from typing import Dict, List, Mapping, Union
 from database import DatabaseManager
+from attachment_cache import AttachmentCache, DEFAULT_CACHE_BYTES
+from template_engine import render_template
 
-class OutlookSender:
-    def __init__(self):
+try:
+    # pywin32 solo está disponible en Windows; Outlook es un backend opcional
+    import pythoncom
+    import win32com.client
+except ImportError:
+    pythoncom = None
+    win32com = None
+
+
+class TransientSendError(Exception):
+    """
+    Fallo temporal del servidor (respuestas 4xx, throttling, conexión caída).
+    El envío no debe marcarse como fallido: se puede reintentar más tarde.
+    """
+
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+class PermanentSendError(Exception):
+    """
+    Rechazo definitivo del servidor (respuestas 5xx): reintentar no sirve.
+    """
+
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+# Frases con las que algunos relays indican limitación de envío
+THROTTLING_HINTS = ('throttl', 'rate limit', 'too many', 'try again later', 'temporarily')
+
+
+def is_transient_response(code: int, message='') -> bool:
+    """Indica si una respuesta SMTP es un rechazo temporal"""
+    if code and 400 <= code < 500:
+        return True
+    text = message.decode(errors='ignore') if isinstance(message, bytes) else str(message)
+    return any(hint in text.lower() for hint in THROTTLING_HINTS)
+
+
+def split_addresses(value: str) -> List[str]:
+    """Separa una cadena con uno o varios correos (separados por ';' o ',')"""
+    if not value:
+        return []
+    return [part.strip() for part in value.replace(',', ';').split(';') if part.strip()]
+
+
+def as_path_list(pdf_path: Union[str, List[str]]) -> List[str]:
+    """Una ruta o una lista de rutas (envío agrupado por destinatario)"""
+    return [pdf_path] if isinstance(pdf_path, str) else list(pdf_path)
+
+
+def render_subject_and_body(client: Dict, template: Dict = None):
+    """
+    Obtiene el asunto y el cuerpo HTML del correo para un cliente. Con
+    plantilla, los campos de combinación salen de la fila del cliente
+    (ver template_engine.merge_fields)
+    """
+    if template:
+        return render_template(template, client)
+    subject = f"New Message - {client['Agency Code']}"
+    body = f"""
+                    <p>Dear Client,</p>
+                    <p>Please find attached.</p>
+                    <p>Best regards,</p>
+                """
+    return subject, body
+
+
+def build_message(sender: str, client: Dict, pdf_path: Union[str, List[str]], template: Dict = None,
+                  attachment_cache: AttachmentCache = None) -> EmailMessage:
+    """Construye el mensaje MIME con el PDF (o los PDFs) adjunto"""
+    pdf_paths = as_path_list(pdf_path)
+    for path in pdf_paths:
+        if not os.path.exists(path):
+            raise Exception(f"PDF no encontrado: {path}")
+    attachment_cache = attachment_cache or AttachmentCache()
+
+    subject, body = render_subject_and_body(client, template)
+    msg = EmailMessage()
+    msg['From'] = sender
+    msg['To'] = ', '.join(split_addresses(client['Report email']))
+    msg['Subject'] = subject
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid()
+    msg.set_content("Este mensaje requiere un cliente de correo compatible con HTML.")
+    msg.add_alternative(body, subtype='html')
+
+    msg.make_mixed()
+    for path in pdf_paths:
+        msg.attach(attachment_cache.attachment(path))
+    return msg
+
+
+def message_bytes(msg: EmailMessage) -> bytes:
+    """Serializa el mensaje tal como se transmite por SMTP (líneas CRLF)"""
+    return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+
+# Caché de adjuntos de cada proceso del pool de render
+_render_cache = None
+
+
+def init_render_worker(max_bytes: int = DEFAULT_CACHE_BYTES, spill_folder: str = None):
+    """
+    Inicializador de cada proceso del pool de render: su caché de adjuntos
+    usa el tamaño y la carpeta de desborde de la aplicación, así lo que
+    codifica un proceso lo reutilizan los demás y los trabajos siguientes
+    """
+    global _render_cache
+    _render_cache = AttachmentCache(max_bytes=max_bytes, spill_folder=spill_folder)
+
+
+def render_message(sender: str, client: Dict, pdf_path: Union[str, List[str]], template: Dict = None) -> bytes:
+    """
+    Construye y serializa un mensaje completo. Pensada para ejecutarse en un
+    ProcessPoolExecutor (ver SendEngine): los argumentos y el resultado son
+    serializables y cada proceso mantiene su propia caché de adjuntos.
+    """
+    global _render_cache
+    if _render_cache is None:
+        _render_cache = AttachmentCache()
+    return message_bytes(build_message(sender, client, pdf_path, template, _render_cache))
+
+
+class MailTransport:
+    """
+    Interfaz común de los backends de envío.
+    Las rutas de la aplicación solo usan estos métodos, sin importar si el
+    correo sale por Outlook o por SMTP.
+    """
+
+    name = 'base'
+    # True si el backend puede enviar mensajes ya renderizados con
+    # render_message (send_prepared); el motor los prepara por adelantado
+    supports_prepared = False
+
+    def open(self):
+        """Prepara los recursos del backend (opcional)"""
         pass
 
-    def send_email(self, client: Dict, pdf_path: str, save_as_draft: bool = False, template: Dict = None) -> bool:
+    def close(self):
+        """Libera los recursos del backend al terminar una campaña"""
+        pass
+
+    def send_email(self, client: Dict, pdf_path: Union[str, List[str]], save_as_draft: bool = False,
+                   template: Dict = None) -> bool:
         """
-        Envía un correo electrónico usando Outlook
+        Envía (o guarda como borrador) un correo con uno o varios PDFs adjuntos
         """
-        try:
-            # Inicializar COM antes de usar Outlook
+        raise NotImplementedError
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class OutlookSender(MailTransport):
+    """
+    Backend de Outlook (solo Windows).
+    Reutiliza la instancia de Outlook.Application por hilo durante toda la
+    campaña en lugar de crearla para cada mensaje.
+    """
+
+    name = 'outlook'
+    # Outlook/MAPI no admite envíos en paralelo desde varios hilos
+    max_concurrency = 1
+
+    def __init__(self):
+        if win32com is None:
+            raise RuntimeError("El backend de Outlook requiere pywin32 (solo disponible en Windows)")
+        self._local = threading.local()
+
+    def open(self):
+        self._get_outlook()
+
+    def close(self):
+        """Libera COM en el hilo actual"""
+        if getattr(self._local, 'outlook', None) is not None:
+            self._local.outlook = None
+            try:
+                pythoncom.CoUninitialize()
+            except Exception:
+                pass
+
+    def _get_outlook(self):
+        outlook = getattr(self._local, 'outlook', None)
+        if outlook is None:
+            # COM se inicializa una vez por hilo
             pythoncom.CoInitialize()
-            
             outlook = win32com.client.Dispatch('Outlook.Application')
-            mail = outlook.CreateItem(0)  # 0 = olMailItem
-            
+            self._local.outlook = outlook
+        return outlook
+
+    def send_email(self, client: Dict, pdf_path: Union[str, List[str]], save_as_draft: bool = False,
+                   template: Dict = None) -> bool:
+        """
+        Envía un correo electrónico usando Outlook
+        """
+        try:
+            mail = self._get_outlook().CreateItem(0)  # 0 = olMailItem
+
             mail.To = client['Report email']
-            
-            # Usar plantilla si está disponible
-            if template:
-                mail.Subject = template['subject']
-                mail.HTMLBody = template['body']
-            else:
-                mail.Subject = f"New Message - {client['Agency Code']}"
-                mail.HTMLBody = f"""
-                    <p>Dear Client,</p>
-                    <p>Please find attached.</p>
-                    <p>Best regards,</p>
-                """
-            
-            # Adjuntar PDF
-            if os.path.exists(pdf_path):
-                mail.Attachments.Add(pdf_path)
-            else:
-                raise Exception(f"PDF no encontrado: {pdf_path}")
-            
+            mail.Subject, mail.HTMLBody = render_subject_and_body(client, template)
+
+            # Adjuntar PDF(s)
+            for path in as_path_list(pdf_path):
+                if not os.path.exists(path):
+                    raise Exception(f"PDF no encontrado: {path}")
+                mail.Attachments.Add(path)
+
             if save_as_draft:
                 mail.Save()
                 print(f"Correo guardado como borrador para {client['Report email']}")
             else:
                 mail.Send()
                 print(f"Correo enviado exitosamente a {client['Report email']}")
-                return True
-                
+            return True
+
         except Exception as e:
+            # La instancia de Outlook puede haber quedado inválida
+            self.close()
             # Capturar errores específicos de Outlook
             if "Outlook" in str(e):
                 raise Exception("Error al conectar con Outlook. Asegúrate de que Outlook esté abierto y configurado.")
@@ -57,56 +247,273 @@ class OutlookSender:
             else:
                 raise Exception(f"Error al enviar el correo: {str(e)}")
 
-        finally:
-            # Liberar COM al terminar
-            pythoncom.CoUninitialize()
+
+class _PooledConnection:
+    """Conexión SMTP autenticada junto con sus contadores de uso"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPSender(MailTransport):
+    """
+    Backend SMTP con un pool de conexiones persistentes.
+    Las conexiones se autentican una sola vez y se reutilizan durante toda
+    la campaña; solo se reabren si el servidor las cierra o al alcanzar
+    max_messages_per_connection. Los PDFs se adjuntan desde un
+    AttachmentCache, ya codificados.
+    """
+
+    name = 'smtp'
+    supports_prepared = True
+
+    def __init__(self, host: str = 'localhost', port: int = 587, username: str = None,
+                 password: str = None, use_tls: bool = True, use_ssl: bool = False,
+                 sender: str = None, pool_size: int = 4, timeout: float = 30,
+                 max_messages_per_connection: int = 100, idle_timeout: float = 60,
+                 drafts_folder: str = 'drafts', attachment_cache: AttachmentCache = None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.sender = sender or username
+        self.pool_size = max(1, pool_size)
+        self.max_concurrency = self.pool_size
+        self.timeout = timeout
+        self.max_messages_per_connection = max_messages_per_connection
+        self.idle_timeout = idle_timeout
+        self.drafts_folder = drafts_folder
+        self.attachment_cache = attachment_cache or AttachmentCache()
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+
+    def _connect(self) -> _PooledConnection:
+        """Abre y autentica una nueva conexión SMTP"""
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            smtp.ehlo()
+            if self.use_tls and smtp.has_extn('starttls'):
+                smtp.starttls()
+                smtp.ehlo()
+        if self.username and self.password:
+            smtp.login(self.username, self.password)
+        return _PooledConnection(smtp)
+
+    def _discard(self, conn: _PooledConnection):
+        try:
+            conn.smtp.quit()
+        except Exception:
             try:
-                pythoncom.CoUninitialize()
-            except:
+                conn.smtp.close()
+            except Exception:
                 pass
 
+    def _acquire(self) -> _PooledConnection:
+        """Obtiene una conexión del pool (o abre una si no hay libres)"""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                # Verificar conexiones que llevan tiempo sin usarse
+                if time.monotonic() - conn.last_used > self.idle_timeout:
+                    try:
+                        if conn.smtp.noop()[0] != 250:
+                            raise smtplib.SMTPServerDisconnected()
+                    except Exception:
+                        self._discard(conn)
+                        continue
+                return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, conn: _PooledConnection, healthy: bool = True):
+        """Devuelve una conexión al pool o la cierra si ya no es reutilizable"""
+        try:
+            if healthy and conn.messages < self.max_messages_per_connection:
+                conn.last_used = time.monotonic()
+                self._idle.put(conn)
+            else:
+                self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def open(self):
+        """Precalienta una conexión para detectar errores de configuración al inicio"""
+        self._release(self._acquire())
+
+    def close(self):
+        """Cierra las conexiones inactivas del pool"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def build_message(self, client: Dict, pdf_path: Union[str, List[str]], template: Dict = None) -> EmailMessage:
+        """Construye el mensaje MIME con el PDF (o los PDFs) adjunto"""
+        return build_message(self.sender, client, pdf_path, template, self.attachment_cache)
+
+    def _save_draft(self, client: Dict, message: bytes):
+        """SMTP no tiene borradores: se guardan como .eml en drafts_folder"""
+        os.makedirs(self.drafts_folder, exist_ok=True)
+        # En un envío agrupado 'Agency Code' contiene varios códigos
+        name = re.sub(r'[^\w.-]+', '_', str(client['Agency Code']))
+        draft_path = os.path.join(self.drafts_folder, f"{name}.eml")
+        with open(draft_path, 'wb') as f:
+            f.write(message)
+        print(f"Correo guardado como borrador para {client['Report email']} en {draft_path}")
+
+    def send_email(self, client: Dict, pdf_path: Union[str, List[str]], save_as_draft: bool = False,
+                   template: Dict = None) -> bool:
+        """
+        Envía un correo electrónico usando una conexión del pool
+        """
+        return self.send_prepared(client, message_bytes(self.build_message(client, pdf_path, template)),
+                                  save_as_draft)
+
+    def send_prepared(self, client: Dict, message: bytes, save_as_draft: bool = False) -> bool:
+        """
+        Envía un mensaje ya renderizado (ver render_message)
+        """
+        if save_as_draft:
+            self._save_draft(client, message)
+            return True
+
+        recipients = split_addresses(client['Report email'])
+        # Un reintento si una conexión reutilizada resultó estar cerrada
+        for attempt in range(2):
+            try:
+                conn = self._acquire()
+            except smtplib.SMTPResponseException as e:
+                if is_transient_response(e.smtp_code, e.smtp_error):
+                    raise TransientSendError(f"Servidor SMTP no disponible: {e.smtp_code} {e.smtp_error!r}", e.smtp_code)
+                raise Exception(f"Error al conectar con el servidor SMTP: {e.smtp_code} {e.smtp_error!r}")
+            except OSError as e:
+                raise TransientSendError(f"No se pudo conectar con el servidor SMTP: {str(e)}")
+            try:
+                conn.smtp.sendmail(self.sender, recipients, message)
+                conn.messages += 1
+                self._release(conn)
+                print(f"Correo enviado exitosamente a {client['Report email']}")
+                return True
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._release(conn, healthy=False)
+                if attempt == 1:
+                    raise TransientSendError(f"Conexión SMTP cerrada por el servidor ({str(e)})")
+            except smtplib.SMTPRecipientsRefused as e:
+                self._release(conn)
+                codes = [code for code, _ in e.recipients.values()]
+                if codes and all(is_transient_response(code) for code in codes):
+                    raise TransientSendError(f"Destinatario rechazado temporalmente {e.recipients}", codes[0])
+                raise PermanentSendError(f"Error al enviar el correo: destinatario rechazado {e.recipients}",
+                                         codes[0] if codes else None)
+            except smtplib.SMTPResponseException as e:
+                # La conexión sigue siendo válida tras un rechazo, salvo con 421
+                self._release(conn, healthy=e.smtp_code != 421)
+                if is_transient_response(e.smtp_code, e.smtp_error):
+                    raise TransientSendError(f"Rechazo temporal del servidor: {e.smtp_code} {e.smtp_error!r}", e.smtp_code)
+                raise PermanentSendError(f"Error al enviar el correo: {e.smtp_code} {e.smtp_error!r}", e.smtp_code)
+            except Exception as e:
+                self._release(conn, healthy=False)
+                raise Exception(f"Error al enviar el correo: {str(e)}")
+
+
+def _as_bool(value, default: bool = False) -> bool:
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'si', 'sí', 'on')
+
+
+def create_mailer(config: Mapping) -> MailTransport:
+    """
+    Crea el backend de envío indicado en la configuración.
+    Acepta app.config u os.environ (los valores pueden venir como texto).
+    Args:
+        config: Debe incluir MAIL_TRANSPORT ('outlook' o 'smtp') y, para SMTP,
+                SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_USE_TLS,
+                SMTP_USE_SSL, SMTP_FROM y SMTP_POOL_SIZE; opcionalmente
+                ATTACHMENT_CACHE_MB y ATTACHMENT_CACHE_FOLDER.
+    """
+    transport = str(config.get('MAIL_TRANSPORT') or ('outlook' if os.name == 'nt' else 'smtp')).lower()
+
+    if transport == 'outlook':
+        return OutlookSender()
+    if transport == 'smtp':
+        return SMTPSender(
+            host=config.get('SMTP_HOST') or 'localhost',
+            port=int(config.get('SMTP_PORT') or 587),
+            username=config.get('SMTP_USER') or None,
+            password=config.get('SMTP_PASSWORD') or None,
+            use_tls=_as_bool(config.get('SMTP_USE_TLS'), True),
+            use_ssl=_as_bool(config.get('SMTP_USE_SSL'), False),
+            sender=config.get('SMTP_FROM') or None,
+            pool_size=int(config.get('SMTP_POOL_SIZE') or 4),
+            drafts_folder=config.get('DRAFTS_FOLDER') or 'drafts',
+            attachment_cache=AttachmentCache(
+                max_bytes=int(float(config.get('ATTACHMENT_CACHE_MB') or DEFAULT_CACHE_BYTES / 2 ** 20) * 2 ** 20),
+                spill_folder=config.get('ATTACHMENT_CACHE_FOLDER') or None)
+        )
+    raise ValueError(f"Transporte de correo no soportado: {transport}")
+
+
 def main():
-    # Inicializar manejador de base de datos y Outlook
+    # Inicializar manejador de base de datos y backend de correo
     db = DatabaseManager()
-    mailer = OutlookSender()
+    mailer = create_mailer(os.environ)
 
     # Ruta base donde están los PDFs
-    base_path = "c:\\Users\\Eduardo\\Documents\\massemails\\uploads"
-    
+    base_path = os.environ.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+
     try:
         # Obtener clientes pendientes de envío
         pending_clients = db.get_pending_clients()
-        
+
         if not pending_clients:
             print("No hay correos pendientes por enviar")
             return
 
         print(f"Enviando {len(pending_clients)} correos...")
-        
+
         # Enviar correos
         for client in pending_clients:
             try:
                 # Construir ruta al PDF
-                pdf_filename = f"{client['Agency Code']}.pdf"
+                pdf_filename = f"{client['agency_code']}.pdf"
                 pdf_path = os.path.join(base_path, pdf_filename)
-                
+
                 # Enviar correo
-                mailer.send_email(client, pdf_path)
-                
+                mailer.send_email({
+                    'Agency Code': client['agency_code'],
+                    'Report email': client['email']
+                }, pdf_path)
+
                 # Marcar como enviado en la base de datos
-                db.mark_email_sent(client['id'])
-                
-                # Esperar un poco entre envíos
-                time.sleep(1)
-                
+                db.add_sent_email(client['agency_code'], client['email'], 'success', 'Correo enviado correctamente')
+
             except Exception as e:
-                print(f"Error procesando cliente {client['Agency Code']}: {str(e)}")
+                print(f"Error procesando cliente {client['agency_code']}: {str(e)}")
+                db.add_sent_email(client['agency_code'], client['email'], 'error', str(e))
                 continue
-                
+
     except Exception as e:
         print(f"Error en el proceso de envío: {str(e)}")
-    
+
     finally:
+        mailer.close()
         print("Proceso finalizado")
 
 if __name__ == "__main__":
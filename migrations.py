@@ -0,0 +1,427 @@
+import sqlite3
+from typing import List
+
+# Columnas declaradas de clients (además de id). Las columnas adicionales del
+# Excel se guardan como JSON en "extra".
+CLIENT_COLUMNS = [
+    ('Agency Code', 'TEXT NOT NULL DEFAULT \'\''),
+    ('Report email', 'TEXT NOT NULL DEFAULT \'\''),
+    ('email_sent', 'INTEGER DEFAULT 0'),
+    ('sent_date', 'DATETIME'),
+    ('has_pdf', 'BOOLEAN DEFAULT FALSE'),
+    ('extra', 'TEXT'),
+]
+
+
+def quote(identifier: str) -> str:
+    """Escapa un nombre de columna o tabla para SQLite"""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def table_columns(cursor, table: str):
+    """Devuelve {nombre: fila de PRAGMA table_info} de una tabla"""
+    cursor.execute(f'PRAGMA table_info({quote(table)})')
+    return {row[1]: row for row in cursor.fetchall()}
+
+
+def _create_base_tables(cursor):
+    # Tabla de clientes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS clients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            "Agency Code" TEXT NOT NULL,
+            "Report email" TEXT NOT NULL,
+            email_sent INTEGER DEFAULT 0,
+            sent_date DATETIME,
+            has_pdf BOOLEAN DEFAULT FALSE
+        )
+    ''')
+
+    # Tabla de logs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            agency_code TEXT,
+            action TEXT,
+            status TEXT,
+            message TEXT
+        )
+    ''')
+
+    # Tabla de correos enviados
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sent_emails (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agency_code TEXT NOT NULL,
+            email TEXT NOT NULL,
+            sent_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            status TEXT,
+            message TEXT
+        )
+    ''')
+
+    # Tabla de plantillas de correo
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            is_default INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Tabla de PDFs pendientes
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_pdfs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agency_code TEXT NOT NULL,
+            upload_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed BOOLEAN DEFAULT FALSE,
+            processed_date TIMESTAMP
+        )
+    ''')
+
+
+def _create_send_job_tables(cursor):
+    # Tabla de trabajos de envío (campañas en segundo plano)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS send_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT,
+            status TEXT DEFAULT 'queued',
+            total INTEGER DEFAULT 0,
+            current INTEGER DEFAULT 0,
+            success_count INTEGER DEFAULT 0,
+            error_count INTEGER DEFAULT 0,
+            current_agency TEXT,
+            worker_id TEXT,
+            message TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME,
+            heartbeat DATETIME,
+            finished_at DATETIME
+        )
+    ''')
+
+    # Destinatarios de cada trabajo; permite reanudar una campaña
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS send_job_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            agency_code TEXT NOT NULL,
+            email TEXT NOT NULL,
+            status TEXT DEFAULT 'queued',
+            message TEXT,
+            updated_at DATETIME
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_send_job_items_job
+        ON send_job_items(job_id, status)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_send_jobs_status
+        ON send_jobs(status)
+    ''')
+
+
+def _create_dead_letters(cursor):
+    # Destinatarios que agotaron sus reintentos, con el último error
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agency_code TEXT NOT NULL,
+            email TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            job_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            resolved INTEGER DEFAULT 0
+        )
+    ''')
+
+
+def _declare_client_columns(cursor):
+    """
+    Lleva clients al esquema declarado. Normalmente basta con ALTER TABLE;
+    solo las tablas creadas por pandas.to_sql (sin clave primaria en id) se
+    reconstruyen, una única vez, guardando las columnas extra como JSON.
+    """
+    columns = table_columns(cursor, 'clients')
+    id_column = columns.get('id')
+    if id_column is not None and id_column[5] == 1:
+        for name, ddl in CLIENT_COLUMNS:
+            if name not in columns:
+                cursor.execute(f'ALTER TABLE clients ADD COLUMN {quote(name)} {ddl}')
+        return
+
+    declared = {name for name, _ in CLIENT_COLUMNS} | {'id', 'index'}
+    extra_columns = [name for name in columns if name not in declared]
+
+    cursor.execute('''
+        CREATE TABLE clients_migrated (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            "Agency Code" TEXT NOT NULL,
+            "Report email" TEXT NOT NULL,
+            email_sent INTEGER DEFAULT 0,
+            sent_date DATETIME,
+            has_pdf BOOLEAN DEFAULT FALSE,
+            extra TEXT
+        )
+    ''')
+
+    def existing(name, default='NULL'):
+        return quote(name) if name in columns else default
+
+    if extra_columns:
+        extra = 'json_object(' + ', '.join(
+            f"'{name.replace(chr(39), chr(39) * 2)}', {quote(name)}" for name in extra_columns) + ')'
+    else:
+        extra = 'NULL'
+
+    cursor.execute(f'''
+        INSERT INTO clients_migrated (id, "Agency Code", "Report email", email_sent, sent_date, has_pdf, extra)
+        SELECT {existing('id')},
+               COALESCE(CAST({existing('Agency Code', "''")} AS TEXT), ''),
+               COALESCE({existing('Report email', "''")}, ''),
+               COALESCE({existing('email_sent', '0')}, 0),
+               {existing('sent_date')},
+               COALESCE({existing('has_pdf', 'FALSE')}, FALSE),
+               {extra}
+        FROM clients
+    ''')
+    cursor.execute('DROP TABLE clients')
+    cursor.execute('ALTER TABLE clients_migrated RENAME TO clients')
+
+
+def _create_indexes(cursor):
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_clients_agency_code
+        ON clients("Agency Code")
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_clients_pending
+        ON clients(email_sent)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sent_emails_agency_status
+        ON sent_emails(agency_code, status)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_pdfs_agency_processed
+        ON pending_pdfs(agency_code, processed)
+    ''')
+    sync_delivery_state(cursor)
+
+
+def _create_listing_indexes(cursor):
+    # Índices para los listados paginados del panel: cada filtro, seguido de
+    # id, permite recorrer la página en orden sin ordenar en memoria
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_logs_status
+        ON activity_logs(status, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_logs_agency
+        ON activity_logs(agency_code, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_logs_timestamp
+        ON activity_logs(timestamp)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sent_emails_status
+        ON sent_emails(status, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sent_emails_sent_date
+        ON sent_emails(sent_date)
+    ''')
+
+
+def _unique_agency_code(cursor):
+    # La importación hace upsert por "Agency Code": debe ser único. Si hay
+    # duplicados de importaciones anteriores se conserva la fila más reciente.
+    cursor.execute('''
+        DELETE FROM clients
+        WHERE id NOT IN (SELECT MAX(id) FROM clients GROUP BY "Agency Code")
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_clients_agency_code')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_clients_agency_code
+        ON clients("Agency Code")
+    ''')
+
+
+def _create_import_tracking(cursor):
+    # Hash del contenido importado de cada cliente, para actualizar solo los cambios
+    if 'row_hash' not in table_columns(cursor, 'clients'):
+        cursor.execute('ALTER TABLE clients ADD COLUMN row_hash TEXT')
+
+    # Historial de importaciones; el hash del archivo permite omitir re-subidas idénticas
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS client_imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT,
+            file_hash TEXT NOT NULL,
+            total INTEGER DEFAULT 0,
+            added INTEGER DEFAULT 0,
+            changed INTEGER DEFAULT 0,
+            removed INTEGER DEFAULT 0,
+            unchanged INTEGER DEFAULT 0,
+            imported_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _create_import_issues(cursor):
+    # Reporte de validación por fila de cada importación
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS client_import_issues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            import_id INTEGER NOT NULL,
+            row_number INTEGER,
+            agency_code TEXT,
+            email TEXT,
+            severity TEXT,
+            reason TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_client_import_issues_import
+        ON client_import_issues(import_id, row_number)
+    ''')
+    if 'rejected' not in table_columns(cursor, 'client_imports'):
+        cursor.execute('ALTER TABLE client_imports ADD COLUMN rejected INTEGER DEFAULT 0')
+        cursor.execute('ALTER TABLE client_imports ADD COLUMN warnings INTEGER DEFAULT 0')
+
+
+def _version_templates(cursor):
+    # Versión de cada plantilla; cambia al editarla e invalida la compilada en caché
+    if 'version' not in table_columns(cursor, 'email_templates'):
+        cursor.execute('ALTER TABLE email_templates ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+
+def _create_pdf_versions(cursor):
+    # Versión (hash) vigente del PDF de cada agencia en el almacén de uploads
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_files (
+            agency_code TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Versión del PDF que se envió en cada correo
+    if 'pdf_hash' not in table_columns(cursor, 'sent_emails'):
+        cursor.execute('ALTER TABLE sent_emails ADD COLUMN pdf_hash TEXT')
+
+
+def _create_pdf_store_files(cursor):
+    # Archivo de uploads -> blob del almacén, con el tamaño y mtime con que se
+    # registró (si cambian, el archivo se reescribió y hay que volver a hashearlo)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pdf_store_files (
+            filename TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdf_store_files_hash ON pdf_store_files(hash)')
+
+
+def _create_pending_pdfs_listing_index(cursor):
+    # Listado paginado de /api/pending-pdfs: filtro por estado seguido de id
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_pdfs_processed
+        ON pending_pdfs(processed, id)
+    ''')
+
+
+def sync_delivery_state(cursor):
+    """
+    Recalcula clients.email_sent / sent_date a partir de los envíos exitosos
+    registrados en sent_emails
+    """
+    cursor.execute('''
+        UPDATE clients
+        SET email_sent = 1,
+            sent_date = (
+                SELECT MAX(s.sent_date) FROM sent_emails s
+                WHERE s.agency_code = clients."Agency Code" AND s.status = 'success'
+            )
+        WHERE EXISTS (
+            SELECT 1 FROM sent_emails s
+            WHERE s.agency_code = clients."Agency Code" AND s.status = 'success'
+        )
+    ''')
+    cursor.execute('''
+        UPDATE clients SET email_sent = 0 WHERE email_sent IS NULL
+    ''')
+
+
+# Migraciones en orden: (versión, descripción, función)
+# Nunca modificar una migración ya publicada; agregar una nueva al final.
+MIGRATIONS = [
+    (1, 'Tablas base', _create_base_tables),
+    (2, 'Trabajos de envío en segundo plano', _create_send_job_tables),
+    (3, 'Tabla dead_letters', _create_dead_letters),
+    (4, 'Columnas declaradas de clients', _declare_client_columns),
+    (5, 'Índices y estado de entrega', _create_indexes),
+    (6, 'Índices de los listados paginados', _create_listing_indexes),
+    (7, 'Agency Code único en clients', _unique_agency_code),
+    (8, 'Hash por cliente e historial de importaciones', _create_import_tracking),
+    (9, 'Reporte de validación de importaciones', _create_import_issues),
+    (10, 'Versión de las plantillas de correo', _version_templates),
+    (11, 'Versiones de PDF por agencia y en cada envío', _create_pdf_versions),
+    (12, 'Blob del almacén de cada PDF de uploads', _create_pdf_store_files),
+    (13, 'Índice del listado de PDFs pendientes', _create_pending_pdfs_listing_index),
+]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def apply_migrations(conn: sqlite3.Connection) -> List[int]:
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción
+    Returns:
+        list: Versiones aplicadas
+    """
+    conn.commit()
+    get_schema_version(conn)
+    conn.commit()
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        cursor = conn.cursor()
+        try:
+            # BEGIN IMMEDIATE: si otro proceso migra a la vez, uno espera al otro
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,))
+            if cursor.fetchone():
+                conn.commit()
+                continue
+            migrate(cursor)
+            cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                           (version, description))
+            conn.commit()
+            applied.append(version)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    return applied
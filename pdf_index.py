@@ -0,0 +1,205 @@
+import os
+import hashlib
+import threading
+from typing import Dict, List, Optional, Set
+from agency_matcher import AgencyMatcher
+
+
+class PDFIndex:
+    """
+    Índice en memoria de la carpeta de uploads: código de agencia -> ruta,
+    tamaño, mtime y hash del PDF. Se construye con os.scandir al arrancar y lo
+    mantiene al día PDFHandler con los eventos del watcher, así las rutas y el
+    envío consultan la memoria en lugar de hacer stat/listdir por cliente (lo
+    que domina la latencia en carpetas de red con miles de PDFs).
+    El hash se calcula la primera vez que se pide y se descarta si cambian el
+    tamaño o el mtime. El código de agencia de cada archivo lo resuelve el
+    AgencyMatcher, así que el nombre no tiene que ser exactamente el código;
+    si varios archivos resuelven al mismo código se elige uno con un criterio
+    fijo (ver _choose) y el resto queda en conflicts().
+    """
+
+    def __init__(self, folder: str, matcher: AgencyMatcher = None):
+        self.folder = folder
+        self.matcher = matcher or AgencyMatcher()
+        self._lock = threading.Lock()
+        # Nombre de archivo -> entrada de cada PDF de la carpeta
+        self._files: Dict[str, Dict] = {}
+        # Código de agencia -> nombres de los archivos que resuelven a ese código
+        self._candidates: Dict[str, Set[str]] = {}
+        # Código de agencia -> entrada del archivo elegido (ver _choose)
+        self._entries: Dict[str, Dict] = {}
+
+    def rebuild(self) -> int:
+        """Vuelve a leer la carpeta completa; devuelve la cantidad de PDFs"""
+        files = {}
+        with os.scandir(self.folder) as scan:
+            for item in scan:
+                agency_code = self.matcher.match(item.name)
+                if agency_code is None or not item.is_file():
+                    continue
+                files[item.name] = self._entry(agency_code, item.name, item.stat())
+        with self._lock:
+            # Conservar los hashes ya calculados de los archivos que no cambiaron
+            for filename, entry in files.items():
+                known = self._files.get(filename)
+                if known and (known['size'], known['mtime']) == (entry['size'], entry['mtime']):
+                    entry['hash'] = known['hash']
+            self._files = files
+            self._candidates = {}
+            for filename, entry in files.items():
+                self._candidates.setdefault(entry['agency_code'], set()).add(filename)
+            self._entries = {}
+            for agency_code in self._candidates:
+                self._choose(agency_code)
+        return len(files)
+
+    def _entry(self, agency_code: str, filename: str, stat) -> Dict:
+        return {
+            'agency_code': agency_code,
+            'filename': filename,
+            'path': os.path.join(self.folder, filename),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': None
+        }
+
+    def _choose(self, agency_code: str):
+        """
+        Elige el archivo de una agencia cuando varios resuelven al mismo código:
+        el más reciente (mtime) y, a igual fecha, el último por nombre, así
+        '1099_ABC_2025.pdf' gana a '1099_ABC_2024.pdf' sin depender del orden
+        de os.scandir
+        """
+        filenames = self._candidates.get(agency_code)
+        if not filenames:
+            self._candidates.pop(agency_code, None)
+            self._entries.pop(agency_code, None)
+            return
+        chosen = max(filenames, key=lambda name: (self._files[name]['mtime'], name))
+        self._entries[agency_code] = self._files[chosen]
+
+    def _discard(self, filename: str) -> Optional[str]:
+        entry = self._files.pop(filename, None)
+        if entry is None:
+            return None
+        self._candidates.get(entry['agency_code'], set()).discard(filename)
+        self._choose(entry['agency_code'])
+        return entry['agency_code']
+
+    def update(self, path: str, digest: str = None) -> Optional[Dict]:
+        """
+        Agrega o actualiza un PDF (creado, modificado o subido). Si quien lo
+        escribió ya calculó el hash, se recibe en digest y no se vuelve a leer.
+        Devuelve la entrada del archivo (que puede no ser el elegido para su
+        agencia si hay otro más reciente con el mismo código).
+        """
+        filename = os.path.basename(path)
+        agency_code = self.matcher.match(filename)
+        if agency_code is None:
+            return None
+        try:
+            stat = os.stat(os.path.join(self.folder, filename))
+        except OSError:
+            # Ya no existe (p. ej. un evento atrasado de un archivo borrado)
+            self.remove(path)
+            return None
+        entry = self._entry(agency_code, filename, stat)
+        with self._lock:
+            known = self._files.get(filename)
+            if digest:
+                entry['hash'] = digest
+            elif known and (known['size'], known['mtime']) == (entry['size'], entry['mtime']):
+                entry['hash'] = known['hash']
+            self._discard(filename)
+            self._files[filename] = entry
+            self._candidates.setdefault(agency_code, set()).add(filename)
+            self._choose(agency_code)
+        return dict(entry)
+
+    def remove(self, path: str) -> Optional[str]:
+        """
+        Quita un PDF del índice (borrado o movido fuera de la carpeta) y
+        devuelve el código de agencia con el que estaba indexado
+        """
+        with self._lock:
+            return self._discard(os.path.basename(path))
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._candidates.clear()
+            self._entries.clear()
+
+    def conflicts(self, agency_codes=None) -> Dict[str, List[str]]:
+        """
+        Agencias con más de un PDF: código -> archivos, primero el elegido
+        Args:
+            agency_codes: Limitar a estos códigos (p. ej. los de un lote)
+        """
+        with self._lock:
+            codes = self._candidates if agency_codes is None else agency_codes
+            result = {}
+            for agency_code in codes:
+                filenames = self._candidates.get(agency_code, ())
+                if len(filenames) > 1:
+                    chosen = self._entries[agency_code]['filename']
+                    result[agency_code] = [chosen] + sorted(name for name in filenames if name != chosen)
+            return result
+
+    def get(self, agency_code: str) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(agency_code)
+            return dict(entry) if entry else None
+
+    def exists(self, agency_code: str) -> bool:
+        with self._lock:
+            return agency_code in self._entries
+
+    def path(self, agency_code: str) -> Optional[str]:
+        entry = self.get(agency_code)
+        return entry['path'] if entry else None
+
+    def size(self, agency_code: str) -> Optional[int]:
+        entry = self.get(agency_code)
+        return entry['size'] if entry else None
+
+    def has_file(self, filename: str) -> bool:
+        with self._lock:
+            return filename in self._files
+
+    def agency_code(self, filename: str) -> Optional[str]:
+        """Código de agencia con el que está indexado un archivo"""
+        with self._lock:
+            entry = self._files.get(filename)
+            return entry['agency_code'] if entry else None
+
+    def agency_codes(self) -> List[str]:
+        with self._lock:
+            return sorted(self._entries)
+
+    def filenames(self) -> List[str]:
+        """Todos los PDFs de la carpeta, incluidos los duplicados no elegidos"""
+        with self._lock:
+            return sorted(self._files)
+
+    def file_hash(self, agency_code: str) -> Optional[str]:
+        """SHA-256 del PDF, calculado una vez por versión del archivo"""
+        entry = self.get(agency_code)
+        if entry is None:
+            return None
+        if entry['hash'] is not None:
+            return entry['hash']
+        digest = hashlib.sha256()
+        with open(entry['path'], 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        with self._lock:
+            known = self._files.get(entry['filename'])
+            if known and (known['size'], known['mtime']) == (entry['size'], entry['mtime']):
+                known['hash'] = digest.hexdigest()
+        return digest.hexdigest()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
@@ -0,0 +1,66 @@
+import os
+import zipfile
+from contextlib import ExitStack, nullcontext
+from typing import Dict, List, Tuple
+from agency_matcher import is_pdf_filename
+from pdf_store import PDFStore
+
+
+def zip_pdf_entries(archive: zipfile.ZipFile) -> List[Tuple[str, zipfile.ZipInfo]]:
+    """
+    PDFs de un ZIP (nombre, entrada), para leerlos como streams sin extraerlo
+    completo a disco. Solo se usa el nombre base de cada entrada (ignora
+    carpetas y rutas como '../'), y se omiten los metadatos de macOS.
+    """
+    entries = []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        filename = os.path.basename(info.filename.replace('\\', '/'))
+        if filename.startswith('._') or '__MACOSX/' in info.filename:
+            continue
+        if not is_pdf_filename(filename):
+            continue
+        entries.append((filename, info))
+    return entries
+
+
+def ingest_files(files, store: PDFStore) -> Tuple[List[Dict], List[str]]:
+    """
+    Guarda en el almacén de uploads los PDFs subidos y los PDFs contenidos en
+    archivos .zip, en streaming y con el hash de cada uno
+    Args:
+        files: Archivos subidos (FileStorage de Werkzeug)
+        store (PDFStore): Almacén de la carpeta de uploads
+    Returns:
+        tuple: (guardados, errores); cada guardado es el resultado de
+               PDFStore.save (changed=False si el contenido no cambió)
+    """
+    saved, errors = [], []
+    with ExitStack() as stack:
+        # Primero se listan todos los PDFs del lote, para consultar su
+        # registro en el almacén de una sola vez
+        sources = []
+        for file in files:
+            if not file or file.filename == '':
+                continue
+            filename = os.path.basename(file.filename)
+            if filename.lower().endswith('.zip'):
+                try:
+                    archive = stack.enter_context(zipfile.ZipFile(file.stream))
+                except zipfile.BadZipFile as e:
+                    errors.append(f"Error al procesar {filename}: ZIP no válido ({str(e)})")
+                    continue
+                sources.extend((member_name, lambda archive=archive, info=info: archive.open(info))
+                               for member_name, info in zip_pdf_entries(archive))
+            elif is_pdf_filename(filename):
+                sources.append((filename, lambda file=file: nullcontext(file.stream)))
+
+        known = store.known_files(filename for filename, _ in sources) if sources else {}
+        for filename, open_source in sources:
+            try:
+                with open_source() as source:
+                    saved.append(store.save(source, filename, known))
+            except Exception as e:
+                errors.append(f"Error al procesar {filename}: {str(e)}")
+    return saved, errors
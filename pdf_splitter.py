@@ -0,0 +1,192 @@
+import io
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from pdf_store import PDFStore
+
+try:
+    # pypdf solo hace falta para dividir PDFs combinados; es opcional
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = None
+    PdfWriter = None
+
+# Páginas por tarea al buscar los códigos de agencia en el texto
+TEXT_CHUNK_PAGES = 250
+
+
+def parse_page_spec(spec: str) -> List[int]:
+    """Páginas base 1 ('1-3; 7') -> índices base 0 ([0, 1, 2, 6])"""
+    pages = []
+    for part in re.split(r'[;\s]+', spec.strip()):
+        if not part:
+            continue
+        start, _, stop = part.partition('-')
+        start, stop = int(start), int(stop or start)
+        if start < 1 or stop < start:
+            raise ValueError(f"Rango de páginas no válido: {part}")
+        pages.extend(range(start - 1, stop))
+    return pages
+
+
+def parse_page_mapping(text: str) -> Dict[int, str]:
+    """
+    Lee el mapeo página -> agencia: una línea por agencia con sus páginas
+    (base 1, rangos '1-3' separados por ';' o espacios) y el código de agencia,
+    separados por coma o tabulador. Se ignora una fila de encabezado.
+    Returns:
+        dict: índice de página (base 0) -> código de agencia
+    """
+    mapping = {}
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        fields = re.split(r'[,\t]', line, maxsplit=1)
+        spec = fields[0].strip()
+        agency_code = fields[1].strip() if len(fields) > 1 else ''
+        if not spec[:1].isdigit():
+            if line_number == 1:
+                continue
+            raise ValueError(f"Línea {line_number}: páginas no válidas ({spec})")
+        if not agency_code:
+            raise ValueError(f"Línea {line_number}: falta el código de agencia")
+        for page in parse_page_spec(spec):
+            if mapping.get(page, agency_code) != agency_code:
+                raise ValueError(f"Línea {line_number}: la página {page + 1} ya está asignada a {mapping[page]}")
+            mapping[page] = agency_code
+    return mapping
+
+
+def _agency_from_match(match) -> Optional[str]:
+    if match is None:
+        return None
+    if 'agency' in match.re.groupindex:
+        return match.group('agency')
+    return match.group(1) if match.re.groups else match.group(0)
+
+
+def _find_codes(path: str, start: int, stop: int, pattern: str) -> List[Optional[str]]:
+    """Código de agencia encontrado en el texto de cada página de [start, stop)"""
+    reader = PdfReader(path)
+    regex = re.compile(pattern)
+    return [_agency_from_match(regex.search(reader.pages[index].extract_text() or ''))
+            for index in range(start, stop)]
+
+
+def _write_agencies(path: str, groups: List[Tuple[str, List[int]]], store: PDFStore,
+                    known: Dict[str, Dict]) -> Tuple[List[Dict], List[str]]:
+    """
+    Escribe en el almacén un PDF por agencia con sus páginas del PDF combinado.
+    known es el registro del almacén de esos archivos (ver PDFStore.known_files),
+    así los procesos no consultan la base de datos
+    """
+    reader = PdfReader(path)
+    saved, errors = [], []
+    for agency_code, pages in groups:
+        try:
+            writer = PdfWriter()
+            for index in pages:
+                writer.add_page(reader.pages[index])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            buffer.seek(0)
+            saved.append(store.save(buffer, f"{agency_code}.pdf", known))
+        except Exception as e:
+            errors.append(f"Error al generar {agency_code}.pdf: {str(e)}")
+    return saved, errors
+
+
+class PDFSplitter:
+    """
+    Divide el PDF combinado que exporta contabilidad (las páginas de todas las
+    agencias) en un {Agency Code}.pdf por agencia dentro del almacén de uploads.
+    Las páginas se asignan con un mapeo página -> agencia o con una expresión
+    regular buscada en el texto de cada página; una página sin coincidencia
+    pertenece a la misma agencia que la anterior (hojas de continuación).
+    La extracción de texto y la escritura de los PDFs se reparten en un
+    ProcessPoolExecutor; cada proceso abre el PDF combinado desde disco.
+    """
+
+    def __init__(self, store: PDFStore, workers: int = 0):
+        self.store = store
+        # 0 = todo en el proceso actual
+        self.workers = max(0, workers)
+
+    @staticmethod
+    def available() -> bool:
+        return PdfReader is not None
+
+    def _map(self, executor, fn, *iterables):
+        if executor is None:
+            return map(fn, *iterables)
+        return executor.map(fn, *iterables)
+
+    def pages_by_pattern(self, path: str, page_count: int, pattern: str, executor=None) -> Dict[int, str]:
+        """Asigna cada página a la agencia cuyo código aparece en su texto"""
+        starts = list(range(0, page_count, TEXT_CHUNK_PAGES))
+        stops = [min(start + TEXT_CHUNK_PAGES, page_count) for start in starts]
+        mapping, current, page = {}, None, 0
+        for codes in self._map(executor, _find_codes, [path] * len(starts), starts, stops, [pattern] * len(starts)):
+            for code in codes:
+                current = code or current
+                if current is not None:
+                    mapping[page] = current
+                page += 1
+        return mapping
+
+    def split(self, path: str, mapping: Dict[int, str] = None,
+              pattern: str = None) -> Tuple[List[Dict], List[str], int]:
+        """
+        Divide el PDF combinado de path
+        Args:
+            mapping (dict): Índice de página (base 0) -> código de agencia
+            pattern (str): Expresión regular con el código de agencia (grupo
+                           'agency', el primer grupo o la coincidencia completa)
+        Returns:
+            tuple: (guardados como en PDFStore.save, errores, páginas sin agencia)
+        """
+        if PdfReader is None:
+            raise RuntimeError("Dividir PDFs combinados requiere pypdf (pip install pypdf)")
+        if (mapping is None) == (pattern is None):
+            raise ValueError("Indique un mapeo de páginas o una expresión regular")
+        if pattern is not None:
+            re.compile(pattern)
+
+        page_count = len(PdfReader(path).pages)
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers else None
+        try:
+            if pattern is not None:
+                mapping = self.pages_by_pattern(path, page_count, pattern, executor)
+
+            groups: Dict[str, List[int]] = {}
+            invalid, out_of_range = set(), 0
+            for page, agency_code in sorted(mapping.items()):
+                if page >= page_count:
+                    out_of_range += 1
+                elif not agency_code or os.path.basename(agency_code) != agency_code or agency_code in ('.', '..'):
+                    invalid.add(agency_code)
+                else:
+                    groups.setdefault(agency_code, []).append(page)
+            unassigned = page_count - sum(len(pages) for pages in groups.values())
+            errors = [f"Código de agencia no válido: {agency_code}" for agency_code in sorted(invalid)]
+            if out_of_range:
+                errors.append(f"{out_of_range} páginas del mapeo no existen (el PDF tiene {page_count})")
+
+            # Varias agencias por tarea para no abrir el PDF una vez por agencia
+            items = list(groups.items())
+            chunk = max(1, len(items) // (max(1, self.workers) * 4))
+            batches = [items[i:i + chunk] for i in range(0, len(items), chunk)]
+            # Registro del almacén de todas las agencias en una sola consulta
+            known = self.store.known_files(f"{agency_code}.pdf" for agency_code in groups) if groups else {}
+            batch_known = [{f"{agency_code}.pdf": known[f"{agency_code}.pdf"] for agency_code, _ in batch
+                            if f"{agency_code}.pdf" in known} for batch in batches]
+            saved = []
+            for batch_saved, batch_errors in self._map(executor, _write_agencies, [path] * len(batches),
+                                                       batches, [self.store] * len(batches), batch_known):
+                saved.extend(batch_saved)
+                errors.extend(batch_errors)
+            return saved, errors, unassigned
+        finally:
+            if executor is not None:
+                executor.shutdown()
@@ -0,0 +1,233 @@
+import os
+import uuid
+import shutil
+import hashlib
+import stat as stat_module
+from typing import Dict, List, Optional, Tuple
+from agency_matcher import AgencyMatcher
+from database import DatabaseManager
+
+# Tamaño de bloque al copiar (y hashear) cada archivo
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _HashingWriter:
+    """Archivo de destino que calcula el SHA-256 de lo que se escribe"""
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+
+def stored_rows(saved: List[Dict]) -> List[Tuple[str, str, int, int]]:
+    """
+    Filas de pdf_store_files (archivo, hash, tamaño, mtime) de los resultados
+    de PDFStore.save / adopt que aún no están registradas, para escribirlas en
+    la misma transacción que vincula el lote (ver apply_pdf_changes)
+    """
+    return [(result['filename'], result['hash'], result['size'], result['mtime'])
+            for result in saved if not result['recorded']]
+
+
+def _force(path: str, operation):
+    """
+    Ejecuta operation() y, si falla porque path es de solo lectura (Windows no
+    reemplaza ni borra esos archivos), vuelve escribible path y reintenta. En
+    POSIX nunca hace falta.
+    """
+    try:
+        operation()
+    except PermissionError:
+        os.chmod(path, stat_module.S_IREAD | stat_module.S_IWRITE)
+        operation()
+
+
+class PDFStore:
+    """
+    Almacén de PDFs direccionado por contenido dentro de uploads/. Cada
+    contenido se guarda una vez como blob (.blobs/<sha256>.pdf, de solo
+    lectura) y uploads/<archivo>.pdf es un hardlink a ese blob: dos agencias
+    con el mismo PDF comparten el archivo y un cambio escribe el PDF una sola
+    vez. Como el archivo es de solo lectura, no se puede sobrescribir en el
+    lugar (lo que alteraría el blob); reemplazarlo crea un archivo nuevo. Si la
+    carpeta no admite hardlinks, el archivo es una copia del blob.
+    pdf_store_files registra el hash de cada archivo junto con su tamaño y
+    mtime; una re-subida idéntica se detecta por el hash y no reescribe el
+    archivo (no dispara eventos del watcher ni vuelve a vincular). Las filas
+    no se escriben aquí: save y adopt las devuelven y quien vincula el lote
+    las guarda en su transacción (ver stored_rows).
+    """
+
+    def __init__(self, folder: str, blob_folder: str = None, matcher: AgencyMatcher = None,
+                 db_name: str = 'clients.db'):
+        self.folder = folder
+        # Carpeta oculta: ni el índice ni el watcher miran subcarpetas
+        self.blob_folder = blob_folder or os.path.join(folder, '.blobs')
+        self.matcher = matcher or AgencyMatcher()
+        self.db_name = db_name
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_folder, f"{digest}.pdf")
+
+    def _temp_path(self, folder: str, name: str) -> str:
+        # Sin extensión .pdf: el watcher ignora los temporales
+        return os.path.join(folder, f".{name}.{uuid.uuid4().hex}.part")
+
+    def _valid_blob(self, blob: str, size: int) -> bool:
+        try:
+            stat = os.stat(blob)
+        except OSError:
+            return False
+        # Un blob que dejó de ser de solo lectura se pudo modificar a través
+        # de uno de sus enlaces, así que se reemplaza
+        return stat.st_size == size and not stat.st_mode & 0o222
+
+    def _write_blob(self, source) -> Tuple[str, int]:
+        """Copia source a su blob calculando el hash en la misma pasada"""
+        os.makedirs(self.blob_folder, exist_ok=True)
+        temp_path = self._temp_path(self.blob_folder, 'blob')
+        try:
+            with open(temp_path, 'wb') as f:
+                writer = _HashingWriter(f)
+                shutil.copyfileobj(source, writer, COPY_BLOCK_SIZE)
+            digest = writer.digest.hexdigest()
+            blob = self.blob_path(digest)
+            if self._valid_blob(blob, writer.size):
+                os.remove(temp_path)
+            else:
+                os.chmod(temp_path, stat_module.S_IREAD)
+                _force(blob, lambda: os.replace(temp_path, blob))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest, writer.size
+
+    def known_files(self, filenames) -> Dict[str, Dict]:
+        """Registro de pdf_store_files de varios archivos, en una sola consulta"""
+        return DatabaseManager(self.db_name).get_stored_pdfs(filenames)
+
+    def save(self, source, filename: str, known: Dict[str, Dict] = None) -> Dict:
+        """
+        Guarda un PDF desde un stream, calculando su hash en la misma pasada
+        Args:
+            known (dict): Registro de los archivos del lote (ver known_files);
+                          sin él se consulta el de este archivo
+        Returns:
+            dict: filename, agency_code, path, size, mtime, hash, changed
+                  (False si el archivo ya tenía exactamente ese contenido) y
+                  recorded (True si pdf_store_files ya tiene esa versión)
+        """
+        digest, size = self._write_blob(source)
+        path = os.path.join(self.folder, filename)
+        if known is None:
+            known = self.known_files([filename])
+        row = known.get(filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        changed = not self._same_content(path, stat, row, digest, size)
+        if changed:
+            self._link(self.blob_path(digest), path)
+            stat = os.stat(path)
+        return {'filename': filename, 'agency_code': self.matcher.match(filename), 'path': path,
+                'size': size, 'mtime': stat.st_mtime_ns, 'hash': digest, 'changed': changed,
+                'recorded': self._recorded(row, digest, stat)}
+
+    @staticmethod
+    def _recorded(row: Optional[Dict], digest: str, stat) -> bool:
+        return row is not None and (row['hash'], row['size'], row['mtime']) == (
+            digest, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def _same_content(path: str, stat, row: Optional[Dict], digest: str, size: int) -> bool:
+        """Indica si el archivo de uploads ya tiene ese contenido, sin leerlo si es posible"""
+        if stat is None or stat.st_size != size:
+            return False
+        # Si no cambió desde que se registró, vale el hash registrado
+        if row and (row['size'], row['mtime']) == (stat.st_size, stat.st_mtime_ns):
+            return row['hash'] == digest
+        return file_sha256(path) == digest
+
+    def _link(self, blob: str, path: str):
+        """Reemplaza path por un enlace al blob (o una copia) de forma atómica"""
+        temp_path = self._temp_path(self.folder, os.path.basename(path))
+        try:
+            try:
+                os.link(blob, temp_path)
+            except OSError:
+                # Otro sistema de archivos, o sin soporte de hardlinks
+                shutil.copyfile(blob, temp_path)
+            _force(path, lambda: os.replace(temp_path, path))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def adopt(self, path: str, digest: str = None, known: Dict[str, Dict] = None) -> Optional[Dict]:
+        """
+        Toma en cuenta un PDF copiado directamente a uploads/ (sin reescribirlo
+        ni copiarlo al almacén: el archivo es de quien lo copió). Devuelve su
+        registro como en save, o None si el archivo ya no existe.
+        Args:
+            digest (str): Hash ya conocido del archivo (p. ej. del índice)
+            known (dict): Registro de los archivos del lote (ver known_files)
+        """
+        filename = os.path.basename(path)
+        try:
+            stat = os.stat(path)
+            if known is None:
+                known = self.known_files([filename])
+            row = known.get(filename)
+            if not digest:
+                if row and (row['size'], row['mtime']) == (stat.st_size, stat.st_mtime_ns):
+                    digest = row['hash']
+                else:
+                    digest = file_sha256(path)
+        except OSError:
+            return None
+        return {'filename': filename, 'agency_code': self.matcher.match(filename), 'path': path,
+                'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest,
+                'recorded': self._recorded(row, digest, stat)}
+
+    def remove(self, path: str):
+        """Borra un archivo de uploads (es de solo lectura si es un enlace a un blob)"""
+        _force(path, lambda: os.remove(path))
+
+    def prune(self) -> int:
+        """
+        Elimina los blobs que ya no tiene ningún archivo de uploads según
+        pdf_store_files. Devuelve cuántos borró. Un archivo enlazado a un blob
+        borrado conserva su contenido (solo se quita el nombre del blob).
+        """
+        removed = 0
+        if not os.path.isdir(self.blob_folder):
+            return removed
+        with os.scandir(self.folder) as scan:
+            filenames = [item.name for item in scan if item.is_file()]
+        in_use = DatabaseManager(self.db_name).sync_stored_pdfs(filenames)
+        with os.scandir(self.blob_folder) as scan:
+            for item in scan:
+                if not item.name.endswith('.pdf') or item.name[:-4] in in_use:
+                    continue
+                try:
+                    self.remove(item.path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
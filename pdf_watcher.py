@@ -0,0 +1,153 @@
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Segundos sin cambios de tamaño ni mtime para dar por terminada la copia
+SETTLE_SECONDS = 2.0
+# Espera máxima de un lote antes de aplicarlo, aunque sigan llegando archivos
+MAX_BATCH_DELAY = 5.0
+# Archivos por lote (una transacción por lote)
+MAX_BATCH_SIZE = 1000
+
+
+class PDFEventBatcher:
+    """
+    Junta los eventos del watcher en lotes acotados por tiempo y tamaño.
+    Un archivo creado o modificado se considera listo cuando su tamaño y
+    mtime no cambiaron durante `settle_seconds` (así no se vincula un PDF a
+    medio copiar); los borrados se aplican en el siguiente lote. Cada lote se
+    entrega a `apply_batch(created, deleted)` desde un hilo propio, de modo
+    que miles de archivos se resuelven con pocas transacciones.
+    """
+
+    def __init__(self, apply_batch: Callable[[List[str], List[str]], None],
+                 settle_seconds: float = SETTLE_SECONDS, max_delay: float = MAX_BATCH_DELAY,
+                 max_batch: int = MAX_BATCH_SIZE, poll_interval: float = 0.5):
+        self.apply_batch = apply_batch
+        self.settle_seconds = settle_seconds
+        self.max_delay = max_delay
+        self.max_batch = max(1, max_batch)
+        self.poll_interval = poll_interval
+        self._condition = threading.Condition()
+        # ruta -> (tamaño, mtime, desde cuándo no cambia); None hasta el primer stat
+        self._unsettled: Dict[str, Tuple[Optional[int], Optional[int], float]] = {}
+        # Dicts como conjuntos ordenados por llegada
+        self._settled: Dict[str, None] = {}
+        self._deleted: Dict[str, None] = {}
+        self._batch_started = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='pdf-event-batcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Detiene el hilo aplicando lo que ya estaba listo"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def created(self, path: str):
+        """Archivo nuevo o modificado: esperar a que termine de escribirse"""
+        with self._condition:
+            idle = self._idle()
+            self._deleted.pop(path, None)
+            self._settled.pop(path, None)
+            self._unsettled[path] = (None, None, time.monotonic())
+            if idle:
+                self._condition.notify()
+
+    modified = created
+
+    def deleted(self, path: str):
+        with self._condition:
+            idle = self._idle()
+            self._unsettled.pop(path, None)
+            self._settled.pop(path, None)
+            self._deleted[path] = None
+            if self._batch_started is None:
+                self._batch_started = time.monotonic()
+            if idle:
+                self._condition.notify()
+
+    def moved(self, src_path: Optional[str], dest_path: Optional[str]):
+        """
+        Renombrado: el origen deja de existir y el destino es nuevo. Cualquiera
+        de los dos es None si no es un PDF de la carpeta (p. ej. el temporal
+        .part que el almacén renombra a <agencia>.pdf)
+        """
+        if src_path:
+            self.deleted(src_path)
+        if dest_path:
+            self.created(dest_path)
+
+    def _idle(self) -> bool:
+        # Solo se despierta al hilo si estaba sin trabajo; con una ráfaga de
+        # eventos, los archivos se revisan cada poll_interval y no por evento
+        return not (self._unsettled or self._settled or self._deleted)
+
+    def _check_settled(self):
+        """Revisa fuera del lock los archivos que aún se están escribiendo"""
+        with self._condition:
+            candidates = list(self._unsettled.items())
+        now = time.monotonic()
+        for path, state in candidates:
+            try:
+                stat = os.stat(path)
+                current = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = None
+            with self._condition:
+                # Si llegó un evento nuevo mientras tanto, se revisa en la próxima vuelta
+                if self._unsettled.get(path) is not state:
+                    continue
+                if current is None:
+                    # Desapareció antes de asentarse; el borrado llega como evento
+                    del self._unsettled[path]
+                elif current != state[:2]:
+                    self._unsettled[path] = (current[0], current[1], now)
+                elif now - state[2] >= self.settle_seconds:
+                    del self._unsettled[path]
+                    self._settled[path] = None
+                    if self._batch_started is None:
+                        self._batch_started = now
+
+    def _take_batch(self, force: bool = False):
+        with self._condition:
+            ready = len(self._settled) + len(self._deleted)
+            if not ready:
+                return None
+            # Se aplica si el lote está lleno, si no queda nada por asentarse
+            # o si el lote más antiguo ya esperó max_delay
+            if not (force or ready >= self.max_batch or not self._unsettled
+                    or time.monotonic() - self._batch_started >= self.max_delay):
+                return None
+            created = list(self._settled)[:self.max_batch]
+            deleted = list(self._deleted)[:self.max_batch - len(created)]
+            for path in created:
+                del self._settled[path]
+            for path in deleted:
+                del self._deleted[path]
+            self._batch_started = time.monotonic() if (self._settled or self._deleted) else None
+            return created, deleted
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopped and self._idle():
+                    self._condition.wait()
+                stopped = self._stopped
+            self._check_settled()
+            batch = self._take_batch(force=stopped)
+            while batch:
+                try:
+                    self.apply_batch(*batch)
+                except Exception as e:
+                    print(f"Error al aplicar lote de PDFs: {str(e)}")
+                batch = self._take_batch(force=stopped)
+            if stopped:
+                return
+            with self._condition:
+                self._condition.wait(self.poll_interval)
@@ -0,0 +1,135 @@
+import re
+import time
+import asyncio
+from typing import Dict, Optional
+
+# Unidades aceptadas en la especificación de límites, en segundos
+RATE_UNITS = {
+    's': 1, 'sec': 1, 'seg': 1, 'second': 1, 'segundo': 1,
+    'm': 60, 'min': 60, 'minute': 60, 'minuto': 60,
+    'h': 3600, 'hour': 3600, 'hora': 3600,
+    'd': 86400, 'day': 86400, 'dia': 86400
+}
+
+# Sin límites por defecto: se activan con SEND_RATE_LIMITS o el parámetro rate_limits
+DEFAULT_RATE_LIMITS = ''
+
+
+class TokenBucket:
+    """
+    Token bucket: cada envío toma un token. Consultar la espera no consume,
+    así quien espera presupuesto no acumula reservas que luego salen juntas.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate  # tokens por segundo
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float = None) -> float:
+        """Segundos hasta que haya un token disponible (sin consumirlo)"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Consume un token (llamar solo si wait_time() devolvió 0)"""
+        self.tokens -= 1
+
+
+def parse_rate(value: str) -> float:
+    """
+    Convierte '20/min', '5/s' o '1000/h' en tokens por segundo
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*/\s*(\d*)\s*([^\d\s]+)\s*', value)
+    if not match:
+        raise ValueError(f"Límite de envío no válido: {value!r}")
+    amount, multiplier, unit = match.groups()
+    unit = unit.lower().replace('í', 'i')
+    if unit not in RATE_UNITS and unit.endswith('s'):
+        unit = unit[:-1]
+    if unit not in RATE_UNITS:
+        raise ValueError(f"Unidad de tiempo no válida en {value!r}")
+    rate = float(amount) / (RATE_UNITS[unit] * (int(multiplier) if multiplier else 1))
+    if rate <= 0:
+        raise ValueError(f"El límite debe ser mayor que cero: {value!r}")
+    return rate
+
+
+def parse_rate_limits(spec: str) -> Dict[str, float]:
+    """
+    Interpreta una especificación como "gmail.com: 20/min, default: 100/min"
+    Returns:
+        dict: dominio -> tokens por segundo (la clave 'default' aplica al resto;
+              sin ella, los dominios no listados no tienen límite)
+    """
+    limits = {}
+    for entry in (spec or '').replace(';', ',').split(','):
+        if not entry.strip():
+            continue
+        if ':' not in entry:
+            raise ValueError(f"Entrada de límite no válida (se espera 'dominio: N/min'): {entry!r}")
+        domain, rate = entry.split(':', 1)
+        limits[domain.strip().lower()] = parse_rate(rate)
+    return limits
+
+
+class DomainRateLimiter:
+    """
+    Limitador de envíos por dominio del destinatario.
+    Cada dominio tiene su propio token bucket, de modo que los correos a
+    dominios distintos salen en paralelo, cada uno dentro de su presupuesto.
+    Los dominios sin límite (ni propio ni 'default') no esperan.
+    """
+
+    def __init__(self, limits: Dict[str, float]):
+        self.limits = dict(limits)
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    @classmethod
+    def from_spec(cls, spec: str = None):
+        return cls(parse_rate_limits(spec or DEFAULT_RATE_LIMITS))
+
+    @staticmethod
+    def domains_of(email: str):
+        """Dominios distintos de uno o varios correos separados por ';' o ','"""
+        domains = []
+        for address in re.split(r'[;,]', email or ''):
+            domain = address.rsplit('@', 1)[-1].strip().lower() if '@' in address else ''
+            if domain not in domains:
+                domains.append(domain)
+        return domains or ['']
+
+    def bucket_for(self, domain: str) -> Optional[TokenBucket]:
+        """Token bucket del dominio, o None si el dominio no tiene límite"""
+        if domain not in self.buckets:
+            rate = self.limits.get(domain, self.limits.get('default'))
+            self.buckets[domain] = TokenBucket(rate) if rate else None
+        return self.buckets[domain]
+
+    def wait_time(self, email: str) -> float:
+        """Segundos hasta que todos los dominios del destinatario tengan presupuesto"""
+        buckets = [self.bucket_for(domain) for domain in self.domains_of(email)]
+        return max([bucket.wait_time() for bucket in buckets if bucket is not None], default=0.0)
+
+    def try_acquire(self, email: str) -> bool:
+        """Toma un token en cada dominio del destinatario si todos tienen; si no, no toma ninguno"""
+        if self.wait_time(email) > 0:
+            return False
+        for domain in self.domains_of(email):
+            bucket = self.bucket_for(domain)
+            if bucket is not None:
+                bucket.take()
+        return True
+
+    async def wait(self, email: str):
+        """Espera hasta que los dominios del destinatario tengan presupuesto (sin reservarlo)"""
+        while True:
+            delay = self.wait_time(email)
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
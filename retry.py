@@ -0,0 +1,93 @@
+import heapq
+import random
+import asyncio
+import itertools
+
+
+class RetryPolicy:
+    """
+    Backoff exponencial con jitter para reintentos de envío.
+    La espera del intento n es base_delay * 2**(n-1), limitada a max_delay;
+    la mitad es fija y la otra mitad aleatoria para que los reintentos de
+    muchos destinatarios no lleguen al relay todos a la vez.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 30,
+                 max_delay: float = 1800, jitter: float = 0.5):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt: int) -> float:
+        """Segundos de espera antes del intento `attempt` + 1 (attempt >= 1)"""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+    def should_retry(self, attempt: int) -> bool:
+        """Indica si quedan intentos después de `attempt` intentos fallidos"""
+        return attempt < self.max_attempts
+
+
+class RetryScheduler:
+    """
+    Agenda de reintentos en una cola de prioridad ordenada por hora de
+    vencimiento. Un único temporizador despierta a cada reintento en su
+    momento, en lugar de mantener un sleep independiente por destinatario.
+    """
+
+    def __init__(self, policy: RetryPolicy = None):
+        self.policy = policy or RetryPolicy()
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._timer = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, attempt: int) -> asyncio.Future:
+        """
+        Agenda un reintento según la política y devuelve un future que se
+        resuelve cuando vence
+        """
+        loop = asyncio.get_running_loop()
+        if self._timer is None or self._timer.done():
+            self._wakeup = asyncio.Event()
+            self._timer = loop.create_task(self._run_timer())
+
+        due = loop.time() + self.policy.delay(attempt)
+        future = loop.create_future()
+        heapq.heappush(self._heap, (due, next(self._counter), future))
+        # Despertar al temporizador si este reintento vence antes que los demás
+        if self._heap[0][2] is future:
+            self._wakeup.set()
+        return future
+
+    async def wait(self, attempt: int):
+        """Espera hasta el momento del siguiente intento"""
+        await self.schedule(attempt)
+
+    async def _run_timer(self):
+        loop = asyncio.get_running_loop()
+        while self._heap:
+            due, _, future = self._heap[0]
+            timeout = due - loop.time()
+            if timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+
+    def cancel(self):
+        """Cancela los reintentos pendientes (al terminar la campaña)"""
+        if self._timer is not None:
+            self._timer.cancel()
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            future.cancel()
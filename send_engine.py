@@ -0,0 +1,531 @@
+import os
+import time
+import asyncio
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List
+from database import DatabaseManager, BatchWriter
+from rate_limiter import DomainRateLimiter
+from mailer import TransientSendError, PermanentSendError, render_message, init_render_worker
+from retry import RetryPolicy, RetryScheduler
+
+# Tamaño máximo de los PDFs de un envío agrupado. El base64 agrega ~33%, así
+# que 15 MB de PDFs quedan por debajo del límite habitual de 20-25 MB por mensaje
+DEFAULT_MAX_ATTACHMENT_BYTES = 15 * 1024 * 1024
+
+
+def create_render_executor(workers: int, attachment_cache=None) -> ProcessPoolExecutor:
+    """
+    Crea el pool de procesos de render. Cada proceso configura su caché de
+    adjuntos con el tamaño y la carpeta de desborde de attachment_cache (la
+    del backend SMTP), así respeta ATTACHMENT_CACHE_MB y ATTACHMENT_CACHE_FOLDER
+    """
+    initargs = ()
+    if attachment_cache is not None:
+        initargs = (attachment_cache.max_bytes, attachment_cache.spill_folder)
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker, initargs=initargs)
+
+
+class AIMDController:
+    """
+    Control adaptativo de concurrencia (aumento aditivo, disminución
+    multiplicativa). Cada ventana de envíos exitosos sube el límite en uno; un
+    rechazo temporal del servidor lo reduce a la mitad. Solo se aplica una
+    reducción por ventana: los rechazos de envíos que empezaron antes del
+    último recorte no vuelven a recortar.
+    """
+
+    def __init__(self, initial: int = 1, minimum: int = 1, maximum: int = 4,
+                 increase: float = 1.0, decrease_factor: float = 0.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = None
+
+    async def acquire(self) -> float:
+        """Espera un lugar de envío; devuelve el instante de inicio"""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started: float, outcome: str):
+        """
+        Libera el lugar y ajusta el límite según el resultado
+        Args:
+            started (float): Valor devuelto por acquire()
+            outcome (str): 'success', 'deferred' o 'error' (los errores
+                           permanentes no cambian el límite); None si el
+                           lugar se devuelve sin haber enviado
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            if outcome == 'success':
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            elif outcome == 'deferred' and started >= self._last_decrease:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self._last_decrease = time.monotonic()
+            self._condition.notify_all()
+
+
+class RenderPipeline:
+    """
+    Etapa productora del envío: construye los mensajes en un pool de procesos
+    por delante de la etapa de envío. Como mucho `capacity` mensajes quedan
+    renderizados a la espera de salir, así que la memoria no crece con la
+    campaña y, mientras el transporte espera al servidor, la CPU ya prepara
+    los siguientes.
+    """
+
+    def __init__(self, executor: ProcessPoolExecutor, render_args, capacity: int):
+        self.executor = executor
+        # Función que recibe un envío y devuelve los argumentos de render_message
+        self.render_args = render_args
+        self.capacity = max(1, capacity)
+        self._slots = None
+        self._pending = {}
+        self._task = None
+
+    def start(self, units: List[Dict]):
+        """Empieza a renderizar los envíos en el orden en que se consumirán"""
+        loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.capacity)
+        self._pending = {id(unit): loop.create_future() for unit in units}
+        self._task = loop.create_task(self._produce(units))
+
+    async def _produce(self, units: List[Dict]):
+        loop = asyncio.get_running_loop()
+        for unit in units:
+            # Contrapresión: esperar a que la etapa de envío consuma
+            await self._slots.acquire()
+            target = self._pending[id(unit)]
+            rendered = loop.run_in_executor(self.executor, render_message, *self.render_args(unit))
+            rendered.add_done_callback(lambda done, target=target: self._resolve(target, done))
+
+    @staticmethod
+    def _resolve(target: asyncio.Future, done: asyncio.Future):
+        if target.done():
+            return
+        if done.cancelled():
+            target.cancel()
+        elif done.exception() is not None:
+            target.set_exception(done.exception())
+        else:
+            target.set_result(done.result())
+
+    async def get(self, unit: Dict) -> bytes:
+        """Espera el mensaje renderizado de un envío y libera su lugar"""
+        # Se quita de _pending después: el productor puede no haberlo alcanzado aún
+        target = self._pending[id(unit)]
+        try:
+            return await target
+        finally:
+            del self._pending[id(unit)]
+            self._slots.release()
+
+    async def render(self, unit: Dict) -> bytes:
+        """Renderiza un envío fuera de la cola (p. ej. para un reintento)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, render_message, *self.render_args(unit))
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+        for target in self._pending.values():
+            target.cancel()
+
+
+class SendEngine:
+    """
+    Motor de envío asíncrono para campañas masivas.
+    Mantiene hasta `concurrency` correos en vuelo al mismo tiempo. Los envíos
+    al mismo destinatario se hacen en orden y de uno en uno; los de
+    destinatarios distintos avanzan en paralelo. El ritmo por dominio lo
+    controla un DomainRateLimiter: la espera por presupuesto no ocupa un
+    lugar de envío, así que otros dominios siguen saliendo mientras tanto.
+    El número de envíos en vuelo lo ajusta un AIMDController según las
+    respuestas del servidor, hasta un máximo de `concurrency`. Los fallos
+    reintentables se reagendan con backoff exponencial en un RetryScheduler;
+    al agotar los intentos el destinatario pasa a la tabla dead_letters.
+    Con `coalesce` los clientes que comparten destinatario reciben un único
+    correo con todos sus PDFs (hasta `max_attachment_bytes` por mensaje); el
+    resultado se registra por cada código de agencia.
+    Si el backend lo admite (SMTP) y `render_workers` > 0, los mensajes se
+    construyen en un RenderPipeline con hasta `prefetch` mensajes por delante.
+    """
+
+    def __init__(self, mailer, upload_folder: str, concurrency: int = 4,
+                 save_as_draft: bool = False, template: Dict = None,
+                 status: Dict = None, rate_limiter: DomainRateLimiter = None,
+                 db_name: str = 'clients.db', on_result=None,
+                 initial_concurrency: int = None, retry_policy: RetryPolicy = None,
+                 job_id=None, writer: BatchWriter = None, coalesce: bool = False,
+                 max_attachment_bytes: int = DEFAULT_MAX_ATTACHMENT_BYTES,
+                 render_workers: int = 0, prefetch: int = None, pdf_index=None,
+                 render_executor: ProcessPoolExecutor = None):
+        self.mailer = mailer
+        self.upload_folder = upload_folder
+        # Algunos backends (Outlook) no admiten envíos en paralelo
+        self.concurrency = max(1, min(concurrency, getattr(mailer, 'max_concurrency', concurrency)))
+        self.save_as_draft = save_as_draft
+        self.template = template
+        self.status = status if status is not None else {}
+        self.rate_limiter = rate_limiter or DomainRateLimiter.from_spec()
+        self.db_name = db_name
+        # Callback opcional por destinatario (se llama en el hilo de envío)
+        self.on_result = on_result
+        self.controller = AIMDController(
+            initial=initial_concurrency or max(1, self.concurrency // 4),
+            maximum=self.concurrency)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.job_id = job_id
+        # Los resultados se escriben en lotes; si no se recibe un writer se
+        # crea uno propio que se cierra al terminar la campaña
+        self.writer = writer
+        self._owns_writer = writer is None
+        self.coalesce = coalesce
+        self.max_attachment_bytes = max_attachment_bytes
+        self.render_workers = render_workers if getattr(mailer, 'supports_prepared', False) else 0
+        self.prefetch = prefetch or 2 * self.concurrency
+        self.pipeline = None
+        # Pool de render compartido entre campañas (ver SendJobWorker); si no
+        # se recibe, la campaña crea uno propio y lo cierra al terminar
+        self.render_executor = render_executor
+        # Índice en memoria de uploads (PDFIndex); sin él se consulta el disco
+        self.pdf_index = pdf_index
+        # Columnas extra de cada cliente para la plantilla (agency_code -> JSON)
+        self.client_extras = {}
+
+        self.success_count = 0
+        self.error_count = 0
+        self.errors = []
+        self.deferred_count = 0
+        self.retry_count = 0
+        self.dead_letter_count = 0
+
+    def run(self, clients: List[Dict]) -> Dict:
+        """
+        Ejecuta la campaña completa y devuelve el resumen
+        Args:
+            clients (list): Clientes con las claves 'agency_code' y 'email'
+        """
+        self.status.update({
+            'is_sending': True,
+            'total': len(clients),
+            'current': 0,
+            'current_agency': '',
+            'in_flight': 0,
+            'concurrency_limit': int(self.controller.limit),
+            'deferred': 0,
+            'retries_scheduled': 0,
+            'errors': []
+        })
+        if self.writer is None:
+            self.writer = BatchWriter(self.db_name)
+        if self.template:
+            # Campos de combinación de toda la campaña en una sola consulta
+            self.client_extras = DatabaseManager(self.db_name).get_client_extras(
+                client['agency_code'] for client in clients)
+        units = self.coalesce_by_recipient(clients) if self.coalesce else clients
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='send')
+        render_executor = None
+        if self.render_workers > 0 and len(units) > 1:
+            render_executor = self.render_executor or create_render_executor(
+                min(self.render_workers, len(units)), getattr(self.mailer, 'attachment_cache', None))
+            self.pipeline = RenderPipeline(render_executor, self._render_args, self.prefetch)
+        try:
+            asyncio.run(self._run(units, executor))
+        finally:
+            if render_executor is not None:
+                if render_executor is not self.render_executor:
+                    render_executor.shutdown(wait=True, cancel_futures=True)
+                self.pipeline = None
+            # Liberar recursos del backend en el hilo de envío y en el actual
+            try:
+                executor.submit(self.mailer.close).result()
+            except Exception:
+                pass
+            executor.shutdown(wait=True)
+            self.mailer.close()
+            if self._owns_writer:
+                self.writer.close()
+            else:
+                self.writer.flush()
+            self.status['is_sending'] = False
+            self.status['current_agency'] = ''
+            self.status['in_flight'] = 0
+
+        return {
+            'success_count': self.success_count,
+            'error_count': self.error_count,
+            'deferred_count': self.deferred_count,
+            'retry_count': self.retry_count,
+            'dead_letter_count': self.dead_letter_count,
+            'errors': self.errors
+        }
+
+    @staticmethod
+    def group_by_recipient(clients: List[Dict]) -> List[List[Dict]]:
+        """Agrupa los clientes por destinatario conservando el orden original"""
+        groups = OrderedDict()
+        for client in clients:
+            key = (client.get('email') or '').strip().lower()
+            groups.setdefault(key, []).append(client)
+        return list(groups.values())
+
+    @staticmethod
+    def members(client: Dict) -> List[Dict]:
+        """Clientes incluidos en un envío (varios si es un envío agrupado)"""
+        return client.get('members') or [client]
+
+    def pdf_path(self, agency_code: str) -> str:
+        # Con índice, el archivo puede tener otro nombre (ver AgencyMatcher)
+        if self.pdf_index is not None:
+            path = self.pdf_index.path(agency_code)
+            if path is not None:
+                return path
+        return os.path.join(self.upload_folder, f"{agency_code}.pdf")
+
+    def pdf_size(self, agency_code: str):
+        """Tamaño del PDF de una agencia, o None si no existe"""
+        if self.pdf_index is not None:
+            return self.pdf_index.size(agency_code)
+        try:
+            return os.path.getsize(self.pdf_path(agency_code))
+        except OSError:
+            return None
+
+    def pdf_hash(self, agency_code: str):
+        """Versión (hash) del PDF de una agencia según el índice, si se conoce"""
+        if self.pdf_index is None:
+            return None
+        try:
+            return self.pdf_index.file_hash(agency_code)
+        except OSError:
+            return None
+
+    def coalesce_by_recipient(self, clients: List[Dict]) -> List[Dict]:
+        """
+        Junta en un solo envío a los clientes con el mismo destinatario, sin
+        superar max_attachment_bytes por mensaje (un PDF más grande que el
+        límite sale solo). Los clientes sin PDF quedan como envíos individuales
+        y fallan con el error habitual.
+        """
+        units = []
+
+        def flush(batch):
+            if len(batch) == 1:
+                units.append(batch[0])
+            elif batch:
+                units.append({
+                    'agency_code': ', '.join(client['agency_code'] for client in batch),
+                    'email': batch[0]['email'],
+                    'members': batch
+                })
+
+        for group in self.group_by_recipient(clients):
+            batch, batch_size = [], 0
+            for client in group:
+                size = self.pdf_size(client['agency_code'])
+                if size is None:
+                    units.append(client)
+                    continue
+                if batch and batch_size + size > self.max_attachment_bytes:
+                    flush(batch)
+                    batch, batch_size = [], 0
+                batch.append(client)
+                batch_size += size
+            flush(batch)
+        return units
+
+    def mail_client(self, client: Dict) -> Dict:
+        """
+        Cliente tal como lo recibe el backend; en un envío agrupado los campos
+        de la plantilla son los del primer cliente
+        """
+        first = self.members(client)[0]
+        return {'Agency Code': client['agency_code'], 'Report email': client['email'],
+                'extra': self.client_extras.get(first['agency_code'])}
+
+    def _render_args(self, client: Dict):
+        """Argumentos de render_message para un envío"""
+        pdf_paths = [self.pdf_path(member['agency_code']) for member in self.members(client)]
+        return (self.mailer.sender,
+                self.mail_client(client),
+                pdf_paths if len(pdf_paths) > 1 else pdf_paths[0],
+                self.template)
+
+    async def _run(self, clients: List[Dict], executor: ThreadPoolExecutor):
+        self.scheduler = RetryScheduler(self.retry_policy)
+        groups = self.group_by_recipient(clients)
+        if self.pipeline is not None:
+            # Orden de consumo aproximado: el primero de cada destinatario, luego el segundo...
+            self.pipeline.start([unit for row in itertools.zip_longest(*groups)
+                                 for unit in row if unit is not None])
+        try:
+            await asyncio.gather(*[self._send_group(group, executor) for group in groups])
+        finally:
+            self.scheduler.cancel()
+            if self.pipeline is not None:
+                self.pipeline.cancel()
+
+    async def _prepared_message(self, client: Dict, attempt: int):
+        """
+        Mensaje ya renderizado por el pipeline, o None para construirlo al enviar
+        (sin pipeline, o si el render falló: el envío informa el error habitual)
+        """
+        if self.pipeline is None:
+            return None
+        try:
+            if attempt == 1:
+                return await self.pipeline.get(client)
+            return await self.pipeline.render(client)
+        except Exception:
+            return None
+
+    async def _acquire_slot(self, email: str) -> float:
+        """
+        Espera presupuesto del dominio y un lugar de envío, en ese orden. La
+        espera por presupuesto no ocupa lugar (los demás dominios siguen
+        saliendo) y el token se toma recién con el lugar asegurado, así los
+        envíos que esperan lugar no acumulan tokens que luego salen juntos
+        """
+        while True:
+            await self.rate_limiter.wait(email)
+            started = await self.controller.acquire()
+            if self.rate_limiter.try_acquire(email):
+                return started
+            # Otro envío al mismo dominio tomó el token mientras se esperaba lugar
+            await self.controller.release(started, None)
+
+    async def _send_group(self, group: List[Dict], executor: ThreadPoolExecutor):
+        loop = asyncio.get_running_loop()
+        # Los correos de un mismo destinatario se envían en orden
+        for client in group:
+            attempt = 1
+            while True:
+                # Se espera el render antes de tomar presupuesto y lugar de envío
+                message = await self._prepared_message(client, attempt)
+                started = await self._acquire_slot(client['email'])
+                result = None
+                try:
+                    self.status['current_agency'] = client['agency_code']
+                    self.status['in_flight'] = self.controller.in_flight
+                    result = await loop.run_in_executor(executor, self._deliver, client, attempt, message)
+                finally:
+                    # Los rechazos temporales reducen la concurrencia
+                    if result is not None and result['success']:
+                        outcome = 'success'
+                    elif result is not None and result.get('deferred'):
+                        outcome = 'deferred'
+                    else:
+                        outcome = 'error'
+                    await self.controller.release(started, outcome)
+                    self.status['in_flight'] = self.controller.in_flight
+                    self.status['concurrency_limit'] = int(self.controller.limit)
+                if result['status'] != 'retry':
+                    break
+                # Fallo reintentable: reagendar con backoff exponencial
+                if result.get('deferred'):
+                    self.deferred_count += 1
+                    self.status['deferred'] = self.deferred_count
+                self.retry_count += 1
+                self.status['retries_scheduled'] = len(self.scheduler) + 1
+                await self.scheduler.wait(attempt)
+                self.status['retries_scheduled'] = len(self.scheduler)
+                attempt += 1
+            self._account(result)
+
+    def _deliver(self, client: Dict, attempt: int = 1, message: bytes = None) -> Dict:
+        """
+        Envía un correo y registra el resultado (se ejecuta en un hilo de envío)
+        """
+        result = self._send(client, message)
+        if result['status'] == 'error' and result.get('retryable'):
+            if self.retry_policy.should_retry(attempt):
+                for member in self.members(client):
+                    self.writer.add_log(member['agency_code'], 'send_email', 'retry',
+                                        f"Intento {attempt} fallido, se reintentará: {result['message']}")
+                result['status'] = 'retry'
+                return result
+            result['message'] = f"{result['message']} (tras {attempt} intentos)"
+            result['error'] = result['message']
+            # Solo un fallo reintentable que agotó los intentos pasa a dead_letters;
+            # los permanentes (5xx, PDF no encontrado) quedan como error común
+            result['dead_letter'] = True
+
+        # Registro, log, progreso del trabajo y dead letter van en el mismo lote;
+        # un envío agrupado deja una fila por código de agencia
+        for member in self.members(client):
+            self.writer.record_send(member['agency_code'], member['email'], result['status'], result['message'],
+                                    job_id=self.job_id, item_id=member.get('item_id'),
+                                    attempts=attempt if result.get('dead_letter') else None,
+                                    pdf_hash=self.pdf_hash(member['agency_code'])
+                                    if result['status'] == 'success' else None)
+        if self.on_result:
+            self.on_result(result)
+        return result
+
+    def _send(self, client: Dict, message: bytes = None) -> Dict:
+        agency_code = client['agency_code']
+        members = self.members(client)
+        pdf_paths = [self.pdf_path(member['agency_code']) for member in members]
+
+        missing = [member['agency_code'] for member in members if self.pdf_size(member['agency_code']) is None]
+        if missing:
+            error_msg = f"PDF no encontrado para {', '.join(missing)}"
+            return {'client': client, 'success': False, 'status': 'error',
+                    'message': error_msg, 'error': error_msg, 'retryable': False}
+
+        try:
+            mail_client = self.mail_client(client)
+            if message is not None:
+                self.mailer.send_prepared(mail_client, message, self.save_as_draft)
+            else:
+                self.mailer.send_email(mail_client, pdf_paths if len(pdf_paths) > 1 else pdf_paths[0],
+                                       self.save_as_draft, self.template)
+        except TransientSendError as e:
+            message = f"Envío diferido para {agency_code}: {str(e)}"
+            return {'client': client, 'success': False, 'status': 'error',
+                    'message': message, 'error': message, 'retryable': True, 'deferred': True}
+        except PermanentSendError as e:
+            error_msg = f"Error al procesar {agency_code}: {str(e)}"
+            return {'client': client, 'success': False, 'status': 'error',
+                    'message': error_msg, 'error': error_msg, 'retryable': False}
+        except Exception as e:
+            error_msg = f"Error al procesar {agency_code}: {str(e)}"
+            return {'client': client, 'success': False, 'status': 'error',
+                    'message': error_msg, 'error': error_msg, 'retryable': True}
+
+        status = 'draft' if self.save_as_draft else 'success'
+        message = 'Guardado como borrador' if self.save_as_draft else 'Correo enviado correctamente'
+        if len(members) > 1:
+            message += f" (envío agrupado de {len(members)} PDFs)"
+        return {'client': client, 'success': True, 'status': status,
+                'message': message, 'error': None}
+
+    def _account(self, result: Dict):
+        """Actualiza contadores y estado (siempre en el hilo del event loop)"""
+        members = self.members(result['client'])
+        self.status['current'] = self.status.get('current', 0) + len(members)
+        if result['success']:
+            self.success_count += len(members)
+            return
+        # Los que agotaron los reintentos quedaron registrados en dead_letters
+        for member in members:
+            self.error_count += 1
+            if result.get('dead_letter'):
+                self.dead_letter_count += 1
+            self.errors.append(result['error'])
+            self.status['errors'].append({
+                'agency_code': member['agency_code'],
+                'email': member['email'],
+                'error': result['error']
+            })
@@ -0,0 +1,111 @@
+import re
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Mapping, Optional, Tuple
+from jinja2 import TemplateError
+from jinja2.sandbox import SandboxedEnvironment
+
+# Plantillas compiladas que se mantienen en memoria (por proceso)
+TEMPLATE_CACHE_SIZE = 64
+
+# Entorno aislado: las plantillas las escriben usuarios, así que no pueden
+# acceder a atributos internos de Python. En el cuerpo HTML los valores de
+# los campos se escapan; en el asunto (texto plano) no.
+_subject_environment = SandboxedEnvironment(autoescape=False)
+_body_environment = SandboxedEnvironment(autoescape=True)
+
+
+def field_name(column: str) -> str:
+    """Nombre de variable de una columna ('Agency Code' -> agency_code)"""
+    return re.sub(r'\W+', '_', str(column).strip().lower()).strip('_')
+
+
+def merge_fields(client: Mapping) -> Dict:
+    """
+    Campos disponibles en la plantilla para un cliente: cada columna del
+    archivo importado (incluidas las guardadas en extra) con su nombre de
+    variable, y el diccionario `client` con los nombres originales
+    (p. ej. {{ agency_code }} o {{ client['Agency Code'] }})
+    """
+    row = {}
+    extra = client.get('extra')
+    if extra:
+        try:
+            row.update(json.loads(extra) if isinstance(extra, str) else extra)
+        except ValueError:
+            pass
+    row.update((key, value) for key, value in client.items() if key != 'extra')
+    fields = {field_name(key): value for key, value in row.items() if field_name(key)}
+    fields['client'] = row
+    return fields
+
+
+class CompiledTemplate:
+    """Asunto y cuerpo de una plantilla, compilados una sola vez"""
+
+    def __init__(self, subject: str, body: str):
+        self.subject = _subject_environment.from_string(subject)
+        self.body = _body_environment.from_string(body)
+
+    def render(self, client: Mapping) -> Tuple[str, str]:
+        fields = merge_fields(client)
+        # Un asunto no puede tener saltos de línea
+        subject = ' '.join(self.subject.render(fields).split())
+        return subject, self.body.render(fields)
+
+
+class TemplateCache:
+    """
+    Caché LRU de plantillas compiladas. La clave es (id, versión): al editar
+    una plantilla cambia su versión y la siguiente campaña la recompila.
+    Las plantillas sin id (no guardadas) se identifican por su contenido.
+    """
+
+    def __init__(self, max_size: int = TEMPLATE_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._lock = threading.Lock()
+        self._templates = OrderedDict()
+
+    @staticmethod
+    def key(template: Mapping):
+        if template.get('id') is not None:
+            return template['id'], template.get('version')
+        return None, template['subject'], template['body']
+
+    def get(self, template: Mapping) -> CompiledTemplate:
+        key = self.key(template)
+        with self._lock:
+            compiled = self._templates.get(key)
+            if compiled is not None:
+                self._templates.move_to_end(key)
+                return compiled
+
+        compiled = CompiledTemplate(template['subject'], template['body'])
+        with self._lock:
+            self._templates[key] = compiled
+            while len(self._templates) > self.max_size:
+                self._templates.popitem(last=False)
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+_cache = TemplateCache()
+
+
+def render_template(template: Mapping, client: Mapping) -> Tuple[str, str]:
+    """Asunto y cuerpo de una plantilla guardada para un cliente"""
+    return _cache.get(template).render(client)
+
+
+def validate_template(subject: str, body: str) -> Optional[str]:
+    """Devuelve el error de sintaxis de la plantilla, o None si compila"""
+    try:
+        CompiledTemplate(subject, body)
+    except TemplateError as e:
+        line = f" (línea {e.lineno})" if getattr(e, 'lineno', None) else ''
+        return f"Error en la plantilla{line}: {e.message or str(e)}"
+    return None
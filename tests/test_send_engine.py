@@ -0,0 +1,93 @@
+import time
+import threading
+from database import DatabaseManager
+from mailer import TransientSendError, PermanentSendError
+from rate_limiter import DomainRateLimiter
+from retry import RetryPolicy
+from send_engine import SendEngine
+
+
+class RecordingMailer:
+    """Backend falso: registra cuándo empieza y termina cada envío"""
+    sender = 'test@example.com'
+
+    def __init__(self, duration: float = 0.1):
+        self.duration = duration
+        self.sends = []
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def send_email(self, client, pdf_path, save_as_draft=False, template=None):
+        started = time.monotonic() - self._start
+        time.sleep(self.duration)
+        with self._lock:
+            self.sends.append((client['Report email'], started, time.monotonic() - self._start))
+
+    def close(self):
+        pass
+
+
+class FailingMailer(RecordingMailer):
+    """Backend falso que falla con el error indicado para cada agencia"""
+
+    def __init__(self, errors):
+        super().__init__(duration=0)
+        self.errors = errors
+
+    def send_email(self, client, pdf_path, save_as_draft=False, template=None):
+        error = self.errors.get(client['Agency Code'])
+        if error is not None:
+            raise error
+        super().send_email(client, pdf_path, save_as_draft, template)
+
+
+def make_engine(tmp_path, clients, mailer, rate_limits='', concurrency=8, **kwargs):
+    db_name = str(tmp_path / 'clients.db')
+    DatabaseManager(db_name).setup_database()
+    for client in clients:
+        (tmp_path / f"{client['agency_code']}.pdf").write_bytes(b'%PDF-1.4')
+    return SendEngine(mailer, str(tmp_path), concurrency=concurrency,
+                      rate_limiter=DomainRateLimiter.from_spec(rate_limits), db_name=db_name, **kwargs)
+
+
+def test_throttled_domain_does_not_hold_slots(tmp_path):
+    # slow.com admite 2 envíos por segundo; fast.com no tiene límite
+    clients = [{'agency_code': f'S{i}', 'email': f's{i}@slow.com'} for i in range(6)]
+    clients += [{'agency_code': f'F{i}', 'email': f'f{i}@fast.com'} for i in range(6)]
+    mailer = RecordingMailer()
+    summary = make_engine(tmp_path, clients, mailer, 'slow.com: 2/s').run(clients)
+
+    assert summary['success_count'] == 12
+    slow = sorted(send for send in mailer.sends if send[0].endswith('@slow.com'))
+    fast = [send for send in mailer.sends if send[0].endswith('@fast.com')]
+    # Los dominios sin límite terminan mientras slow.com espera su presupuesto
+    assert max(end for _, _, end in fast) < max(start for _, start, _ in slow)
+    assert max(end for _, _, end in fast) < 1.5
+
+
+def test_throttled_domain_keeps_its_rate(tmp_path):
+    clients = [{'agency_code': f'S{i}', 'email': f's{i}@slow.com'} for i in range(6)]
+    mailer = RecordingMailer(duration=0.01)
+    make_engine(tmp_path, clients, mailer, 'slow.com: 2/s').run(clients)
+
+    starts = sorted(start for _, start, _ in mailer.sends)
+    # Capacidad de 2 tokens y luego uno cada 0.5 s, sin ráfagas
+    assert starts[-1] >= 1.9
+    for earlier, later in zip(starts[2:], starts[3:]):
+        assert later - earlier >= 0.45
+
+
+def test_only_exhausted_retries_become_dead_letters(tmp_path):
+    clients = [{'agency_code': code, 'email': f'{code.lower()}@example.com'}
+               for code in ('OK', 'BUSY', 'REJECTED', 'NOPDF')]
+    mailer = FailingMailer({'BUSY': TransientSendError('421 try later'),
+                            'REJECTED': PermanentSendError('550 mailbox unavailable')})
+    engine = make_engine(tmp_path, clients[:3], mailer,
+                         retry_policy=RetryPolicy(max_attempts=2, base_delay=0.01))
+    summary = engine.run(clients)
+
+    assert summary['success_count'] == 1
+    assert summary['error_count'] == 3
+    assert summary['dead_letter_count'] == 1
+    dead_letters = DatabaseManager(engine.db_name).get_dead_letters()
+    assert [(d['agency_code'], d['attempts']) for d in dead_letters] == [('BUSY', 2)]
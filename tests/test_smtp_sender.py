@@ -0,0 +1,128 @@
+import socket
+import threading
+import socketserver
+import pytest
+from mailer import SMTPSender
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Servidor SMTP mínimo en memoria: acepta cualquier mensaje y cuenta las
+    conexiones. drop_connections() corta del lado del servidor las conexiones
+    abiertas, como un relay que cierra sesiones inactivas.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.connections = 0
+        self.messages = []
+        self.open_sockets = set()
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def drop_connections(self):
+        with self.lock:
+            sockets, self.open_sockets = self.open_sockets, set()
+        for sock in sockets:
+            sock.shutdown(socket.SHUT_RDWR)
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.open_sockets.add(self.request)
+        self.reply('220 sink ESMTP')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 sink')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:], []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:])
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''
+                while not data.endswith(b'\r\n.\r\n'):
+                    chunk = self.rfile.readline()
+                    if not chunk:
+                        return
+                    data += chunk
+                with self.server.lock:
+                    self.server.messages.append((sender, recipients, data))
+                self.reply('250 OK queued')
+            elif verb in ('NOOP', 'RSET'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+@pytest.fixture
+def sink():
+    server = SMTPSink()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_sender(sink, **kwargs):
+    return SMTPSender(host='127.0.0.1', port=sink.port, use_tls=False,
+                      sender='reportes@example.com', timeout=5, **kwargs)
+
+
+def client(code: str):
+    return {'Agency Code': code, 'Report email': f'{code.lower()}@example.com'}
+
+
+def test_connection_is_reused_across_messages(sink):
+    sender = make_sender(sink, pool_size=1)
+    for i in range(5):
+        assert sender.send_prepared(client(f'A{i}'), b'Subject: 1099\r\n\r\nadjunto\r\n')
+    sender.close()
+
+    assert sink.connections == 1
+    assert len(sink.messages) == 5
+    assert sink.messages[0][1] == ['<a0@example.com>']
+
+
+def test_connection_is_renewed_after_max_messages(sink):
+    sender = make_sender(sink, pool_size=1, max_messages_per_connection=2)
+    for i in range(5):
+        sender.send_prepared(client(f'A{i}'), b'Subject: 1099\r\n\r\nadjunto\r\n')
+    sender.close()
+
+    assert sink.connections == 3
+    assert len(sink.messages) == 5
+
+
+def test_reconnects_after_server_closes_connection(sink):
+    sender = make_sender(sink, pool_size=1)
+    assert sender.send_prepared(client('A0'), b'Subject: 1099\r\n\r\nadjunto\r\n')
+    # El servidor corta la sesión que el pool tiene guardada
+    sink.drop_connections()
+    assert sender.send_prepared(client('A1'), b'Subject: 1099\r\n\r\nadjunto\r\n')
+    sender.close()
+
+    assert sink.connections == 2
+    assert [recipients for _, recipients, _ in sink.messages] == [['<a0@example.com>'], ['<a1@example.com>']]